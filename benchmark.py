@@ -0,0 +1,433 @@
+#!/usr/bin/python3 -B
+
+#
+# Benchmark of the Python ROM Manager.
+# Generates a synthetic corpus (Logiqx DATs and ROM collections) and times the DAT loader,
+# the scanner, the scanner database and the fixer.
+#
+
+# Copyright (c) 2020 Wintermute0110 <wintermute0110@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+# --- Python standard library --------------------------------------------------------------------
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+import zlib
+
+# --- PRM modules --------------------------------------------------------------------------------
+import common
+from common import log_error, log_warn, log_info, log_verb, log_debug
+from common import FileName
+from common import ROMcollection
+
+# iNES header used by the headered collection. The ROMs are identified with the No-Intro NES
+# header detector in contrib, which checks the "NES" magic and skips 16 bytes.
+NES_HEADER_OFFSET = 16
+NES_HEADER_DETECTOR = 'No-Intro_NES.xml'
+
+# --- Class with program options and settings ----------------------------------------------------
+class Options:
+    def __init__(self):
+        self.num_sets = 2000
+        self.num_NES_sets = None
+        self.rom_size = 32 * 1024
+        self.large_every = 0
+        self.large_size = 64 * 1024 * 1024
+        self.badname_rate = 0.10
+        self.unknown_rate = 0.05
+        self.error_rate = 0.02
+        self.missing_rate = 0.03
+        self.seed = 1
+        self.jobs = 1
+        self.threads = 1
+        self.work_dir = None
+        self.keep = False
+        self.output_file = None
+        self.compare_file = None
+
+# Process the program options in variable args. Returns an Options object.
+def process_arguments(args):
+    options = Options()
+    if args.verbose:
+        if args.verbose == 1:
+            common.change_log_level(common.LOG_VERB)
+        elif args.verbose == 2:
+            common.change_log_level(common.LOG_DEBUG)
+    else:
+        common.change_log_level(common.LOG_WARN)
+    for name in ('sets', 'romSize', 'largeEvery', 'largeSize', 'jobs', 'threads'):
+        value = getattr(args, name)
+        if value is not None and value < (0 if name == 'largeEvery' else 1):
+            log_error('--{} must be {} or greater.'.format(name, 0 if name == 'largeEvery' else 1))
+            sys.exit(1)
+    if args.sets is not None: options.num_sets = args.sets
+    options.num_NES_sets = args.NESsets if args.NESsets is not None else options.num_sets // 10
+    if args.romSize is not None: options.rom_size = args.romSize
+    if args.largeEvery is not None: options.large_every = args.largeEvery
+    if args.largeSize is not None: options.large_size = args.largeSize * 1024 * 1024
+    for name in ('badname', 'unknown', 'error', 'missing'):
+        value = getattr(args, name)
+        if value is None: continue
+        if not 0.0 <= value <= 1.0:
+            log_error('--{} must be between 0 and 1.'.format(name))
+            sys.exit(1)
+        setattr(options, name + '_rate', value)
+    if options.badname_rate + options.unknown_rate + options.error_rate + options.missing_rate > 1.0:
+        log_error('The sum of --badname, --unknown, --error and --missing must not be greater than 1.')
+        sys.exit(1)
+    if args.seed is not None: options.seed = args.seed
+    if args.jobs is not None: options.jobs = args.jobs
+    if args.threads is not None: options.threads = args.threads
+    options.work_dir = args.workDir
+    options.keep = args.keep
+    options.output_file = args.output
+    options.compare_file = args.compare
+
+    return options
+
+# --- Corpus generator ---------------------------------------------------------------------------
+SET_GOOD    = 'Good'
+SET_BADNAME = 'BadName'
+SET_UNKNOWN = 'Unknown'
+SET_ERROR   = 'Error'
+SET_MISSING = 'Missing'
+SET_BADNAME_ZIP = 'BadName ZIP'
+
+def get_DAT_rom_line(rom_name, data):
+    return '\t\t<rom name="{}" size="{}" crc="{:08x}" md5="{}" sha1="{}"/>\n'.format(
+        rom_name, len(data), zlib.crc32(data) & 0xFFFFFFFF,
+        hashlib.md5(data).hexdigest(), hashlib.sha1(data).hexdigest())
+
+def write_ZIP_file(filename, member_list):
+    with zipfile.ZipFile(filename, 'w', compression = zipfile.ZIP_DEFLATED, compresslevel = 1) as zip_f:
+        for name, data in member_list: zip_f.writestr(name, data)
+
+# Generates a collection of num_sets sets in ROM_dir and its DAT in DAT_fname.
+# If header is True the ROMs have an iNES header that is not in the DAT checksums.
+# Returns a dictionary with the number of sets of each status. SET_BADNAME_ZIP is the number
+# of BadName sets with a wrong ZIP name, their DAT sets are also Missing.
+def generate_collection(options, rng, DAT_fname, ROM_dir, system_name, num_sets, header):
+    os.makedirs(ROM_dir)
+    counters = {SET_GOOD : 0, SET_BADNAME : 0, SET_UNKNOWN : 0, SET_ERROR : 0, SET_MISSING : 0,
+        SET_BADNAME_ZIP : 0}
+    ext = '.nes' if header else '.bin'
+    with open(DAT_fname, 'w', encoding = 'utf-8') as DAT_f:
+        DAT_f.write('<?xml version="1.0"?>\n')
+        DAT_f.write('<!DOCTYPE datafile PUBLIC "-//Logiqx//DTD ROM Management Datafile//EN" '
+            '"http://www.logiqx.com/Dats/datafile.dtd">\n')
+        DAT_f.write('<datafile>\n\t<header>\n\t\t<name>{}</name>\n'.format(system_name))
+        DAT_f.write('\t\t<description>{} (benchmark)</description>\n\t</header>\n'.format(system_name))
+        for i in range(num_sets):
+            x = rng.random()
+            if x < options.badname_rate: status = SET_BADNAME
+            elif x < options.badname_rate + options.unknown_rate: status = SET_UNKNOWN
+            elif x < options.badname_rate + options.unknown_rate + options.error_rate: status = SET_ERROR
+            elif x < options.badname_rate + options.unknown_rate + options.error_rate + \
+                options.missing_rate: status = SET_MISSING
+            else: status = SET_GOOD
+            counters[status] += 1
+            if status == SET_GOOD and options.large_every and i % options.large_every == 0:
+                size = options.large_size
+            else:
+                size = rng.randint(options.rom_size // 2 + 1, options.rom_size * 3 // 2)
+            data = rng.randbytes(size)
+            set_name = '{} Game {:06d} (World)'.format(system_name, i)
+            rom_name = set_name + ext
+
+            # Unknown and Error sets are not in the DAT.
+            if status not in (SET_UNKNOWN, SET_ERROR):
+                DAT_f.write('\t<game name="{}">\n\t\t<description>{}</description>\n'.format(set_name, set_name))
+                DAT_f.write(get_DAT_rom_line(rom_name, data))
+                DAT_f.write('\t</game>\n')
+            if status == SET_MISSING: continue
+
+            if header: data = b'NES\x1A' + rng.randbytes(NES_HEADER_OFFSET - 4) + data
+            zip_name = set_name + '.zip'
+            if status == SET_BADNAME:
+                # Half the BadName sets have a wrong ZIP name and half a wrong ROM name.
+                if i % 2:
+                    zip_name = 'Bad {:06d}.zip'.format(i)
+                    counters[SET_BADNAME_ZIP] += 1
+                else: rom_name = 'bad_{:06d}{}'.format(i, ext)
+            elif status == SET_UNKNOWN:
+                zip_name = 'Unknown {:06d}.zip'.format(i)
+            elif status == SET_ERROR:
+                zip_name = 'Error {:06d}.zip'.format(i)
+            zip_fname = os.path.join(ROM_dir, zip_name)
+            if status == SET_ERROR:
+                # Alternate corrupted files and ZIP files with two ROMs.
+                if i % 2:
+                    with open(zip_fname, 'wb') as f: f.write(data[:1024])
+                else:
+                    write_ZIP_file(zip_fname, [(rom_name, data), ('extra.txt', b'extra')])
+            else:
+                write_ZIP_file(zip_fname, [(rom_name, data)])
+        DAT_f.write('</datafile>\n')
+
+    return counters
+
+# Returns the list of the collection_conf of the generated collections.
+def generate_corpus(options, work_dir):
+    rng = random.Random(options.seed)
+    DAT_dir = os.path.join(work_dir, 'DATs')
+    os.makedirs(DAT_dir)
+    collection_list = []
+    for name, system_name, num_sets, header in (
+        ('bench', 'Benchmark', options.num_sets, False),
+        ('bench_nes', 'Benchmark NES', options.num_NES_sets, True)):
+        if num_sets == 0: continue
+        DAT_basename = '{} (20200101-000000).dat'.format(system_name)
+        print('Generating collection {} with {:,} sets...'.format(name, num_sets))
+        counters = generate_collection(options, rng, os.path.join(DAT_dir, DAT_basename),
+            os.path.join(work_dir, name), system_name, num_sets, header)
+        collection_conf = common.ConfigFile().new_collection_dic()
+        collection_conf['name'] = name
+        collection_conf['platform'] = name
+        collection_conf['DAT'] = DAT_basename
+        collection_conf['ROM_dir'] = os.path.join(work_dir, name)
+        if header:
+            collection_conf['HeaderDetector'] = common.get_header_detector_path(NES_HEADER_DETECTOR, work_dir)
+        collection_conf['counters'] = counters
+        collection_list.append(collection_conf)
+
+    return collection_list
+
+# --- Measurements -------------------------------------------------------------------------------
+# Times a phase of the benchmark. items is the number of files or sets processed and
+# num_bytes the bytes read or written.
+class PhaseTimer:
+    def __init__(self, results, name):
+        self.results = results
+        self.name = name
+        self.items = 0
+        self.num_bytes = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None: return False
+        seconds = time.perf_counter() - self.start
+        self.results[self.name] = {
+            'seconds' : round(seconds, 4),
+            'items' : self.items,
+            'bytes' : self.num_bytes,
+            'items_per_s' : round(self.items / seconds, 1) if seconds > 0 else None,
+            'MB_per_s' : round(self.num_bytes / seconds / (1024 * 1024), 2) if seconds > 0 else None,
+            'peak_RSS_MB' : common.get_peak_RSS_MB(),
+        }
+        log_info('{} {:.3f} s'.format(self.name, seconds))
+        return False
+
+def get_files_size(file_list):
+    return sum(os.path.getsize(filename) for filename in file_list)
+
+# Runs all the phases on a collection. The names of the phases are prefixed with the name of
+# the collection.
+def benchmark_collection(options, work_dir, collection_conf, results):
+    name = collection_conf['name']
+    print('Benchmarking collection {}...'.format(name))
+    data_dir_FN = FileName(os.path.join(work_dir, 'data'))
+    data_dir_FN.makedirs()
+    DAT_FN = FileName(os.path.join(work_dir, 'DATs', collection_conf['DAT']))
+    DAT_cache_FN = data_dir_FN.pjoin(name + '_DAT.bin')
+    DAT_size = os.path.getsize(DAT_FN.getPath())
+
+    # --- DAT loader ---
+    with PhaseTimer(results, name + '.DAT_load_XML') as t:
+        DAT = common.load_XML_DAT_file(DAT_FN)
+        t.items, t.num_bytes = len(DAT.sets), DAT_size
+    with PhaseTimer(results, name + '.DAT_cache_build') as t:
+        common.load_XML_DAT_file(DAT_FN, DAT_cache_FN)
+        t.items, t.num_bytes = len(DAT.sets), DAT_size
+    with PhaseTimer(results, name + '.DAT_load_cache') as t:
+        DAT = common.load_XML_DAT_file(DAT_FN, DAT_cache_FN)
+        t.items, t.num_bytes = len(DAT.sets), os.path.getsize(DAT_cache_FN.getPath())
+
+    # --- Scanner ---
+    # The directory is read first so process_files() only measures reading and hashing.
+    collection = ROMcollection(collection_conf)
+    with PhaseTimer(results, name + '.scan_dir') as t:
+        collection.scan_files_in_dir()
+        t.items = len(collection.get_file_list())
+    files_size = get_files_size(collection.file_list)
+    cache_FN = data_dir_FN.pjoin(name + '_checksums.bin')
+    cache = common.ChecksumCache(cache_FN, collection.header_detector)
+    cache.load()
+    with PhaseTimer(results, name + '.scan_cold') as t:
+        collection.process_files(DAT, options.jobs, cache, show_progress = False,
+            num_threads = options.threads)
+        t.items, t.num_bytes = len(collection.file_list), files_size
+    cache.save()
+    collection = ROMcollection(collection_conf)
+    cache = common.ChecksumCache(cache_FN, collection.header_detector)
+    cache.load()
+    with PhaseTimer(results, name + '.scan_warm') as t:
+        collection.scan_files_in_dir()
+        collection.process_files(DAT, options.jobs, cache, show_progress = False,
+            num_threads = options.threads)
+        t.items, t.num_bytes = len(collection.file_list), 0
+
+    # --- Scanner database and status/list commands ---
+    scan_db = common.ScanDatabase(data_dir_FN.pjoin('scan.db'))
+    with PhaseTimer(results, name + '.db_save') as t:
+        scan_db.save_collection(collection)
+        t.items = len(collection.sets)
+    with PhaseTimer(results, name + '.status') as t:
+        stats = scan_db.get_collection_statistics(name)
+        t.items = stats['total']
+    with PhaseTimer(results, name + '.listROMs') as t:
+        t.items = len(scan_db.get_sets(name))
+    issue_statuses = [common.ROMset.SET_STATUS_BADNAME, common.ROMset.SET_STATUS_MISSING,
+        common.ROMset.SET_STATUS_UNKNOWN, common.ROMset.SET_STATUS_ERROR]
+    with PhaseTimer(results, name + '.listIssues') as t:
+        t.items = len(scan_db.get_sets(name, issue_statuses))
+
+    # --- Fixer ---
+    # Renames the files of the corpus, so it is the last phase.
+    fix_list = scan_db.get_sets(name, [common.ROMset.SET_STATUS_BADNAME])
+    scan_db.close()
+    with PhaseTimer(results, name + '.fix') as t:
+        for rom_set in fix_list:
+            t.num_bytes += os.path.getsize(rom_set.filename)
+            if common.fix_ROM_set(rom_set, DAT.get_ROM_extensions()): t.items += 1
+
+    # Check the scanner found the sets generated.
+    counters = collection_conf['counters']
+    expected = {
+        'have' : counters[SET_GOOD], 'badname' : counters[SET_BADNAME],
+        'missing' : counters[SET_MISSING] + counters[SET_BADNAME_ZIP],
+        'unknown' : counters[SET_UNKNOWN],
+        'error' : counters[SET_ERROR],
+    }
+    for key, value in expected.items():
+        if stats[key] != value:
+            log_warn('Collection {} has {} {} sets, {} expected'.format(name, stats[key], key, value))
+
+def get_system_info(options):
+    return {
+        'prm_version' : common.PRM_VERSION,
+        'python' : platform.python_version(),
+        'platform' : platform.platform(),
+        'cpu_count' : multiprocessing.cpu_count(),
+        'time' : time.strftime('%Y-%m-%d %H:%M:%S'),
+        'corpus' : {
+            'sets' : options.num_sets,
+            'NES_sets' : options.num_NES_sets,
+            'rom_size' : options.rom_size,
+            'large_every' : options.large_every,
+            'large_size' : options.large_size,
+            'badname_rate' : options.badname_rate,
+            'unknown_rate' : options.unknown_rate,
+            'error_rate' : options.error_rate,
+            'missing_rate' : options.missing_rate,
+            'seed' : options.seed,
+        },
+        'jobs' : options.jobs,
+        'threads' : options.threads,
+    }
+
+def print_results(results, old_results = None):
+    header = ['Phase', 'Seconds', 'Items/s', 'MB/s', 'Peak RSS MB']
+    if old_results is not None: header.append('Old seconds')
+    if old_results is not None: header.append('Change')
+    table_str = [['left'] * len(header), header]
+    for phase, result in results.items():
+        row = [
+            phase, '{:.3f}'.format(result['seconds']),
+            '{:,.0f}'.format(result['items_per_s']) if result['items_per_s'] else '',
+            '{:.1f}'.format(result['MB_per_s']) if result['MB_per_s'] else '',
+            str(result['peak_RSS_MB']),
+        ]
+        if old_results is not None:
+            old_result = old_results.get(phase)
+            if old_result is None:
+                row.extend(['', ''])
+            else:
+                row.append('{:.3f}'.format(old_result['seconds']))
+                if old_result['seconds'] > 0:
+                    change = (result['seconds'] - old_result['seconds']) / old_result['seconds']
+                    row.append('{:+.1%}'.format(change))
+                else:
+                    row.append('')
+        table_str.append(row)
+    print('')
+    for line in common.text_render_table(table_str): print(line)
+
+# -----------------------------------------------------------------------------
+# main function
+# -----------------------------------------------------------------------------
+if __name__ == '__main__':
+    print('\033[36mPython ROM Manager benchmark\033[0m version ' + common.PRM_VERSION)
+
+    # --- Command line parser
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-v', '--verbose', help = 'Be verbose', action = 'count')
+    parser.add_argument('--sets', help = 'Number of sets of the collection', type = int)
+    parser.add_argument('--NESsets', help = 'Number of sets of the headered collection', type = int)
+    parser.add_argument('--romSize', help = 'Average ROM size in bytes', type = int)
+    parser.add_argument('--largeEvery', help = 'Make one of every N Good ROMs large', type = int)
+    parser.add_argument('--largeSize', help = 'Size of the large ROMs in MiB', type = int)
+    parser.add_argument('--badname', help = 'Fraction of BadName sets', type = float)
+    parser.add_argument('--unknown', help = 'Fraction of Unknown sets', type = float)
+    parser.add_argument('--error', help = 'Fraction of Error sets', type = float)
+    parser.add_argument('--missing', help = 'Fraction of Missing sets', type = float)
+    parser.add_argument('--seed', help = 'Seed of the corpus generator', type = int)
+    parser.add_argument('--jobs', help = 'Number of scanner processes', type = int)
+    parser.add_argument('--threads', help = 'Number of scanner hashing threads', type = int)
+    parser.add_argument('--workDir', help = 'Directory for the corpus, must not exist')
+    parser.add_argument('--keep', help = 'Do not delete the corpus', action = 'store_true')
+    parser.add_argument('--output', help = 'Write the results to this JSON file')
+    parser.add_argument('--compare', help = 'Compare with the results in this JSON file')
+    args = parser.parse_args()
+    options = process_arguments(args)
+
+    if options.work_dir is None:
+        work_dir = tempfile.mkdtemp(prefix = 'prm_benchmark_')
+    else:
+        if os.path.exists(options.work_dir):
+            log_error('Directory "{}" already exists.'.format(options.work_dir))
+            sys.exit(1)
+        os.makedirs(options.work_dir)
+        work_dir = options.work_dir
+    old_results = None
+    if options.compare_file is not None:
+        with open(options.compare_file, 'r', encoding = 'utf-8') as f:
+            old_results = json.load(f)['results']
+
+    try:
+        start_time = time.perf_counter()
+        collection_list = generate_corpus(options, work_dir)
+        print('Corpus generated in {:.1f} s in "{}"'.format(time.perf_counter() - start_time, work_dir))
+        results = {}
+        for collection_conf in collection_list:
+            benchmark_collection(options, work_dir, collection_conf, results)
+    finally:
+        if not options.keep: shutil.rmtree(work_dir, ignore_errors = True)
+
+    print_results(results, old_results)
+    output = get_system_info(options)
+    output['results'] = results
+    if options.output_file is not None:
+        with open(options.output_file, 'w', encoding = 'utf-8') as f:
+            json.dump(output, f, indent = 2)
+        print('\nResults written to "{}"'.format(options.output_file))
@@ -17,19 +17,44 @@
 
 # --- Python standard library --------------------------------------------------------------------
 from collections import OrderedDict
+import contextlib
+import ctypes
+import ctypes.util
+import functools
 import hashlib
 import fnmatch
+import io
+import itertools
+import json
+import math
+import mmap
+import multiprocessing
 import os
+import pickle
 import pprint
+import queue
+import random
 import re
+import select
+import sqlite3
+import struct
 import sys
+import threading
+import time
 import xml.etree.ElementTree
 import zipfile
 import zlib
+try:
+    import resource
+except ImportError:
+    resource = None
 
 # --- Global variables ---------------------------------------------------------------------------
 PRM_VERSION = '0.1.0'
 
+# Hash algorithms the scanner can compute. Any subset can be selected.
+HASH_ALGORITHMS = ('crc', 'md5', 'sha1')
+
 # --- DEBUG functions ----------------------------------------------------------------------------
 def debug_dumpclean(obj):
     if type(obj) == dict:
@@ -73,27 +98,120 @@ def change_log_level(level):
 
     log_level = level
 
+# Serializes the output of the log functions and ProgressReporter, which may be called from
+# several threads. progress_line_active is True if the last thing written to the console is
+# a progress line without a newline.
+log_lock = threading.Lock()
+progress_line_active = False
+
 # --- Print/log to a specific level
-def myprint(level, print_str):
-    # --- Write to console depending on verbosity
-    if level <= log_level:
+# If args is not empty print_str is a format string. It is only formatted if the message is
+# printed, so disabled log_debug() calls are cheap. Call log_debug('File "{}"', filename)
+# instead of log_debug('File "{}"'.format(filename)) in loops.
+def myprint(level, print_str, args = ()):
+    global progress_line_active
+
+    if level > log_level: return
+    if args: print_str = print_str.format(*args)
+    with log_lock:
+        # --- Write to console depending on verbosity
+        if progress_line_active:
+            sys.stdout.write('\n')
+            progress_line_active = False
         print(print_str)
 
-    # --- Write to file
-    if file_log_flag and level <= log_level:
-        if print_str[-1] != '\n': print_str += '\n'
-        f_log.write(print_str) # python will convert \n to os.linesep
+        # --- Write to file
+        if file_log_flag:
+            if print_str[-1] != '\n': print_str += '\n'
+            f_log.write(print_str) # python will convert \n to os.linesep
 
 # --- Some useful function overloads
-def log_error(print_str): myprint(LOG_ERROR, print_str)
-
-def log_warn(print_str): myprint(LOG_WARN, print_str)
-
-def log_info(print_str): myprint(LOG_INFO, print_str)
-
-def log_verb(print_str): myprint(LOG_VERB, print_str)
-
-def log_debug(print_str): myprint(LOG_DEBUG, print_str)
+def log_error(print_str, *args): myprint(LOG_ERROR, print_str, args)
+
+def log_warn(print_str, *args): myprint(LOG_WARN, print_str, args)
+
+def log_info(print_str, *args): myprint(LOG_INFO, print_str, args)
+
+def log_verb(print_str, *args): myprint(LOG_VERB, print_str, args)
+
+def log_debug(print_str, *args): myprint(LOG_DEBUG, print_str, args)
+
+# Formats a number of seconds as H:MM:SS or M:SS.
+def text_format_seconds(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours: return '{}:{:02d}:{:02d}'.format(hours, minutes, seconds)
+
+    return '{}:{:02d}'.format(minutes, seconds)
+
+# Progress display of a loop. The line is written at most every interval seconds, so the
+# terminal output does not slow down loops with many fast iterations. If stdout is not a
+# terminal a full line is printed every 10 seconds instead.
+# update() can be called from several threads. Worker processes do not print progress, the
+# process that collects their results calls update().
+class ProgressReporter:
+    def __init__(self, label, total = None, interval = 0.25):
+        self.label = label
+        self.total = total
+        self.total_is_final = True
+        self.is_tty = sys.stdout.isatty()
+        self.interval = interval if self.is_tty else 10.0
+        self.count = 0
+        self.num_bytes = 0
+        self.start_time = time.monotonic()
+        self.last_time = self.start_time
+        self.line_size = 0
+
+    # count items of num_bytes bytes have been processed. If total is not None it is the new
+    # total of items. If total_is_final is False more items may be found, the ETA is not shown.
+    def update(self, count = 1, num_bytes = 0, total = None, total_is_final = True):
+        with log_lock:
+            self.count += count
+            self.num_bytes += num_bytes
+            if total is not None:
+                self.total = total
+                self.total_is_final = total_is_final
+            now = time.monotonic()
+            if now - self.last_time < self.interval: return
+            self.last_time = now
+            self._write(now)
+
+    # Writes the final line and ends it with a newline.
+    def finish(self):
+        global progress_line_active
+
+        with log_lock:
+            self._write(time.monotonic())
+            if self.is_tty:
+                sys.stdout.write('\n')
+                sys.stdout.flush()
+                progress_line_active = False
+
+    def _write(self, now):
+        global progress_line_active
+
+        elapsed = now - self.start_time
+        text = '{} {:,}'.format(self.label, self.count)
+        if self.total is not None:
+            text += ' of {:,}{}'.format(self.total, '' if self.total_is_final else ' found')
+        if elapsed > 0:
+            text += ' ({:,.0f}/s'.format(self.count / elapsed)
+            if self.num_bytes:
+                text += ', {:,.1f} MB/s'.format(self.num_bytes / elapsed / (1024 * 1024))
+            if self.total and self.total_is_final and 0 < self.count < self.total:
+                eta = (self.total - self.count) * elapsed / self.count
+                text += ', ETA {}'.format(text_format_seconds(eta))
+            text += ')'
+        if self.is_tty:
+            if progress_line_active:
+                sys.stdout.write('\r' + text.ljust(self.line_size))
+            else:
+                sys.stdout.write(text)
+            sys.stdout.flush()
+            self.line_size = len(text)
+            progress_line_active = True
+        else:
+            print(text)
 
 # --- XML functions ------------------------------------------------------------------------------
 # Reads merged MAME XML file.
@@ -379,6 +497,73 @@ class FileName:
     def rename(self, to):
         os.rename(self.path, to.getPath())
 
+    # Generator of ScanEntry objects of the files in path and its subdirectories that pass
+    # file_filter, a FileFilter object. Files are returned while the directories are read.
+    def recursiveScanDirEntries(self, file_filter = None):
+        return scan_dir_entries(self.path, file_filter)
+
+# --- Directory scanner --------------------------------------------------------------------------
+# File in a directory returned by scan_dir_entries(). The attribute names are the same as in
+# os.stat_result so a ScanEntry can be used instead, see ChecksumCache.
+class ScanEntry:
+    __slots__ = ('path', 'name', 'st_size', 'st_mtime_ns', 'st_ino')
+
+    def __init__(self, path, name, st):
+        self.path = path
+        self.name = name
+        self.st_size = st.st_size
+        self.st_mtime_ns = st.st_mtime_ns
+        self.st_ino = st.st_ino
+
+# Selects files by name. include and exclude are lists of fnmatch patterns. extensions is a
+# list of file extensions, case insensitive. A file passes the filter if it matches any
+# include pattern (or include is empty), no exclude pattern and has one of the extensions
+# (or extensions is empty).
+class FileFilter:
+    def __init__(self, include = (), exclude = (), extensions = ()):
+        self.include = list(include)
+        self.exclude = list(exclude)
+        self.extensions = tuple(ext.lower() for ext in extensions)
+
+    def match(self, name):
+        if self.include and not any(fnmatch.fnmatch(name, p) for p in self.include): return False
+        if any(fnmatch.fnmatch(name, p) for p in self.exclude): return False
+        if self.extensions and not name.lower().endswith(self.extensions): return False
+
+        return True
+
+# Temporary files created by fix, import and prm-mame rebuild are not sets.
+SCANNER_FILE_FILTER = FileFilter(exclude = ('_prm_*.zip', '*.prm_tmp'))
+
+# Generator of ScanEntry objects of the files in dirname and its subdirectories, like
+# os.walk() does. Paths are os.path.join(directory, name) so they are the same as with
+# os.walk(). The stat result is taken from os.scandir() and files that cannot be stat'ed
+# (for example broken symlinks) are skipped. Symlinks to directories are not followed.
+def scan_dir_entries(dirname, file_filter = None):
+    dir_stack = [dirname]
+    while dir_stack:
+        current_dir = dir_stack.pop()
+        subdir_list = []
+        try:
+            dir_iter = os.scandir(current_dir)
+        except OSError as e:
+            log_warn('Cannot read directory "{}": {}'.format(current_dir, str(e)))
+            continue
+        with dir_iter:
+            for entry in dir_iter:
+                try:
+                    if entry.is_dir():
+                        if not entry.is_symlink(): subdir_list.append(entry.path)
+                        continue
+                    if file_filter is not None and not file_filter.match(entry.name): continue
+                    st = entry.stat()
+                except OSError as e:
+                    log_warn('Cannot stat "{}": {}'.format(entry.path, str(e)))
+                    continue
+                yield ScanEntry(entry.path, entry.name, st)
+        # Visit the subdirectories in alphabetical order.
+        dir_stack.extend(sorted(subdir_list, reverse = True))
+
 # --- Configuration file stuff --------------------------------------------------------------------
 class ConfigFile:
     # Valid tags in the XML file. Text in these tags is string.
@@ -393,8 +578,16 @@ class ConfigFile:
         'platform',
         'HeaderOffset',
         'HeaderRule',
+        'HeaderDetector',
+        'DAT',
+        'ROM_dir',
+    ]
+    MAME_collection_tag_set = [
+        'name',
         'DAT',
+        'SetType',
         'ROM_dir',
+        'Source_dir',
     ]
 
     def __init__(self):
@@ -410,6 +603,8 @@ class ConfigFile:
         # Dictionary of dictionaries. Key is the collection name.
         # Uses OrderedDict() to keep order as found in the config file.
         self.collections = OrderedDict()
+        # MAME collections, used by prm-mame. Key is the collection name.
+        self.MAME_collections = OrderedDict()
 
     def new_collection_dic(self):
         return OrderedDict([
@@ -417,14 +612,39 @@ class ConfigFile:
             ('platform', ''),
             ('HeaderOffset', 0),
             ('HeaderRules', []),
+            ('HeaderDetector', ''),
             ('DAT', ''),
             ('ROM_dir', ''),
         ])
 
+    # MAME ROMs do not have headers.
+    def new_MAME_collection_dic(self):
+        return OrderedDict([
+            ('name', ''),
+            ('HeaderOffset', 0),
+            ('HeaderRules', []),
+            ('HeaderDetector', ''),
+            ('DAT', ''),
+            ('SetType', 'split'),
+            ('ROM_dir', ''),
+            ('Source_dirs', []),
+        ])
+
+# Header detector file names are relative to the directory of the configuration file. If the
+# file is not there the detectors in the contrib directory of PRM are used.
+def get_header_detector_path(detector_name, config_dir):
+    detector_path = os.path.join(config_dir, detector_name)
+    if os.path.isfile(detector_path): return detector_path
+    contrib_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'contrib', detector_name)
+    if os.path.isfile(contrib_path): return contrib_path
+
+    return detector_path
+
 # Parses configuration file using ElementTree.
 # Returns a ConfigFile object
 def parse_File_Config(options):
     log_info('Parsing configuration file')
+    config_dir = os.path.dirname(os.path.abspath(options.config_file_name))
     xml_tree = XML_read_file_ElementTree(options.config_file_name)
     xml_root = xml_tree.getroot()
     configuration = ConfigFile()
@@ -462,15 +682,46 @@ def parse_File_Config(options):
                         'offset' : offset,
                         'value' : xml_text,
                     })
+                elif xml_tag == 'HeaderDetector':
+                    collection[xml_tag] = get_header_detector_path(xml_text, config_dir)
                 else:
                     collection[xml_tag] = xml_text
             filter_name = collection['name']
             if not filter_name:
                     print('[ERROR] Collection has empty <name> tag.')
                     sys.exit(10)
+            if collection['HeaderDetector'] and collection['HeaderOffset'] > 0:
+                print('[ERROR] Collection "{}" has <HeaderDetector> and <HeaderOffset>.'.format(filter_name))
+                print('[ERROR] Use only one of them.')
+                sys.exit(10)
             collection['name'] = filter_name
             configuration.collections[filter_name] = collection
-            log_debug('Adding collection "{}"'.format(filter_name))
+            log_debug('Adding collection "{}"', filter_name)
+        elif root_child.tag == 'MAME_collection':
+            collection = configuration.new_MAME_collection_dic()
+            for filter_child in root_child:
+                xml_text = filter_child.text if filter_child.text is not None else ''
+                xml_text = text_unescape_XML(xml_text)
+                xml_tag  = filter_child.tag
+                if xml_tag not in ConfigFile.MAME_collection_tag_set:
+                    print('[ERROR] On <MAME_collection> section')
+                    print('[ERROR] Unrecognised tag <{}>'.format(xml_tag))
+                    sys.exit(10)
+                if xml_tag == 'Source_dir':
+                    collection['Source_dirs'].append(xml_text)
+                elif xml_tag == 'SetType':
+                    if xml_text not in MAME_SET_TYPES:
+                        print('[ERROR] On <MAME_collection> section')
+                        print('[ERROR] <SetType> must be one of {}'.format(', '.join(MAME_SET_TYPES)))
+                        sys.exit(10)
+                    collection[xml_tag] = xml_text
+                else:
+                    collection[xml_tag] = xml_text
+            if not collection['name']:
+                print('[ERROR] MAME collection has empty <name> tag.')
+                sys.exit(10)
+            configuration.MAME_collections[collection['name']] = collection
+            log_debug('Adding MAME collection "{}"', collection['name'])
         else:
             log_error('[ERROR] At XML root level')
             log_error('[ERROR] Unrecognised tag <{}>'.format(root_child.tag))
@@ -478,165 +729,1316 @@ def parse_File_Config(options):
 
     return configuration
 
+# --- ROM header detectors ------------------------------------------------------------------------
+# Header detectors are the clrmamepro XML files that describe the ROM headers of a platform,
+# see contrib/xmlheaders.txt. A detector has a list of rules. The first rule whose tests are
+# all true gives the block of the file with the ROM data: the start and end offsets and the
+# byte swap applied before hashing. If no rule is true the ROM has no header.
+# Detectors are compiled once per collection. Test values are converted to bytes and integers,
+# so checking a ROM only compares slices of its first bytes.
+
+# Value is the size of the unit swapped by the operation.
+DETECTOR_OPERATIONS = {
+    'none' : 1,
+    'bitswap' : 1,
+    'byteswap' : 2,
+    'wordswap' : 4,
+    'wordbyteswap' : 4,
+}
+DETECTOR_BITSWAP_TABLE = bytes(int('{:08b}'.format(i)[::-1], 2) for i in range(256))
+
+# The whole file, a ROM without header.
+DETECTOR_FULL_BLOCK = (0, None, 'none')
+
+# Offsets are tuples (value, from_end). If from_end is True the offset is value bytes before
+# the end of the file.
+def detector_parse_offset(text):
+    text = text.strip()
+    if text.upper() == 'EOF': return (0, True)
+    if text.startswith('-'): return (int(text[1:], 16), True)
+
+    return (int(text, 16), False)
+
+def detector_resolve_offset(offset, size):
+    return size - offset[0] if offset[1] else offset[0]
+
+# Swaps the bytes of data. len(data) must be a multiple of the operation unit.
+def detector_swap_bytes(data, operation):
+    if operation == 'bitswap': return data.translate(DETECTOR_BITSWAP_TABLE)
+    swapped = bytearray(len(data))
+    if operation == 'byteswap':
+        swapped[0::2] = data[1::2]
+        swapped[1::2] = data[0::2]
+    elif operation == 'wordswap':
+        swapped[0::4] = data[3::4]
+        swapped[1::4] = data[2::4]
+        swapped[2::4] = data[1::4]
+        swapped[3::4] = data[0::4]
+    elif operation == 'wordbyteswap':
+        swapped[0::4] = data[2::4]
+        swapped[1::4] = data[3::4]
+        swapped[2::4] = data[0::4]
+        swapped[3::4] = data[1::4]
+
+    return bytes(swapped)
+
+# kind is data, or, xor, and or file. value and mask are bytes. File tests use size, None is
+# a power of 2 size, and operator.
+class DetectorTest:
+    __slots__ = ('kind', 'offset', 'value', 'mask', 'value_int', 'mask_int', 'result',
+        'operator', 'size')
+
+    def __init__(self, kind, offset = (0, False), value = b'', mask = b'', result = True,
+        operator = 'equal', size = None):
+        self.kind = kind
+        self.offset = offset
+        self.value = value
+        self.mask = mask
+        self.value_int = int.from_bytes(value, 'big')
+        self.mask_int = int.from_bytes(mask, 'big')
+        self.result = result
+        self.operator = operator
+        self.size = size
+
+    def get_key(self):
+        return (self.kind, self.offset, self.value, self.mask, self.result, self.operator, self.size)
+
+    # data has the first bytes of a file of size bytes. A test that reads outside data or the
+    # file is false whatever its result attribute.
+    def check(self, data, size):
+        if self.kind == 'file':
+            if self.size is None:
+                passed = size > 0 and size & (size - 1) == 0
+            elif self.operator == 'less':
+                passed = size < self.size
+            elif self.operator == 'greater':
+                passed = size > self.size
+            else:
+                passed = size == self.size
+            return passed == self.result
+        start = detector_resolve_offset(self.offset, size)
+        end = start + len(self.value)
+        if start < 0 or end > size or end > len(data): return False
+        if self.kind == 'data':
+            passed = data[start:end] == self.value
+        else:
+            number = int.from_bytes(data[start:end], 'big')
+            if self.kind == 'or':
+                passed = number | self.mask_int == self.value_int
+            elif self.kind == 'xor':
+                passed = number ^ self.mask_int == self.value_int
+            else:
+                passed = number & self.mask_int == self.value_int
+        return passed == self.result
+
+class DetectorRule:
+    __slots__ = ('start', 'end', 'operation', 'tests')
+
+    def __init__(self, start = (0, False), end = (0, True), operation = 'none', tests = None):
+        self.start = start
+        self.end = end
+        self.operation = operation
+        self.tests = tests if tests is not None else []
+
+    def get_key(self):
+        return (self.start, self.end, self.operation, tuple(test.get_key() for test in self.tests))
+
+class HeaderDetector:
+    def __init__(self, name, rules):
+        self.name = name
+        self.rules = rules
+        self.key = tuple(rule.get_key() for rule in rules)
+        # Bytes from the start of the file needed to check all the tests.
+        self.head_size = max([0] + [test.offset[0] + len(test.value)
+            for rule in rules for test in rule.tests if test.kind != 'file' and not test.offset[1]])
+        # Tests relative to the end of the file need the whole file.
+        self.needs_tail = any(test.kind != 'file' and test.offset[1]
+            for rule in rules for test in rule.tests)
+
+    # Reads the bytes of file_obj needed by match(), at least min_size bytes.
+    def read_head(self, file_obj, size, min_size = 0):
+        if self.needs_tail: return file_obj.read()
+
+        return file_obj.read(max(self.head_size, min_size))
+
+    # head_bytes are the first bytes of a file of size bytes, see read_head().
+    # Returns the block with the ROM data, a tuple (start, end, operation), or None if the
+    # file has no header.
+    def match(self, head_bytes, size):
+        for rule in self.rules:
+            if not all(test.check(head_bytes, size) for test in rule.tests): continue
+            start = detector_resolve_offset(rule.start, size)
+            end = detector_resolve_offset(rule.end, size)
+            # Blocks outside the file or not a multiple of the swapped unit are ignored.
+            if start < 0 or end > size or start > end: return None
+            if (end - start) % DETECTOR_OPERATIONS[rule.operation]: return None
+            if start == 0 and end == size and rule.operation == 'none': return None
+            return (start, end, rule.operation)
+
+        return None
+
+# Loads and compiles a clrmamepro header detector XML file.
+# Aborts if the file is not valid.
+def load_header_detector(detector_FN):
+    log_info('Loading header detector "{}"'.format(detector_FN.getOriginalPath()))
+    try:
+        xml_root = xml.etree.ElementTree.parse(detector_FN.getPath()).getroot()
+        name = xml_root.findtext('name', '').strip()
+        rules = []
+        for rule_element in xml_root.iter('rule'):
+            operation = rule_element.attrib.get('operation', 'none')
+            if operation not in DETECTOR_OPERATIONS:
+                raise ValueError('Unknown operation "{}"'.format(operation))
+            rule = DetectorRule(
+                detector_parse_offset(rule_element.attrib.get('start_offset', '0')),
+                detector_parse_offset(rule_element.attrib.get('end_offset', 'EOF')),
+                operation)
+            for test_element in rule_element:
+                attrib = test_element.attrib
+                result = attrib.get('result', 'true').lower() == 'true'
+                if test_element.tag == 'file':
+                    size_text = attrib['size']
+                    operator = attrib.get('operator', 'equal')
+                    if operator not in ('equal', 'less', 'greater'):
+                        raise ValueError('Unknown operator "{}"'.format(operator))
+                    size = None if size_text.upper() == 'PO2' else int(size_text, 16)
+                    test = DetectorTest('file', result = result, operator = operator, size = size)
+                elif test_element.tag in ('data', 'or', 'xor', 'and'):
+                    value = bytes.fromhex(attrib['value'])
+                    mask = bytes.fromhex(attrib['mask']) if test_element.tag != 'data' else b''
+                    if not value or (test_element.tag != 'data' and len(mask) != len(value)):
+                        raise ValueError('Bad value or mask in <{}> test'.format(test_element.tag))
+                    test = DetectorTest(test_element.tag,
+                        detector_parse_offset(attrib.get('offset', '0')), value, mask, result)
+                else:
+                    raise ValueError('Unknown test <{}>'.format(test_element.tag))
+                rule.tests.append(test)
+            rules.append(rule)
+    except (OSError, xml.etree.ElementTree.ParseError, KeyError, ValueError) as e:
+        log_error('Cannot load header detector "{}"'.format(detector_FN.getPath()))
+        log_error('{}: {}'.format(type(e).__name__, str(e)))
+        sys.exit(10)
+    if not rules:
+        log_error('Header detector "{}" has no rules'.format(detector_FN.getPath()))
+        sys.exit(10)
+    log_debug('Header detector "{}" has {} rules', name, len(rules))
+
+    return HeaderDetector(name, rules)
+
+# Converts the collection <HeaderOffset> and <HeaderRule> into a detector with one rule.
+# HeaderOffset and the rule offsets are decimal.
+def new_header_rules_detector(headerOffset, headerRules):
+    tests = [DetectorTest('data', (rule['offset'], False), bytes.fromhex(rule['value']))
+        for rule in headerRules]
+
+    return HeaderDetector('HeaderOffset {}'.format(headerOffset),
+        [DetectorRule((headerOffset, False), (0, True), 'none', tests)])
+
+# Returns the compiled header detector of a collection or None if its ROMs have no header.
+def get_collection_detector(collection_conf):
+    if collection_conf['HeaderDetector']:
+        return load_header_detector(FileName(collection_conf['HeaderDetector']))
+    if collection_conf['HeaderOffset'] > 0:
+        return new_header_rules_detector(collection_conf['HeaderOffset'], collection_conf['HeaderRules'])
+
+    return None
+
 # --- DAT file functions -------------------------------------------------------------------------
+# DAT sets and ROMs use __slots__ to keep memory usage low with big DATs.
+class DATset:
+    __slots__ = ('name', 'cloneof', 'description', 'ROMs')
+
+    def __init__(self, name = '', cloneof = '', description = '', ROMs = None):
+        self.name = name
+        self.cloneof = cloneof
+        self.description = description
+        self.ROMs = ROMs if ROMs is not None else []
+
+class DATrom:
+    __slots__ = ('name', 'size', 'crc', 'md5', 'sha1')
+
+    def __init__(self, name = '', size = 0, crc = '', md5 = '', sha1 = ''):
+        self.name = name
+        self.size = size
+        self.crc = crc
+        self.md5 = md5
+        self.sha1 = sha1
+
 class DATfile:
+    # ROMs in the indices are referenced with an integer, (set index << ROM_REF_BITS) | ROM index.
+    ROM_REF_BITS = 16
+    ROM_REF_MASK = (1 << ROM_REF_BITS) - 1
+
     def __init__(self):
-        # Key is crc, value is a tuple (a, b) a is the set index, b is the ROM index.
+        # Key is the hash, value is a posting list, a tuple of ROM references of all the ROMs
+        # with that hash. Real DATs have ROMs shared between sets and CRC collisions.
         self.crc_index = {}
         self.md5_index = {}
         self.sha1_index = {}
-        self.sets = []
-
-    def new_set(self):
-        return {
-            'name' : '',
-            'cloneof' : '',
-            'description' : '',
-            'ROMs' : [],
-        }
-
-    def new_rom(self):
-        return {
-            'name' : '',
-            'size' : 0,
-            'crc' : '',
-            'md5' : '',
-            'sha1' : '',
-        }
+        # Key is a tuple (crc, size). Used to find ROMs when only the CRC is known.
+        self.crc_size_index = {}
+        self.sets = [] # List of DATset objects.
+        # Identity of the XML file, see get_DAT_file_identity(). Set by load_XML_DAT_file().
+        self.file_id = None
+        self.ROM_extensions = None # See get_ROM_extensions().
+
+    def new_set(self): return DATset()
+
+    def new_rom(self): return DATrom()
+
+    # Sets and ROMs are pickled as plain tuples, which is much faster to pickle and unpickle
+    # than the __slots__ objects. Used by the compiled DAT cache.
+    def __getstate__(self):
+        sets = [(set.name, set.cloneof, set.description,
+            tuple((ROM.name, ROM.size, ROM.crc, ROM.md5, ROM.sha1) for ROM in set.ROMs))
+            for set in self.sets]
+        return (sets, self.crc_index, self.md5_index, self.sha1_index, self.crc_size_index)
+
+    def __setstate__(self, state):
+        sets, self.crc_index, self.md5_index, self.sha1_index, self.crc_size_index = state
+        self.file_id = None
+        self.ROM_extensions = None
+        self.sets = [DATset(name, cloneof, description, [DATrom(*ROM) for ROM in ROMs])
+            for name, cloneof, description, ROMs in sets]
 
     def num_sets(self): return len(self.sets)
 
     def num_ROMs(self):
         num_ROMs = 0
         for set in self.sets:
-            for ROM in set['ROMs']:
-                num_ROMs += 1
+            num_ROMs += len(set.ROMs)
         return num_ROMs
 
+    # Returns a frozenset with the extensions of the ROM names in lowercase, for example
+    # {'.nes'}. Files in ROM_dir with these extensions are loose ROMs, see is_loose_ROM_file().
+    def get_ROM_extensions(self):
+        if self.ROM_extensions is None:
+            self.ROM_extensions = get_ROM_name_extensions(
+                ROM.name for set in self.sets for ROM in set.ROMs)
+
+        return self.ROM_extensions
+
+    # ROMs with no hash in the DAT (for example, MAME nodump ROMs) are not indexed.
+    # Raises ValueError if a set has more ROMs than a ROM reference can address, see
+    # parse_XML_DAT_file().
     def create_indices(self):
+        crc_index = {}
+        md5_index = {}
+        sha1_index = {}
+        crc_size_index = {}
         for i, set in enumerate(self.sets):
-            for j, ROM in enumerate(set['ROMs']):
-                if ROM['crc'] in self.crc_index:
-                    log_error('In set {} ROM {}'.format(set['name'], ROM['name']))
-                    log_error('Duplicated CRC {}'.format(ROM['crc']))
-                    sys.exit(2)
-                if ROM['md5'] in self.md5_index:
-                    log_error('In set {} ROM {}'.format(set['name'], ROM['name']))
-                    log_error('Duplicated MD5 {}'.format(ROM['md5']))
-                    sys.exit(2)
-                if ROM['sha1'] in self.sha1_index:
-                    log_error('In set {} ROM {}'.format(set['name'], ROM['name']))
-                    log_error('Duplicated SHA1 {}'.format(ROM['sha1']))
-                    sys.exit(2)
-                self.crc_index[ROM['crc']] = (i, j)
-                self.md5_index[ROM['md5']] = (i, j)
-                self.sha1_index[ROM['sha1']] = (i, j)
+            # A ROM index that does not fit in ROM_REF_BITS would reference a ROM of another set.
+            if len(set.ROMs) > DATfile.ROM_REF_MASK + 1:
+                raise ValueError('Set "{}" has {:,} ROMs, the maximum is {:,}'.format(
+                    set.name, len(set.ROMs), DATfile.ROM_REF_MASK + 1))
+            for j, ROM in enumerate(set.ROMs):
+                ref = (i << DATfile.ROM_REF_BITS) | j
+                if ROM.crc:
+                    crc_index.setdefault(ROM.crc, []).append(ref)
+                    crc_size_index.setdefault((ROM.crc, ROM.size), []).append(ref)
+                if ROM.md5: md5_index.setdefault(ROM.md5, []).append(ref)
+                if ROM.sha1: sha1_index.setdefault(ROM.sha1, []).append(ref)
+        # Posting lists are stored as tuples to save memory.
+        self.crc_index = {k : tuple(v) for k, v in crc_index.items()}
+        self.md5_index = {k : tuple(v) for k, v in md5_index.items()}
+        self.sha1_index = {k : tuple(v) for k, v in sha1_index.items()}
+        self.crc_size_index = {k : tuple(v) for k, v in crc_size_index.items()}
+        num_dup_crc = sum(1 for v in self.crc_size_index.values() if len(v) > 1)
+        num_dup_sha1 = sum(1 for v in self.sha1_index.values() if len(v) > 1)
+        if num_dup_crc or num_dup_sha1:
+            log_verb('DAT has {:,} duplicated CRC+size and {:,} duplicated SHA1'.format(
+                num_dup_crc, num_dup_sha1))
+
+    # Returns a tuple (DATset, DATrom) from a ROM reference.
+    def get_ROM_ref(self, ref):
+        set = self.sets[ref >> DATfile.ROM_REF_BITS]
+        return (set, set.ROMs[ref & DATfile.ROM_REF_MASK])
 
     def ROM_CRC_exists(self, crc):
         return crc in self.crc_index
 
-    def ROM_SHA1_exists(self, crc):
-        return crc in self.sha1_index
+    def ROM_MD5_exists(self, md5):
+        return md5 in self.md5_index
 
+    def ROM_SHA1_exists(self, sha1):
+        return sha1 in self.sha1_index
+
+    # The get_ROM_*() functions return the first ROM with the hash.
     def get_ROM_CRC(self, crc):
-        set_idx, rom_idx = self.crc_index[crc]
-        return self.sets[set_idx]['ROMs'][rom_idx]
+        return self.get_ROM_ref(self.crc_index[crc][0])[1]
+
+    def get_ROM_MD5(self, md5):
+        return self.get_ROM_ref(self.md5_index[md5][0])[1]
+
+    def get_ROM_SHA1(self, sha1):
+        return self.get_ROM_ref(self.sha1_index[sha1][0])[1]
+
+    # Finds ROMs by SHA1, then by MD5, then by CRC and size, using the hashes available in
+    # checksums. DAT ROMs may not have all the hashes, so if nothing is found with a hash the
+    # next one is tried. A DAT ROM found with a weaker hash is rejected if one of its stronger
+    # hashes is different from the ROM one.
+    # Returns a list of tuples (DATset, DATrom), empty if not found.
+    def find_ROMs(self, checksums):
+        lookups = (
+            ('sha1', self.sha1_index, checksums['sha1']),
+            ('md5', self.md5_index, checksums['md5']),
+            ('crc', self.crc_size_index, (checksums['crc'], checksums['size'])),
+        )
+        stronger_hashes = []
+        for hash_name, index, key in lookups:
+            if checksums[hash_name]:
+                matches = [self.get_ROM_ref(ref) for ref in index.get(key, ())]
+                matches = [(datset, datrom) for datset, datrom in matches
+                    if not any(getattr(datrom, name) and getattr(datrom, name) != checksums[name]
+                        for name in stronger_hashes)]
+                if matches: return matches
+                stronger_hashes.append(hash_name)
+
+        return []
+
+    # Finds a ROM like find_ROMs().
+    # Returns the first DAT ROM or None if not found.
+    def find_ROM(self, checksums):
+        matches = self.find_ROMs(checksums)
+        return matches[0][1] if matches else None
+
+# Exceptions raised by parse_XML_DAT_file() if the DAT file is not valid.
+DAT_PARSE_ERRORS = (xml.etree.ElementTree.ParseError, OSError, KeyError, ValueError)
+
+# Parses a No-Intro XML DAT file. DTD "http://www.logiqx.com/Dats/datafile.dtd"
+# The XML file is parsed incrementally with iterparse() and every <game> element is
+# discarded after processing, so the full XML tree is never in memory.
+# MAME XML <machine> elements are also supported.
+# Raises one of DAT_PARSE_ERRORS if the file is not valid, callers decide if that is fatal.
+# Returns a DATfile class with the indices created.
+def parse_XML_DAT_file(xml_FN):
+    DAT = DATfile()
+    context = xml.etree.ElementTree.iterparse(xml_FN.getPath(), events = ('start', 'end'))
+    event, xml_root = next(context)
+    for event, root_element in context:
+        if event != 'end' or root_element.tag not in ('game', 'machine'): continue
+        set = DATset()
+        # Process attributes
+        set.name = root_element.attrib['name']
+        if 'cloneof' in root_element.attrib:
+            set.cloneof = root_element.attrib['cloneof']
+        # Process subtags.
+        for child in root_element:
+            if child.tag == 'description':
+                set.description = child.text
+            elif child.tag == 'rom':
+                ROM = DATrom()
+                ROM.name = child.attrib['name']
+                ROM.size = int(child.attrib.get('size', 0))
+                # Store hash strings as uppercase always.
+                ROM.crc = child.attrib.get('crc', '').upper()
+                ROM.md5 = child.attrib.get('md5', '').upper()
+                ROM.sha1 = child.attrib.get('sha1', '').upper()
+                set.ROMs.append(ROM)
+        # Add to data object.
+        DAT.sets.append(set)
+        # Free the memory used by the processed elements.
+        xml_root.clear()
+
+    # Create indices for fast ROM data access.
+    DAT.create_indices()
+
+    return DAT
 
-# Loads a No-Intro XML DAT file. DTD "http://www.logiqx.com/Dats/datafile.dtd"
-# Checks that there are no duplicate CRCs in the DAT file, aborts if so.
+# Loads a No-Intro XML DAT file, see parse_XML_DAT_file().
+# If cache_FN is not None the compiled DAT cache is used, see load_DAT_cache().
+# Aborts if the DAT file does not exist or is not valid.
 # Returns a DATfile class.
-def load_XML_DAT_file(xml_FN):
+def load_XML_DAT_file(xml_FN, cache_FN = None):
     if not xml_FN.exists():
         log_error('Does not exist "{0}"'.format(xml_FN.getPath()))
         sys.exit(10)
 
-    # Parse using ElementTree
+    # Use the compiled DAT if up to date.
+    if cache_FN is not None:
+        DAT = load_DAT_cache(xml_FN, cache_FN)
+        if DAT is not None:
+            log_info('DAT Sets {:,} / ROMs {:,}'.format(DAT.num_sets(), DAT.num_ROMs()))
+            return DAT
+
     log_info('Loading XML "{0}"'.format(xml_FN.getOriginalPath()))
     try:
-        xml_tree = xml.etree.ElementTree.parse(xml_FN.getPath())
+        DAT = parse_XML_DAT_file(xml_FN)
+    except DAT_PARSE_ERRORS as e:
+        log_error('Cannot load XML DAT file "{}"'.format(xml_FN.getPath()))
+        log_error('({}) {}'.format(type(e).__name__, str(e)))
+        sys.exit(10)
+
+    # Print statistics
+    log_info('DAT Sets {:,} / ROMs {:,}'.format(DAT.num_sets(), DAT.num_ROMs()))
+    DAT.file_id = get_DAT_file_identity(xml_FN)
+
+    # Save compiled DAT for next time.
+    if cache_FN is not None:
+        save_DAT_cache(xml_FN, cache_FN, DAT)
+
+    return DAT
+
+# --- Compiled DAT cache ---
+# The compiled DAT file has two pickles: a small header with the identity of the XML DAT and
+# the DATfile object itself, including the indices. The header is checked before the
+# DATfile is loaded. The cache is valid if the XML file size and modification time did not
+# change. If the modification time changed but the SHA1 of the XML file is the same the cache
+# is also valid.
+DAT_CACHE_VERSION = 2
+
+def get_DAT_file_identity(xml_FN, compute_SHA1 = True):
+    st = xml_FN.stat()
+    DAT_id = {
+        'version' : DAT_CACHE_VERSION,
+        'name' : xml_FN.getBase(),
+        'size' : st.st_size,
+        'mtime_ns' : st.st_mtime_ns,
+        'sha1' : '',
+    }
+    if compute_SHA1:
+        with open(xml_FN.getPath(), 'rb') as f:
+            DAT_id['sha1'] = misc_calculate_stream_checksums(f, hashes = ('sha1',))['sha1']
+
+    return DAT_id
+
+# Returns a DATfile object or None if the cache does not exist or is not up to date.
+def load_DAT_cache(xml_FN, cache_FN):
+    if not cache_FN.exists(): return None
+    try:
+        with open(cache_FN.getPath(), 'rb') as f:
+            header = pickle.load(f)
+            if header['version'] != DAT_CACHE_VERSION:
+                log_info('Compiled DAT version changed.')
+                return None
+            DAT_id = get_DAT_file_identity(xml_FN, False)
+            if header['size'] != DAT_id['size']:
+                log_info('DAT file changed.')
+                return None
+            save_header = False
+            if header['mtime_ns'] != DAT_id['mtime_ns']:
+                DAT_id = get_DAT_file_identity(xml_FN)
+                if header['sha1'] != DAT_id['sha1']:
+                    log_info('DAT file changed.')
+                    return None
+                # DAT file touched but not modified. Update header after loading.
+                save_header = True
+            log_info('Loading compiled DAT "{}"'.format(cache_FN.getPath()))
+            DAT = pickle.load(f)
+            DAT.file_id = DAT_id if save_header else header
+    except (OSError, EOFError, KeyError, pickle.UnpicklingError) as e:
+        log_warn('Cannot load compiled DAT. Ignoring it.')
+        log_warn('{}'.format(str(e)))
+        return None
+    if save_header:
+        save_DAT_cache(xml_FN, cache_FN, DAT)
+
+    return DAT
+
+def save_DAT_cache(xml_FN, cache_FN, DAT):
+    log_info('Saving compiled DAT "{}"'.format(cache_FN.getPath()))
+    FileName(cache_FN.getDir()).makedirs()
+    header = DAT.file_id
+    # Collections sharing a DAT may be scanned at the same time, see command_scanall().
+    temp_fname = '{}.{}.tmp'.format(cache_FN.getPath(), threading.get_ident())
+    with open(temp_fname, 'wb') as f:
+        pickle.dump(header, f, pickle.HIGHEST_PROTOCOL)
+        pickle.dump(DAT, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_fname, cache_FN.getPath())
+
+# --- DAT selector -------------------------------------------------------------------------------
+# No-Intro DAT file names end with the date of the DAT, for example
+# "Sega - Mega Drive - Genesis (20191120-213041).dat".
+# Returns a tuple (system, date). date is an empty string if the name has no date.
+def get_DAT_system_and_date(DAT_name):
+    m = re.match(r'^(.*) \((\d{8}-\d{6})\)\.[^.]*$', DAT_name)
+    if m is None: return (os.path.splitext(DAT_name)[0], '')
+
+    return (m.group(1), m.group(2))
+
+# Index of the ROMs of all the DAT files in a directory, used to find the DAT of a ROM_dir.
+# The key of the index is the tuple (CRC, size) and the value is a tuple with the positions
+# in DAT_list of the DATs that have a ROM with that CRC and size.
+# The keys and the ROM extensions of each DAT are cached in cache_FN, so only new or modified
+# DATs are parsed.
+class DATIndex:
+    CACHE_VERSION = 2
+
+    def __init__(self, DAT_dir_FN, cache_FN):
+        self.DAT_dir_FN = DAT_dir_FN
+        self.cache_FN = cache_FN
+        # List of dictionaries with keys name, size, mtime_ns, num_ROMs, keys and extensions.
+        self.DAT_list = []
+        self.index = {}
+
+    def _load_cache(self):
+        if not self.cache_FN.exists(): return {}
+        try:
+            with open(self.cache_FN.getPath(), 'rb') as f:
+                cache_data = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError) as e:
+            log_warn('Cannot load DAT index "{}". Ignoring it.'.format(self.cache_FN.getPath()))
+            return {}
+        if cache_data['version'] != DATIndex.CACHE_VERSION or \
+            cache_data['DAT_dir'] != self.DAT_dir_FN.getPath():
+            return {}
+
+        return {DAT_entry['name'] : DAT_entry for DAT_entry in cache_data['DAT_list']}
+
+    def _save_cache(self):
+        log_info('Saving DAT index "{}"'.format(self.cache_FN.getPath()))
+        FileName(self.cache_FN.getDir()).makedirs()
+        cache_data = {
+            'version' : DATIndex.CACHE_VERSION,
+            'DAT_dir' : self.DAT_dir_FN.getPath(),
+            'DAT_list' : self.DAT_list,
+        }
+        temp_fname = self.cache_FN.getPath() + '.tmp'
+        with open(temp_fname, 'wb') as f:
+            pickle.dump(cache_data, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_fname, self.cache_FN.getPath())
+
+    def build(self):
+        if not self.DAT_dir_FN.isdir():
+            log_error('DAT directory does not exist "{}"'.format(self.DAT_dir_FN.getPath()))
+            sys.exit(10)
+        cached_DATs = self._load_cache()
+        num_parsed = 0
+        for filename in sorted(self.DAT_dir_FN.scanFilesInPath('*.dat')):
+            st = os.stat(filename)
+            name = os.path.basename(filename)
+            DAT_entry = cached_DATs.get(name)
+            if DAT_entry is None or DAT_entry['size'] != st.st_size or DAT_entry['mtime_ns'] != st.st_mtime_ns:
+                # A bad DAT must not stop the search in the other DATs.
+                log_info('Loading XML "{0}"'.format(filename))
+                try:
+                    DAT = parse_XML_DAT_file(FileName(filename))
+                except DAT_PARSE_ERRORS as e:
+                    log_warn('Cannot load XML DAT file "{}". Skipping it.'.format(filename))
+                    log_warn('({}) {}'.format(type(e).__name__, str(e)))
+                    continue
+                DAT_entry = {
+                    'name' : name,
+                    'size' : st.st_size,
+                    'mtime_ns' : st.st_mtime_ns,
+                    'num_ROMs' : DAT.num_ROMs(),
+                    'keys' : tuple(DAT.crc_size_index),
+                    'extensions' : DAT.get_ROM_extensions(),
+                }
+                num_parsed += 1
+            self.DAT_list.append(DAT_entry)
+        log_info('DAT index has {:,} DATs, {:,} parsed'.format(len(self.DAT_list), num_parsed))
+        if num_parsed or len(self.DAT_list) != len(cached_DATs): self._save_cache()
+
+        index = {}
+        for i, DAT_entry in enumerate(self.DAT_list):
+            for key in DAT_entry['keys']:
+                index.setdefault(key, []).append(i)
+        self.index = {k : tuple(v) for k, v in index.items()}
+
+    # Returns a frozenset with the ROM extensions of all the DATs, see DATfile.get_ROM_extensions().
+    def get_ROM_extensions(self):
+        return frozenset().union(*(DAT_entry['extensions'] for DAT_entry in self.DAT_list))
+
+    # Counts the keys found in each DAT. Returns a list with a counter for each DAT in DAT_list.
+    def count_matches(self, key_list):
+        counters = [0] * len(self.DAT_list)
+        for key in key_list:
+            for i in self.index.get(key, ()):
+                counters[i] += 1
+
+        return counters
+
+# Returns the (CRC, size) keys of a random sample of sample_size files in the ROM_dir of a
+# collection, see DATIndex. The CRC in the ZIP central directory is used unless the ROM
+# has a header. ZIP files without exactly one ROM are not included.
+# loose_extensions are the extensions of the loose ROMs, see is_loose_ROM_file().
+def sample_collection_keys(collection, sample_size, loose_extensions):
+    file_list = collection.get_file_list()
+    if len(file_list) > sample_size:
+        sample_list = random.sample(file_list, sample_size)
+    else:
+        sample_list = list(file_list)
+    key_list = []
+    for filename in sample_list:
+        file_info = get_ROM_file_info(filename, collection.header_detector, True, ('crc',),
+            loose_extensions = loose_extensions)
+        if file_info['zfilename'] is None: continue
+        key_list.append((file_info['checksums']['crc'], file_info['checksums']['size']))
+
+    return key_list
+
+# --- MAME DAT functions --------------------------------------------------------------------------
+# MAME sets have many ROMs, some of them shared with the parent set or with the BIOS set.
+# In MAME DATs the ROMs shared with the parent or the BIOS have the merge attribute, the name
+# of the ROM in the parent or BIOS set.
+MAME_SET_TYPES = ('merged', 'split', 'nonmerged')
+
+class MAMEset:
+    __slots__ = ('name', 'cloneof', 'romof', 'description', 'isbios', 'isdevice', 'ROMs')
+
+    def __init__(self, name = '', cloneof = '', romof = '', description = '',
+        isbios = False, isdevice = False, ROMs = None):
+        self.name = name
+        self.cloneof = cloneof
+        self.romof = romof
+        self.description = description
+        self.isbios = isbios
+        self.isdevice = isdevice
+        self.ROMs = ROMs if ROMs is not None else []
+
+class MAMErom:
+    __slots__ = ('name', 'merge', 'size', 'crc', 'sha1')
+
+    def __init__(self, name = '', merge = '', size = 0, crc = '', sha1 = ''):
+        self.name = name
+        self.merge = merge
+        self.size = size
+        self.crc = crc
+        self.sha1 = sha1
+
+class MAMEDATfile:
+    def __init__(self):
+        self.sets = [] # List of MAMEset objects.
+        self.set_index = {} # Key is the set name, value the MAMEset object.
+        # Identity of the XML file, see get_DAT_file_identity().
+        self.file_id = None
+
+    # Pickled as plain tuples like DATfile. Used by the compiled DAT cache.
+    def __getstate__(self):
+        return ([(machine.name, machine.cloneof, machine.romof, machine.description,
+            machine.isbios, machine.isdevice,
+            tuple((ROM.name, ROM.merge, ROM.size, ROM.crc, ROM.sha1) for ROM in machine.ROMs))
+            for machine in self.sets],)
+
+    def __setstate__(self, state):
+        self.sets = [MAMEset(name, cloneof, romof, description, isbios, isdevice,
+            [MAMErom(*ROM) for ROM in ROMs])
+            for name, cloneof, romof, description, isbios, isdevice, ROMs in state[0]]
+        self.file_id = None
+        self.create_indices()
+
+    def num_sets(self): return len(self.sets)
+
+    def num_ROMs(self):
+        return sum(len(machine.ROMs) for machine in self.sets)
+
+    def create_indices(self):
+        self.set_index = {machine.name : machine for machine in self.sets}
+
+# Loads a MAME XML DAT, the output of mame -listxml or a Logiqx XML DAT for MAME.
+# Machines without ROMs and nodump ROMs, which have no CRC, are not loaded.
+# If cache_FN is not None the compiled DAT cache is used, see load_DAT_cache().
+# Returns a MAMEDATfile object.
+def load_MAME_XML_DAT_file(xml_FN, cache_FN = None):
+    if not xml_FN.exists():
+        log_error('Does not exist "{0}"'.format(xml_FN.getPath()))
+        sys.exit(10)
+    if cache_FN is not None:
+        DAT = load_DAT_cache(xml_FN, cache_FN)
+        if DAT is not None:
+            log_info('MAME DAT Sets {:,} / ROMs {:,}'.format(DAT.num_sets(), DAT.num_ROMs()))
+            return DAT
+
+    log_info('Loading MAME XML "{0}"'.format(xml_FN.getOriginalPath()))
+    DAT = MAMEDATfile()
+    try:
+        context = xml.etree.ElementTree.iterparse(xml_FN.getPath(), events = ('start', 'end'))
+        event, xml_root = next(context)
+        for event, root_element in context:
+            if event != 'end' or root_element.tag not in ('game', 'machine'): continue
+            attrib = root_element.attrib
+            machine = MAMEset(attrib['name'], attrib.get('cloneof', ''), attrib.get('romof', ''),
+                '', attrib.get('isbios', 'no') == 'yes', attrib.get('isdevice', 'no') == 'yes')
+            for child in root_element:
+                if child.tag == 'description':
+                    machine.description = child.text
+                elif child.tag == 'rom':
+                    if child.attrib.get('status', '') == 'nodump' or 'crc' not in child.attrib: continue
+                    machine.ROMs.append(MAMErom(child.attrib['name'], child.attrib.get('merge', ''),
+                        int(child.attrib.get('size', 0)), child.attrib['crc'].upper(),
+                        child.attrib.get('sha1', '').upper()))
+            if machine.ROMs: DAT.sets.append(machine)
+            xml_root.clear()
     except xml.etree.ElementTree.ParseError as e:
-        log_error('(ParseError) Exception parsing XML categories.xml')
+        log_error('(ParseError) Exception parsing XML DAT file')
         log_error('(ParseError) {0}'.format(str(e)))
         sys.exit(10)
     except IOError as e:
         log_error('(IOError) {0}'.format(str(e)))
         sys.exit(10)
+    DAT.create_indices()
+    log_info('MAME DAT Sets {:,} / ROMs {:,}'.format(DAT.num_sets(), DAT.num_ROMs()))
+    DAT.file_id = get_DAT_file_identity(xml_FN)
+    if cache_FN is not None:
+        save_DAT_cache(xml_FN, cache_FN, DAT)
 
-    # Process DAT contents
-    DAT = DATfile()
-    for root_element in xml_tree.getroot():
-        if root_element.tag != 'game': continue
-        set = DAT.new_set()
-        # Process attributes
-        set['name'] = root_element.attrib['name']
-        if 'cloneof' in root_element.attrib:
-            set['cloneof'] = root_element.attrib['cloneof']
-        # Process subtags.
-        for child in root_element:
-            if child.tag == 'description':
-                set['description'] = child.text
-            elif child.tag == 'rom':
-                ROM = DAT.new_rom()
-                ROM['name'] = child.attrib['name']
-                ROM['size'] = int(child.attrib['size'])
-                # Store hash strings as lowercase always.
-                ROM['crc'] = child.attrib['crc'].upper()
-                ROM['md5'] = child.attrib['md5'].upper()
-                ROM['sha1'] = child.attrib['sha1'].upper()
-                set['ROMs'].append(ROM)
-        # Add to data object.
-        DAT.sets.append(set)
+    return DAT
 
-    # Create indices for fast ROM data access.
-    DAT.create_indices()
+# Returns the ROMs of the BIOS of a machine as a set of tuples (name, CRC). The BIOS is found
+# following the romof attributes, for clones romof is the parent and then the BIOS.
+def MAME_get_BIOS_keys(DAT, machine):
+    for i in range(8):
+        if not machine.romof or machine.romof not in DAT.set_index: break
+        machine = DAT.set_index[machine.romof]
+        if machine.isbios:
+            return {(ROM.name, ROM.crc) for ROM in machine.ROMs}
+
+    return set()
+
+# Returns the list of ZIP files of a MAME collection, a list of tuples (set name, ROMs) in
+# DAT order. ROMs is a list of MAMErom objects.
+# BIOS ROMs are only in the ZIP file of the BIOS set and device ROMs only in the ZIP file of
+# the device, in all set types.
+#   nonmerged  ZIP files of clones have the parent ROMs.
+#   split      ZIP files of clones only have the ROMs not in the parent.
+#   merged     Clones are in the ZIP file of the parent. There are no clone ZIP files.
+def MAME_build_set_list(DAT, set_type):
+    own_ROMs = {}
+    all_ROMs = {}
+    for machine in DAT.sets:
+        BIOS_keys = set() if machine.isbios else MAME_get_BIOS_keys(DAT, machine)
+        parent = DAT.set_index.get(machine.cloneof) if machine.cloneof else None
+        parent_keys = {(ROM.name, ROM.crc) for ROM in parent.ROMs} if parent else set()
+        own_list = []
+        all_list = []
+        names = set()
+        for ROM in machine.ROMs:
+            # Some machines load the same ROM in several regions.
+            if ROM.name in names: continue
+            names.add(ROM.name)
+            if ROM.merge and (ROM.merge, ROM.crc) in BIOS_keys: continue
+            all_list.append(ROM)
+            if not (ROM.merge and (ROM.merge, ROM.crc) in parent_keys): own_list.append(ROM)
+        own_ROMs[machine.name] = own_list
+        all_ROMs[machine.name] = all_list
+
+    if set_type == 'nonmerged':
+        set_list = [(machine.name, all_ROMs[machine.name]) for machine in DAT.sets]
+    elif set_type == 'split':
+        set_list = [(machine.name, own_ROMs[machine.name]) for machine in DAT.sets]
+    elif set_type == 'merged':
+        clones = {}
+        for machine in DAT.sets:
+            if machine.cloneof and machine.cloneof in DAT.set_index:
+                clones.setdefault(machine.cloneof, []).append(machine.name)
+        set_list = []
+        for machine in DAT.sets:
+            if machine.cloneof and machine.cloneof in DAT.set_index: continue
+            ROM_list = list(own_ROMs[machine.name])
+            names = {ROM.name : ROM.crc for ROM in ROM_list}
+            for clone_name in clones.get(machine.name, []):
+                for ROM in own_ROMs[clone_name]:
+                    if ROM.name in names:
+                        if names[ROM.name] != ROM.crc:
+                            log_debug('Merged set {} ROM {} name conflict', machine.name, ROM.name)
+                        continue
+                    names[ROM.name] = ROM.crc
+                    ROM_list.append(ROM)
+            set_list.append((machine.name, ROM_list))
+    else:
+        log_error('Unknown MAME set type "{}"'.format(set_type))
+        sys.exit(10)
 
-    # Print statistics
-    log_info('DAT Sets {:,} / ROMs {:,}'.format(DAT.num_sets(), DAT.num_ROMs()))
+    # Clones of split sets may have no ROMs of their own.
+    return [(name, ROM_list) for name, ROM_list in set_list if ROM_list]
+
+# --- Checksum cache -----------------------------------------------------------------------------
+# Persistent cache of the information returned by get_ROM_file_info(), stored in the data
+# directory. Entries are keyed by the file path and are valid while the file size and
+# modification time do not change, so rescans only decompress and hash new or modified files.
+# The cache is discarded if the header detector of the collection changes.
+# An entry is used only if it has all the hashes requested by the scanner. Entries computed in
+# quick mode are only used by quick scans.
+class ChecksumCache:
+    CACHE_VERSION = 5
+
+    def __init__(self, cache_FN, detector, quick = False, hashes = HASH_ALGORITHMS):
+        self.cache_FN = cache_FN
+        self.quick = quick
+        self.hashes = hashes
+        self.header_key = detector.key if detector is not None else None
+        # Key is the file path, value is a tuple (size, mtime_ns, file_info)
+        self.entries = {}
+        self.num_hits = 0
+        self.num_misses = 0
+
+    def load(self):
+        if not self.cache_FN.exists(): return
+        log_info('Loading checksum cache "{}"'.format(self.cache_FN.getPath()))
+        try:
+            with open(self.cache_FN.getPath(), 'rb') as f:
+                cache_data = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError) as e:
+            log_warn('Cannot load checksum cache. Ignoring it.')
+            log_warn('{}'.format(str(e)))
+            return
+        if cache_data['version'] != ChecksumCache.CACHE_VERSION:
+            log_info('Checksum cache version changed. Ignoring it.')
+            return
+        if cache_data['header_key'] != self.header_key:
+            log_info('Collection header settings changed. Ignoring checksum cache.')
+            return
+        self.entries = cache_data['entries']
+
+    def save(self):
+        log_info('Saving checksum cache "{}"'.format(self.cache_FN.getPath()))
+        FileName(self.cache_FN.getDir()).makedirs()
+        cache_data = {
+            'version' : ChecksumCache.CACHE_VERSION,
+            'header_key' : self.header_key,
+            'entries' : self.entries,
+        }
+        temp_fname = self.cache_FN.getPath() + '.tmp'
+        with open(temp_fname, 'wb') as f:
+            pickle.dump(cache_data, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_fname, self.cache_FN.getPath())
+
+    # st is the os.stat() result of filename. Returns None if file not in the cache or changed.
+    def get(self, filename, st):
+        entry = self.entries.get(filename)
+        if entry is None or entry[0] != st.st_size or entry[1] != st.st_mtime_ns:
+            self.num_misses += 1
+            return None
+        if entry[2]['quick'] and not self.quick:
+            self.num_misses += 1
+            return None
+        if entry[2]['zfilename'] is not None and not set(self.hashes) <= set(entry[2]['hashes']):
+            self.num_misses += 1
+            return None
+        self.num_hits += 1
+        return entry[2]
+
+    # Files that could not be read are not cached, see new_read_error_file_info().
+    def put(self, filename, st, file_info):
+        if file_info.get('read_error'):
+            self.entries.pop(filename, None)
+            return
+        self.entries[filename] = (st.st_size, st.st_mtime_ns, file_info)
+
+    # Returns True if filename was modified after it was hashed. If the file is not in the cache
+    # it is not known and False is returned.
+    def is_modified(self, filename, st):
+        entry = self.entries.get(filename)
+        if entry is None: return False
+
+        return entry[0] != st.st_size or entry[1] != st.st_mtime_ns
+
+    # Called after the set filename is renamed to new_filename and its ROM to zfilename.
+    # st is the os.stat() result of new_filename. The checksums of the ROM do not change.
+    def rename(self, filename, new_filename, st, zfilename):
+        entry = self.entries.pop(filename, None)
+        if entry is None or entry[2]['zfilename'] is None: return
+        file_info = dict(entry[2])
+        file_info['zfilename'] = zfilename
+        self.entries[new_filename] = (st.st_size, st.st_mtime_ns, file_info)
+
+    def remove(self, filename):
+        self.entries.pop(filename, None)
+
+    # Remove entries of files that no longer exist.
+    def prune(self, file_list):
+        file_set = set(file_list)
+        for filename in [f for f in self.entries if f not in file_set]:
+            del self.entries[filename]
+
+# --- Scanner metrics ----------------------------------------------------------------------------
+# Returns the peak resident set size of the process in MiB or None if not available. The
+# peak only grows, so it is the peak of everything done so far.
+def get_peak_RSS_MB():
+    if resource is None: return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KiB on Linux.
+    if sys.platform == 'darwin': return round(maxrss / (1024 * 1024), 1)
+
+    return round(maxrss / 1024, 1)
+
+# CPU time of the process and of its worker processes that have finished.
+def get_CPU_time():
+    t = os.times()
+
+    return t.user + t.system + t.children_user + t.children_system
+
+# Wraps a file object and measures the wall and CPU time spent in read(). Reading a ZIP
+# member is decompressing it. CPU time is the time of the calling thread.
+class TimedReader:
+    def __init__(self, file_obj):
+        self.file_obj = file_obj
+        self.read_time = 0.0
+        self.read_CPU_time = 0.0
+        self.num_bytes = 0
+
+    def read(self, size = -1):
+        start_time = time.perf_counter()
+        start_CPU_time = time.thread_time()
+        data = self.file_obj.read(size)
+        self.read_time += time.perf_counter() - start_time
+        self.read_CPU_time += time.thread_time() - start_CPU_time
+        self.num_bytes += len(data)
+
+        return data
+
+# Wall time, CPU time, files, bytes read and bytes decompressed of the phases of a scan, for
+# each collection. Phases done several times are added. Metrics can be updated from several
+# threads, see command_scanall().
+#
+# The phases of a scan overlap because files are hashed while the directory is read. The
+# inflate and hash phases are the sum of the time of all the threads or processes that
+# decompressed and hashed the files. The CPU time of the other phases is the CPU time of the
+# whole process.
+class Metrics:
+    def __init__(self):
+        self.phases = OrderedDict() # Key is (collection_name, phase_name).
+        self.lock = threading.Lock()
+
+    def add(self, collection_name, phase_name, wall_time = 0.0, CPU_time = 0.0, files = 0,
+        bytes_read = 0, bytes_decompressed = 0):
+        with self.lock:
+            phase = self.phases.get((collection_name, phase_name))
+            if phase is None:
+                phase = {
+                    'collection' : collection_name,
+                    'phase' : phase_name,
+                    'wall_time' : 0.0,
+                    'CPU_time' : 0.0,
+                    'files' : 0,
+                    'bytes_read' : 0,
+                    'bytes_decompressed' : 0,
+                    'peak_RSS_MB' : None,
+                }
+                self.phases[(collection_name, phase_name)] = phase
+            phase['wall_time'] += wall_time
+            phase['CPU_time'] += CPU_time
+            phase['files'] += files
+            phase['bytes_read'] += bytes_read
+            phase['bytes_decompressed'] += bytes_decompressed
+            phase['peak_RSS_MB'] = get_peak_RSS_MB()
+
+    # Measures the wall and CPU time of the code in the with block. The dictionary returned
+    # can be used to set files, bytes_read and bytes_decompressed.
+    @contextlib.contextmanager
+    def phase(self, collection_name, phase_name):
+        counters = {'files' : 0, 'bytes_read' : 0, 'bytes_decompressed' : 0}
+        start_time = time.perf_counter()
+        start_CPU_time = get_CPU_time()
+        yield counters
+        self.add(collection_name, phase_name, time.perf_counter() - start_time,
+            get_CPU_time() - start_CPU_time, **counters)
+
+    # Generator that returns the items of iterator and measures the time spent getting them.
+    def timed_iter(self, collection_name, phase_name, iterator):
+        wall_time = 0.0
+        num_items = 0
+        while True:
+            start_time = time.perf_counter()
+            item = next(iterator, None)
+            wall_time += time.perf_counter() - start_time
+            if item is None: break
+            num_items += 1
+            yield item
+        self.add(collection_name, phase_name, wall_time, files = num_items)
+
+    # Adds the file_info['stats'] of get_ROM_file_info() of a file of size bytes.
+    def add_file_stats(self, collection_name, size, stats):
+        self.add(collection_name, 'inflate', stats['inflate_time'], stats['inflate_CPU_time'],
+            files = 1, bytes_read = size, bytes_decompressed = stats['decompressed'])
+        self.add(collection_name, 'hash', stats['hash_time'], stats['hash_CPU_time'],
+            files = 1, bytes_decompressed = stats['decompressed'])
+
+    def get_phase_list(self):
+        phase_list = []
+        with self.lock:
+            for phase in self.phases.values():
+                phase = dict(phase)
+                wall_time = phase['wall_time']
+                num_bytes = phase['bytes_decompressed'] or phase['bytes_read']
+                phase['files_per_s'] = round(phase['files'] / wall_time, 1) \
+                    if wall_time > 0 and phase['files'] else None
+                phase['MB_per_s'] = round(num_bytes / wall_time / (1024 * 1024), 2) \
+                    if wall_time > 0 and num_bytes else None
+                phase['wall_time'] = round(wall_time, 4)
+                phase['CPU_time'] = round(phase['CPU_time'], 4)
+                phase_list.append(phase)
+
+        return phase_list
+
+    def print_report(self):
+        table_str = [
+            ['left'] * 10,
+            ['Collection', 'Phase', 'Wall s', 'CPU s', 'Files', 'Read MB', 'Decompressed MB',
+             'Files/s', 'MB/s', 'Peak RSS MB'],
+        ]
+        for phase in self.get_phase_list():
+            table_str.append([
+                phase['collection'], phase['phase'],
+                '{:.3f}'.format(phase['wall_time']), '{:.3f}'.format(phase['CPU_time']),
+                '{:,}'.format(phase['files']) if phase['files'] else '',
+                '{:,.1f}'.format(phase['bytes_read'] / (1024 * 1024)) if phase['bytes_read'] else '',
+                '{:,.1f}'.format(phase['bytes_decompressed'] / (1024 * 1024)) if phase['bytes_decompressed'] else '',
+                '{:,.0f}'.format(phase['files_per_s']) if phase['files_per_s'] else '',
+                '{:,.1f}'.format(phase['MB_per_s']) if phase['MB_per_s'] else '',
+                str(phase['peak_RSS_MB']),
+            ])
+        print('\n=== Scanner metrics ===')
+        for line in text_render_table(table_str): print(line)
+
+    # Appends the metrics to filename as a line of JSON, so the metrics of many scans can be
+    # kept in the same file.
+    def save_JSON(self, filename, command):
+        metrics_dic = {
+            'prm_version' : PRM_VERSION,
+            'command' : command,
+            'time' : time.strftime('%Y-%m-%d %H:%M:%S'),
+            'phases' : self.get_phase_list(),
+        }
+        with open(filename, 'a', encoding = 'utf-8') as f:
+            f.write(json.dumps(metrics_dic) + '\n')
 
-    return DAT
+# --- Scanner pipeline ---------------------------------------------------------------------------
+# Files larger than this are not read ahead, the hashing thread reads them block by block.
+PIPELINE_MAX_READ_AHEAD_SIZE = 64 * 1024 * 1024
+
+# Object put in the queues by a thread that has finished.
+PIPELINE_DONE = object()
+
+# Generator that computes the file information of the ScanEntry objects in entry_iter with a
+# pipeline of threads, so reading the disk overlaps with decompressing and hashing:
+#
+#  * A reader thread reads the directories, gets the unmodified files from the cache and
+#    reads the contents of the rest of the files ahead of the hashing threads.
+#  * num_threads hashing threads call get_ROM_file_info() on the bytes read. zlib and hashlib
+#    release the GIL so the threads run in parallel. Files larger than
+#    PIPELINE_MAX_READ_AHEAD_SIZE are not read ahead, the hashing threads read them or, if
+#    they are loose ROMs or STORED ZIP members, memory map them. Files that are not ZIP
+#    files nor loose ROMs are not read ahead either, they are Error sets.
+#  * The caller of the generator classifies the files.
+#
+# The reader is at most queue_depth files ahead of the hashing threads, and the hashing
+# threads at most queue_depth files ahead of the caller.
+# Yields tuples (entry, file_info, hashed) in completion order. hashed is False if file_info
+# was taken from the cache. Exceptions in the threads are raised in the caller.
+# measure and loose_extensions are passed to get_ROM_file_info().
+def scan_files_pipeline(entry_iter, cache, detector, quick, hashes,
+    num_threads = 1, queue_depth = 8, measure = False, loose_extensions = frozenset()):
+    read_queue = queue.Queue(queue_depth)
+    result_queue = queue.Queue(queue_depth)
+
+    def reader():
+        try:
+            for entry in entry_iter:
+                file_info = cache.get(entry.path, entry) if cache is not None else None
+                if file_info is not None:
+                    result_queue.put((entry, file_info, False))
+                    continue
+                data = None
+                read_ahead = entry.path.lower().endswith('.zip') or \
+                    is_loose_ROM_file(entry.path, loose_extensions)
+                if read_ahead and entry.st_size <= PIPELINE_MAX_READ_AHEAD_SIZE:
+                    # Files that cannot be read are Error sets, they are not hashed.
+                    try:
+                        with open(entry.path, 'rb') as file:
+                            data = file.read()
+                    except OSError as e:
+                        log_warn('Cannot read "{}": {}'.format(entry.path, str(e)))
+                        result_queue.put((entry, new_read_error_file_info(), True))
+                        continue
+                read_queue.put((entry, data))
+        except BaseException as e:
+            result_queue.put(e)
+        finally:
+            for i in range(num_threads): read_queue.put(PIPELINE_DONE)
+            result_queue.put(PIPELINE_DONE)
+
+    def hasher():
+        try:
+            while True:
+                item = read_queue.get()
+                if item is PIPELINE_DONE: break
+                entry, data = item
+                file_info = get_ROM_file_info(entry.path, detector, quick, hashes, data, measure,
+                    loose_extensions)
+                result_queue.put((entry, file_info, True))
+        except BaseException as e:
+            result_queue.put(e)
+        finally:
+            result_queue.put(PIPELINE_DONE)
+
+    thread_list = [threading.Thread(target = reader, daemon = True)]
+    thread_list.extend(threading.Thread(target = hasher, daemon = True) for i in range(num_threads))
+    for thread in thread_list: thread.start()
+    num_running = len(thread_list)
+    while num_running > 0:
+        item = result_queue.get()
+        if item is PIPELINE_DONE:
+            num_running -= 1
+        elif isinstance(item, BaseException):
+            raise item
+        else:
+            yield item
+    for thread in thread_list: thread.join()
 
 # Stores all sets in a ROM collection.
 class ROMcollection:
     def __init__(self, collection_conf):
         self.name = collection_conf['name'] # Collection <name>
-        self.headerOffset = collection_conf['HeaderOffset'] # Collection <HeaderOffsetBytes>
-        self.headerRules = collection_conf['HeaderRules']
+        # Compiled <HeaderDetector> or <HeaderOffset> and <HeaderRule>. None if no header.
+        self.header_detector = get_collection_detector(collection_conf)
         self.dirname = collection_conf['ROM_dir'] # <ROM_dir>
         self.num_DAT_sets = 0
+        self.DAT_name = '' # Filename and SHA1 of the DAT used in the last scan.
+        self.DAT_sha1 = ''
+        self.scan_time = 0.0 # Time of the last scan, seconds since the epoch.
         self.basename_index = {}
         self.sets = [] # List of ROMset objects. May have unknown ROM sets.
         self.file_list = [] # List of files in ROM_dir with full path name.
+        self.file_entries = iter(()) # Iterator of ScanEntry objects not read yet.
+        self.entry_list = [] # ScanEntry objects already read, same order as self.file_list.
+        self.all_files_read = False # True when self.file_list has all the files in ROM_dir.
 
-    # Scans files in self.dirname and fills self.file_list
+    # Prepares the scan of the files in self.dirname. Files are read lazily: process_files()
+    # hashes them while the directories are read. Use get_file_list() to read all of them.
     def scan_files_in_dir(self):
         ROM_dir_FN = FileName(self.dirname)
-        log_info('HeaderOffset {}'.format(self.headerOffset))
-        for rule in self.headerRules:
-            print('HeaderRule offset {} value {}'.format(rule['offset'], rule['value']))
+        if self.header_detector is not None:
+            log_info('Header detector "{}"'.format(self.header_detector.name))
         log_info('Scanning files in "{}"...'.format(ROM_dir_FN.getPath()))
         if not ROM_dir_FN.exists():
             log_error('Directory does not exist "{}"'.format(ROM_dir_FN.getPath()))
             sys.exit(10)
-        self.file_list = ROM_dir_FN.recursiveScanFilesInPath('*')
+        self.file_list = []
+        self.entry_list = []
+        self.all_files_read = False
+        self.file_entries = ROM_dir_FN.recursiveScanDirEntries(SCANNER_FILE_FILTER)
+
+    # Generator of the ScanEntry objects of ROM_dir. The entries already read are returned
+    # first, then the directories are read and the files added to self.file_list.
+    def iter_file_entries(self):
+        for i in range(len(self.entry_list)):
+            yield self.entry_list[i]
+        for entry in self.file_entries:
+            self.entry_list.append(entry)
+            self.file_list.append(entry.path)
+            yield entry
+        self.all_files_read = True
+
+    # Returns the list of files in ROM_dir, reading the rest of the directories if needed.
+    def get_file_list(self):
+        for entry in self.iter_file_entries(): pass
+
+        return self.file_list
+
+    # Generator like scan_files_pipeline() that hashes the files in the worker processes of pool.
+    # The files are read by the task thread of the pool, which only appends to the lists.
+    def scan_files_pool(self, entry_iter, pool, cache, quick, hashes, measure, loose_extensions):
+        entry_list = []
+        cached_list = []
+        def scan_files():
+            for entry in entry_iter:
+                file_info = cache.get(entry.path, entry) if cache is not None else None
+                if file_info is not None:
+                    cached_list.append((entry, file_info, False))
+                    continue
+                entry_list.append(entry)
+                yield entry.path
+
+        worker_fn = functools.partial(get_ROM_file_info, detector = self.header_detector,
+            quick = quick, hashes = hashes, measure = measure, loose_extensions = loose_extensions)
+        for i, file_info in enumerate(pool.imap(worker_fn, scan_files(), 4)):
+            yield (entry_list[i], file_info, True)
+        for item in cached_list: yield item
 
     # Fills self.sets and adds missing ROM sets.
-    def process_files(self, DAT):
+    # If num_jobs > 1 ZIP decompression and hashing is done in a pool of worker processes.
+    # Otherwise files are read ahead and hashed by num_threads threads, see
+    # scan_files_pipeline(). queue_depth is the number of files read ahead.
+    # Workers only compute checksums, the DAT lookup is always done in this process so the
+    # results are exactly the same as the serial scanner.
+    # If cache is a ChecksumCache object files not modified since the last scan are not opened.
+    # In quick mode the CRC in the ZIP central directory is used, see get_ZIP_file_info().
+    # hashes is the tuple of hash algorithms to compute, see HASH_ALGORITHMS.
+    # If pool is a multiprocessing.Pool it is used instead of creating one, so several
+    # collections can be scanned at the same time sharing the worker processes.
+    # If metrics is a Metrics object the phases of the scan are measured.
+    def process_files(self, DAT, num_jobs = 1, cache = None, quick = False, hashes = HASH_ALGORITHMS,
+        pool = None, show_progress = True, num_threads = 1, queue_depth = 8, metrics = None):
         self.num_DAT_sets = len(DAT.sets)
-
-        # Determine status of the ROM sets (aka ZIP files).
-        num_files = len(self.file_list)
-        file_count = 1
-        for filename in sorted(self.file_list):
-            set = get_ROM_set_status(filename, DAT, self.headerOffset, self.headerRules)
-            self.sets.append(set)
-            sys.stdout.write("\rProcessed file {} of {}... ".format(file_count, num_files))
-            sys.stdout.flush()
-            file_count += 1
-        sys.stdout.write("\r\n")
+        if DAT.file_id is not None:
+            self.DAT_name = DAT.file_id['name']
+            self.DAT_sha1 = DAT.file_id['sha1']
+        self.scan_time = time.time()
+
+        # Files are hashed while ROM_dir is read. The checksums of files not modified since the
+        # last scan are taken from the cache, using the stat result of the directory scanner.
+        # Only files with the extension of a DAT ROM are hashed as loose ROMs.
+        loose_extensions = DAT.get_ROM_extensions()
+        measure = metrics is not None
+        entry_iter = self.iter_file_entries()
+        if measure:
+            for phase_name in ('dir_walk', 'scan', 'inflate', 'hash', 'classify', 'missing_sort'):
+                metrics.add(self.name, phase_name)
+            entry_iter = metrics.timed_iter(self.name, 'dir_walk', entry_iter)
+            scan_start_time = time.perf_counter()
+            scan_start_CPU_time = get_CPU_time()
+            classify_time = 0.0
+            bytes_read = 0
+        own_pool = False
+        if pool is None and num_jobs > 1:
+            pool = multiprocessing.Pool(num_jobs, initializer = change_log_level, initargs = (log_level,))
+            own_pool = True
+        if pool is not None:
+            log_info('Scanning files with {} processes...'.format(num_jobs))
+            result_iter = self.scan_files_pool(entry_iter, pool, cache, quick, hashes, measure,
+                loose_extensions)
+        else:
+            log_debug('Scanning files with {} threads, queue depth {}', num_threads, queue_depth)
+            result_iter = scan_files_pipeline(entry_iter, cache, self.header_detector,
+                quick, hashes, num_threads, queue_depth, measure, loose_extensions)
+
+        # Classify the files as they are hashed.
+        set_list = []
+        num_files = 0
+        progress = ProgressReporter('Processed file') if show_progress else None
+        for entry, file_info, hashed in result_iter:
+            if hashed:
+                if measure:
+                    bytes_read += entry.st_size
+                    stats = file_info.pop('stats', None)
+                    if stats is not None: metrics.add_file_stats(self.name, entry.st_size, stats)
+                if cache is not None: cache.put(entry.path, entry, file_info)
+                num_files += 1
+            if progress is not None:
+                progress.update(1, entry.st_size if hashed else 0, len(self.file_list),
+                    self.all_files_read)
+            if measure: start_time = time.perf_counter()
+            rom_set = build_ROM_set(entry.path, file_info, DAT)
+            rom_set.set_file_stat(entry)
+            set_list.append(rom_set)
+            if measure: classify_time += time.perf_counter() - start_time
+        if progress is not None:
+            progress.finish()
+        else:
+            log_info('Processed {} files in "{}"', num_files, self.name)
+        if own_pool:
+            pool.close()
+            pool.join()
+        if cache is not None:
+            cache.prune(self.file_list)
+            log_info('Checksum cache hits {:,} / misses {:,}'.format(cache.num_hits, cache.num_misses))
+        if measure:
+            metrics.add(self.name, 'scan', time.perf_counter() - scan_start_time,
+                get_CPU_time() - scan_start_CPU_time, num_files, bytes_read)
+            metrics.add(self.name, 'classify', classify_time, files = len(set_list))
+            sort_start_time = time.perf_counter()
+            sort_start_CPU_time = get_CPU_time()
+
+        # Sets are sorted by filename so the order of the sets with the same basename does not
+        # depend on the order the files were read and hashed.
+        set_list.sort(key = lambda set: set.filename)
+        self.sets.extend(set_list)
 
         # Compute indices for fast access.
         for i, rom_set in enumerate(self.sets):
-            # log_debug('Index {:5d} Basename "{}"'.format(i, rom_set.basename))
+            # log_debug('Index {:5d} Basename "{}"', i, rom_set.basename)
             self.basename_index[rom_set.basename] = i
 
         # Add missing ROMs.
@@ -645,18 +2047,9 @@ class ROMcollection:
         log_info('Adding missing ROMs...')
         num_missing = 0
         for dat_set in DAT.sets:
-            # log_info('Set name "{}"'.format(dat_set['name']))
-            set_zip_basename = dat_set['name'] + '.zip'
-            if set_zip_basename not in self.basename_index:
-                set_filename = FileName(self.dirname).pjoin(set_zip_basename).getPath()
-                rom_set = ROMset(set_filename)
-                rom_set.status = ROMset.SET_STATUS_MISSING
-                rom = rom_set.new_rom()
-                rom['name'] = dat_set['ROMs'][0]['name']
-                rom['correct_name'] = dat_set['ROMs'][0]['name']
-                rom['status'] = ROMset.ROM_STATUS_MISSING
-                rom_set.rom_list.append(rom)
-                self.sets.append(rom_set)
+            # log_info('Set name "{}"'.format(dat_set.name))
+            if not any(basename in self.basename_index for basename in get_DAT_set_basenames(dat_set)):
+                self.sets.append(new_missing_ROM_set(self.dirname, dat_set))
                 num_missing += 1
         log_info('Added {} missing sets.'.format(num_missing))
 
@@ -669,8 +2062,11 @@ class ROMcollection:
 
         # Refresh indices after addition of missing ROMs.
         for i, rom_set in enumerate(self.sets):
-            # log_debug('Index {:5d} Basename "{}"'.format(i, rom_set.basename))
+            # log_debug('Index {:5d} Basename "{}"', i, rom_set.basename)
             self.basename_index[rom_set.basename] = i
+        if measure:
+            metrics.add(self.name, 'missing_sort', time.perf_counter() - sort_start_time,
+                get_CPU_time() - sort_start_CPU_time, files = len(self.sets))
 
 # ROMset is a ZIP file that contains ROMs.
 class ROMset:
@@ -683,11 +2079,14 @@ class ROMset:
     #   2. The set ZIP file is corrupted or any other error.
     #   3. The set ZIP file has 2 or more files or is empty.
     # * Only BADNAME sets are fixable at the moment.
+    # * MAME sets have many ROMs. A PARTIAL set has some ROMs missing. A MAME set is BADNAME
+    #   if it has all the ROMs but some have a wrong name or there are unneeded files.
     SET_STATUS_GOOD    = 'Good   '
     SET_STATUS_BADNAME = 'BadName'
     SET_STATUS_MISSING = 'Missing'
     SET_STATUS_UNKNOWN = 'Unknown'
     SET_STATUS_ERROR   = 'Error  '
+    SET_STATUS_PARTIAL = 'Partial'
 
     ROM_STATUS_GOOD    = 'Good   '
     ROM_STATUS_BADNAME = 'BadName'
@@ -696,11 +2095,26 @@ class ROMset:
 
     def __init__(self, filename):
         self.filename = filename
-        self.basename = FileName(filename).getBase()
+        self.basename = os.path.basename(filename)
         # Set correct name is the current one until the proper name can be determined.
         self.correct_filename = filename
         self.status = None
         self.rom_list = []
+        # Size and modification time of the file when the set was built, None if unknown.
+        # Used to check that the file did not change before fixing it.
+        self.file_size = None
+        self.file_mtime_ns = None
+
+    # st is an os.stat() result or a ScanEntry.
+    def set_file_stat(self, st):
+        self.file_size = st.st_size
+        self.file_mtime_ns = st.st_mtime_ns
+
+    # Returns True if the file changed since the set was built. st is an os.stat() result.
+    def is_file_modified(self, st):
+        if self.file_size is None: return False
+
+        return self.file_size != st.st_size or self.file_mtime_ns != st.st_mtime_ns
 
     def new_rom(self):
         return {
@@ -710,88 +2124,442 @@ class ROMset:
             'crc' : '',
             'md5' : '',
             'sha1' : '',
+            'hashes' : (), # Hashes computed by the scanner, empty strings for the others.
             'status' : ROMset.ROM_STATUS_UNKNOWN,
         }
 
-def misc_calculate_stream_checksums(file_bytes):
-    log_debug('Computing checksums of bytes stream...'.format(len(file_bytes)))
+# Creates the fake ROMset of a DAT set not found in ROM_dir.
+def new_missing_ROM_set(dirname, dat_set):
+    set_filename = FileName(dirname).pjoin(dat_set.name + '.zip').getPath()
+    rom_set = ROMset(set_filename)
+    rom_set.status = ROMset.SET_STATUS_MISSING
+    rom = rom_set.new_rom()
+    rom['name'] = dat_set.ROMs[0].name
+    rom['correct_name'] = dat_set.ROMs[0].name
+    rom['status'] = ROMset.ROM_STATUS_MISSING
+    rom_set.rom_list.append(rom)
+
+    return rom_set
+
+# File names of a DAT set in ROM_dir, its ZIP file or its loose ROMs. The set is not missing
+# if one of them exists.
+def get_DAT_set_basenames(dat_set):
+    return [dat_set.name + '.zip'] + [os.path.basename(ROM.name) for ROM in dat_set.ROMs]
+
+# Block size used to read and hash ROMs. Peak memory of the scanner does not depend on the
+# ROM size.
+STREAM_BLOCK_SIZE = 1024 * 1024
+
+def misc_read_bytes_in_chunks(file_obj, chunk_size = STREAM_BLOCK_SIZE):
+    while True:
+        piece = file_obj.read(chunk_size)
+        if not piece: break
+        yield piece
+
+# Same as misc_read_bytes_in_chunks() for a bytes-like object or a mmap. The pieces are
+# memoryview slices, the data is not copied.
+def misc_read_buffer_in_chunks(buffer, chunk_size = STREAM_BLOCK_SIZE):
+    view = memoryview(buffer)
+    for position in range(0, len(view), chunk_size):
+        yield view[position:position + chunk_size]
+
+# Maps a file in memory for reading. Yields a mmap object, or b'' for empty files, which
+# cannot be mapped. The kernel is told that the file is read sequentially so it reads ahead.
+# All the memoryviews of the mmap must be released before the context ends.
+@contextlib.contextmanager
+def misc_map_file(filename):
+    with open(filename, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            yield b''
+            return
+        mapped = mmap.mmap(file.fileno(), 0, access = mmap.ACCESS_READ)
+    if hasattr(mmap, 'MADV_SEQUENTIAL'): mapped.madvise(mmap.MADV_SEQUENTIAL)
+    try:
+        yield mapped
+    finally:
+        # If an exception keeps a memoryview alive the mmap is closed when it is collected.
+        try:
+            mapped.close()
+        except BufferError:
+            pass
+
+# Computes the checksums of a stream. head_bytes are bytes already read from file_obj that
+# are hashed before the rest of the stream.
+# Only the algorithms in hashes are computed, the other checksums are empty strings.
+def misc_calculate_stream_checksums(file_obj, head_bytes = b'', hashes = HASH_ALGORITHMS):
+    log_debug('Computing checksums of bytes stream...')
+    do_crc = 'crc' in hashes
+    md5 = hashlib.md5() if 'md5' in hashes else None
+    sha1 = hashlib.sha1() if 'sha1' in hashes else None
     crc_prev = 0
-    md5 = hashlib.md5()
-    sha1 = hashlib.sha1()
+    size = 0
     # Process bytes stream block by block
-    # for piece in misc_read_bytes_in_chunks(file_bytes):
-    #     crc_prev = zlib.crc32(piece, crc_prev)
-    #     md5.update(piece)
-    #     sha1.update(piece)
-    # Process bytes in one go
-    crc_prev = zlib.crc32(file_bytes, crc_prev)
-    md5.update(file_bytes)
-    sha1.update(file_bytes)
-    crc_digest = '{:08X}'.format(crc_prev & 0xFFFFFFFF)
-    md5_digest = md5.hexdigest()
-    sha1_digest = sha1.hexdigest()
-    size = len(file_bytes)
+    for piece in itertools.chain((head_bytes,), misc_read_bytes_in_chunks(file_obj)):
+        if do_crc: crc_prev = zlib.crc32(piece, crc_prev)
+        if md5: md5.update(piece)
+        if sha1: sha1.update(piece)
+        size += len(piece)
 
     checksums = {
-        'crc'  : crc_digest.upper(),
-        'md5'  : md5_digest.upper(),
-        'sha1' : sha1_digest.upper(),
+        'crc'  : '{:08X}'.format(crc_prev & 0xFFFFFFFF) if do_crc else '',
+        'md5'  : md5.hexdigest().upper() if md5 else '',
+        'sha1' : sha1.hexdigest().upper() if sha1 else '',
         'size' : size,
     }
 
     return checksums
 
-# This function assumes sets (ZIP files) contain 1 ROM. Otherwise it is an error.
-# For MAME ZIP files another function is required.
-# Also, NoIntro sets with severe errors require a more sofisticated function.
-def get_ROM_set_status(filename, DAT, headerOffset, headerRules):
-    set = ROMset(filename)
+# Computes the checksums of several blocks of a stream in a single pass. A block is a tuple
+# (start, end, operation), see HeaderDetector.match(). If end is None the block ends at the end
+# of the stream. Used to compute the checksums of a ROM with and without its header.
+# head_bytes are bytes already read from file_obj.
+# Returns a dictionary, key is the block and value is the checksums dictionary.
+def misc_calculate_stream_checksums_blocks(file_obj, blocks, head_bytes = b'', hashes = HASH_ALGORITHMS):
+    return misc_calculate_pieces_checksums_blocks(
+        itertools.chain((head_bytes,), misc_read_bytes_in_chunks(file_obj)), blocks, hashes)
+
+# Same as misc_calculate_stream_checksums_blocks() for a bytes-like object or a mmap. The
+# blocks without a swap operation are hashed from memoryview slices of buffer without
+# copying them.
+def misc_calculate_buffer_checksums_blocks(buffer, blocks, hashes = HASH_ALGORITHMS):
+    return misc_calculate_pieces_checksums_blocks(misc_read_buffer_in_chunks(buffer), blocks, hashes)
+
+# pieces is an iterator of the consecutive pieces of the data, bytes or memoryviews.
+def misc_calculate_pieces_checksums_blocks(pieces, blocks, hashes):
+    do_crc = 'crc' in hashes
+    states = {}
+    for block in blocks:
+        states[block] = {
+            'crc' : 0,
+            'md5' : hashlib.md5() if 'md5' in hashes else None,
+            'sha1' : hashlib.sha1() if 'sha1' in hashes else None,
+            'size' : 0,
+            'carry' : b'', # Bytes waiting for a full unit of the swap operation.
+        }
+    position = 0
+    for piece in pieces:
+        piece_end = position + len(piece)
+        for (start, end, operation), state in states.items():
+            if end is None: end = piece_end
+            if start >= piece_end or end <= position: continue
+            data = piece[max(start - position, 0):min(end, piece_end) - position]
+            if operation != 'none':
+                data = state['carry'] + data
+                num_bytes = len(data) - len(data) % DETECTOR_OPERATIONS[operation]
+                state['carry'] = data[num_bytes:]
+                data = detector_swap_bytes(data[:num_bytes], operation)
+            if do_crc: state['crc'] = zlib.crc32(data, state['crc'])
+            if state['md5']: state['md5'].update(data)
+            if state['sha1']: state['sha1'].update(data)
+            state['size'] += len(data)
+        position = piece_end
+
+    checksums_dic = {}
+    for block, state in states.items():
+        checksums_dic[block] = {
+            'crc'  : '{:08X}'.format(state['crc'] & 0xFFFFFFFF) if do_crc else '',
+            'md5'  : state['md5'].hexdigest().upper() if state['md5'] else '',
+            'sha1' : state['sha1'].hexdigest().upper() if state['sha1'] else '',
+            'size' : state['size'],
+        }
+
+    return checksums_dic
+
+# Computes the checksums of a ROM in buffer, a bytes-like object or a mmap, with and without
+# its header. The header is skipped slicing a memoryview of buffer, see
+# misc_calculate_buffer_checksums_blocks().
+# Returns a tuple (checksums, header_checksums), see get_ZIP_file_info().
+def get_buffer_checksums(buffer, detector, hashes = HASH_ALGORITHMS):
+    block = detector.match(buffer, len(buffer)) if detector is not None else None
+    log_debug('Header block {}', block)
+    if block is None:
+        checksums_dic = misc_calculate_buffer_checksums_blocks(buffer, (DETECTOR_FULL_BLOCK,), hashes)
+        return (checksums_dic[DETECTOR_FULL_BLOCK], None)
+    checksums_dic = misc_calculate_buffer_checksums_blocks(buffer, (block, DETECTOR_FULL_BLOCK), hashes)
+
+    return (checksums_dic[block], checksums_dic[DETECTOR_FULL_BLOCK])
+
+# Opens a set ZIP file, decompresses the ROM and computes the checksums.
+# This function does not need the DAT so it can be run in worker processes.
+# Returns a dictionary. file_info['zfilename'] is None if the ZIP file is not valid.
+#
+# Only the hash algorithms in hashes are computed, file_info['hashes'] has the computed ones.
+#
+# detector is the HeaderDetector of the collection or None. If the ROM has a header
+# file_info['checksums'] are the checksums of the ROM data and file_info['header_checksums']
+# the checksums of the whole ROM, computed in the same pass. Otherwise
+# file_info['header_checksums'] is None.
+#
+# In quick mode, if only the CRC is requested, the CRC and size stored in the ZIP central
+# directory are used and the ROM is not decompressed. If the ROM has a header the stored CRC
+# is not the CRC of the ROM data and the ROM is decompressed and hashed anyway.
+#
+# STORED (uncompressed) members are hashed from a memoryview of the ZIP file contents, or of
+# the memory mapped ZIP file, without copying them.
+#
+# If data is not None it is the contents of the file, already read by scan_files_pipeline().
+# If measure is True file_info['stats'] has the time spent decompressing and hashing, see
+# Metrics.add_file_stats(). It must be removed before the file_info is stored.
+def get_ZIP_file_info(filename, detector, quick = False, hashes = HASH_ALGORITHMS,
+    data = None, measure = False):
+    file_info = {
+        'zfilename' : None,
+        'checksums' : None,
+        'header_checksums' : None,
+        'hashes' : (),
+        'quick' : False,
+    }
 
     # Open the ZIP file.
-    log_debug('\nProcessing "{}"'.format(set.basename))
+    log_debug('\nProcessing "{}"', os.path.basename(filename))
     try:
-        zip_f = zipfile.ZipFile(filename, 'r')
+        zip_f = zipfile.ZipFile(io.BytesIO(data) if data is not None else filename, 'r')
     except zipfile.BadZipfile as e:
-        set.status = ROMset.SET_STATUS_ERROR
-        return set
+        return file_info
 
     # ZIP file must have one and only one file.
     # If set has 0 or more than 1 file that's and error.
     num_zip_files = len(zip_f.namelist())
-    log_debug('zip file contains {} files'.format(num_zip_files))
+    log_debug('zip file contains {} files', num_zip_files)
     if num_zip_files != 1:
+        zip_f.close()
+        return file_info
+    zfilename = zip_f.namelist()[0]
+    zinfo = zip_f.getinfo(zfilename)
+
+    # --- Quick mode. Use checksums in the ZIP central directory ---
+    if quick and set(hashes) <= {'crc'}:
+        if detector is not None:
+            with zip_f.open(zfilename) as zfile:
+                head_bytes = detector.read_head(zfile, zinfo.file_size)
+            block = detector.match(head_bytes, zinfo.file_size)
+        else:
+            block = None
+        if block is None:
+            zip_f.close()
+            checksums = {
+                'crc'  : '{:08X}'.format(zinfo.CRC),
+                'md5'  : '',
+                'sha1' : '',
+                'size' : zinfo.file_size,
+            }
+            log_debug('zfilename   "{}" size {:,}', zfilename, checksums['size'])
+            log_debug('CRC         "{}" (ZIP central directory)', checksums['crc'])
+            file_info['zfilename'] = zfilename
+            file_info['checksums'] = checksums
+            file_info['hashes'] = ('crc',)
+            file_info['quick'] = True
+            return file_info
+        log_debug('ROM has a header. Decompressing.')
+
+    # --- STORED members. Hash the member data in the ZIP file ---
+    if zinfo.compress_type == zipfile.ZIP_STORED and not zinfo.flag_bits & ZIP_FLAG_ENCRYPTED:
+        zip_f.close()
+        if measure:
+            start_time = time.perf_counter()
+            start_CPU_time = time.thread_time()
+        try:
+            with contextlib.nullcontext(data) if data is not None else misc_map_file(filename) as buffer:
+                data_offset = zip_get_member_data_offset(
+                    io.BytesIO(buffer) if data is not None else buffer, zinfo)
+                member_view = memoryview(buffer)[data_offset:data_offset + zinfo.file_size]
+                if len(member_view) != zinfo.file_size:
+                    raise zipfile.BadZipFile('Truncated member {}'.format(zfilename))
+                checksums, header_checksums = get_buffer_checksums(member_view, detector, hashes)
+                member_view.release()
+        except (OSError, ValueError, zipfile.BadZipFile) as e:
+            log_warn('Cannot read "{}": {}'.format(filename, str(e)))
+            return file_info
+        # Check the CRC like zipfile does when reading a member.
+        full_checksums = header_checksums if header_checksums is not None else checksums
+        if full_checksums['crc'] and int(full_checksums['crc'], 16) != zinfo.CRC:
+            log_warn('Bad CRC of "{}" in "{}"'.format(zfilename, filename))
+            return file_info
+        if measure:
+            file_info['stats'] = {
+                'inflate_time' : 0.0,
+                'inflate_CPU_time' : 0.0,
+                'hash_time' : time.perf_counter() - start_time,
+                'hash_CPU_time' : time.thread_time() - start_CPU_time,
+                'decompressed' : zinfo.file_size,
+            }
+        log_debug('zfilename   "{}" size {:,} (STORED)', zfilename, checksums['size'])
+        file_info['zfilename'] = zfilename
+        file_info['checksums'] = checksums
+        file_info['header_checksums'] = header_checksums
+        file_info['hashes'] = tuple(hashes)
+        return file_info
+
+    # --- Calculate checksums ---
+    # Decompress the ROM block by block and calculate hashes and size.
+    # The detector is checked on the first block only, unless it has tests relative to the
+    # end of the ROM. The checksums with and without header are computed in the same pass.
+    with zip_f.open(zfilename) as zfile:
+        if measure:
+            zfile = TimedReader(zfile)
+            start_time = time.perf_counter()
+            start_CPU_time = time.thread_time()
+        if detector is not None:
+            head_bytes = detector.read_head(zfile, zinfo.file_size, STREAM_BLOCK_SIZE)
+            block = detector.match(head_bytes, zinfo.file_size)
+        else:
+            head_bytes = b''
+            block = None
+        log_debug('Header block {}', block)
+        if block is None:
+            checksums = misc_calculate_stream_checksums(zfile, head_bytes, hashes)
+        else:
+            checksums_dic = misc_calculate_stream_checksums_blocks(zfile,
+                (block, DETECTOR_FULL_BLOCK), head_bytes, hashes)
+            checksums = checksums_dic[block]
+            file_info['header_checksums'] = checksums_dic[DETECTOR_FULL_BLOCK]
+        if measure:
+            file_info['stats'] = {
+                'inflate_time' : zfile.read_time,
+                'inflate_CPU_time' : zfile.read_CPU_time,
+                'hash_time' : time.perf_counter() - start_time - zfile.read_time,
+                'hash_CPU_time' : time.thread_time() - start_CPU_time - zfile.read_CPU_time,
+                'decompressed' : zfile.num_bytes,
+            }
+    zip_f.close()
+    log_debug('zfilename   "{}" size {:,}', zfilename, checksums['size'])
+    log_debug('CRC         "{}"', checksums['crc'])
+    log_debug('SHA1        "{}"', checksums['sha1'])
+    file_info['zfilename'] = zfilename
+    file_info['checksums'] = checksums
+    file_info['hashes'] = tuple(hashes)
+
+    return file_info
+
+# Files in ROM_dir with the extension of a ROM in the DAT are loose ROMs, see
+# DATfile.get_ROM_extensions(). A loose ROM is a set whose only ROM is the file itself.
+# Other files are ZIP files and, if they are not, Error sets, so files like readme.txt or
+# 7z archives are never hashed as ROMs nor reported as Unknown.
+def is_loose_ROM_file(filename, loose_extensions):
+    return os.path.splitext(filename)[1].lower() in loose_extensions
+
+# Returns a frozenset with the lowercase extensions of the file names in name_iter that can be
+# loose ROMs. Names without an extension and ZIP files are not included.
+def get_ROM_name_extensions(name_iter):
+    return frozenset(os.path.splitext(name)[1].lower() for name in name_iter) - {'', '.zip'}
+
+# Computes the checksums of a loose ROM. The file is memory mapped and hashed without copying
+# it, see get_buffer_checksums(). quick mode does not apply, the ROM is always hashed.
+# data is the contents of the file if already read by scan_files_pipeline().
+# Returns a dictionary like get_ZIP_file_info(), file_info['zfilename'] is the file name.
+def get_loose_ROM_file_info(filename, detector, hashes = HASH_ALGORITHMS, data = None, measure = False):
+    file_info = {
+        'zfilename' : None,
+        'checksums' : None,
+        'header_checksums' : None,
+        'hashes' : (),
+        'quick' : False,
+    }
+    log_debug('\nProcessing "{}"', os.path.basename(filename))
+    if measure:
+        start_time = time.perf_counter()
+        start_CPU_time = time.thread_time()
+    try:
+        with contextlib.nullcontext(data) if data is not None else misc_map_file(filename) as buffer:
+            checksums, header_checksums = get_buffer_checksums(buffer, detector, hashes)
+    except (OSError, ValueError) as e:
+        log_warn('Cannot read "{}": {}'.format(filename, str(e)))
+        return new_read_error_file_info()
+    if measure:
+        file_info['stats'] = {
+            'inflate_time' : 0.0,
+            'inflate_CPU_time' : 0.0,
+            'hash_time' : time.perf_counter() - start_time,
+            'hash_CPU_time' : time.thread_time() - start_CPU_time,
+            'decompressed' : checksums['size'] if header_checksums is None else header_checksums['size'],
+        }
+    log_debug('Loose ROM size {:,} CRC "{}"', checksums['size'], checksums['crc'])
+    file_info['zfilename'] = os.path.basename(filename)
+    file_info['checksums'] = checksums
+    file_info['header_checksums'] = header_checksums
+    file_info['hashes'] = tuple(hashes)
+
+    return file_info
+
+# File information of a file that cannot be read. The set is an Error set. read_error is
+# only set here and tells ChecksumCache not to cache it, so the file is read again next time.
+def new_read_error_file_info():
+    return {
+        'zfilename' : None,
+        'checksums' : None,
+        'header_checksums' : None,
+        'hashes' : (),
+        'quick' : False,
+        'read_error' : True,
+    }
+
+# Returns the file information of a set, a ZIP file or a loose ROM, see get_ZIP_file_info().
+# loose_extensions are the extensions of the loose ROMs, see is_loose_ROM_file().
+# If the file cannot be read returns new_read_error_file_info().
+def get_ROM_file_info(filename, detector, quick = False, hashes = HASH_ALGORITHMS,
+    data = None, measure = False, loose_extensions = frozenset()):
+    if is_loose_ROM_file(filename, loose_extensions):
+        return get_loose_ROM_file_info(filename, detector, hashes, data, measure)
+    try:
+        return get_ZIP_file_info(filename, detector, quick, hashes, data, measure)
+    except OSError as e:
+        log_warn('Cannot read "{}": {}'.format(filename, str(e)))
+        return new_read_error_file_info()
+
+# This function assumes sets (ZIP files) contain 1 ROM. Otherwise it is an error.
+# For MAME ZIP files another function is required.
+# Also, NoIntro sets with severe errors require a more sofisticated function.
+def get_ROM_set_status(filename, DAT, detector):
+    file_info = get_ROM_file_info(filename, detector, loose_extensions = DAT.get_ROM_extensions())
+
+    return build_ROM_set(filename, file_info, DAT)
+
+# Several DAT ROMs may have the same hash. Choose the DAT ROM that matches the ROM name and
+# the set name, then the ROM name, then the set name. Otherwise choose the first.
+# matches is the list returned by DATfile.find_ROMs(). Returns a DATrom or None.
+def resolve_DAT_ROM(set, rom, matches):
+    if not matches: return None
+    if len(matches) == 1: return matches[0][1]
+    set_base_noext = os.path.splitext(set.basename)[0]
+    candidates = [datrom for datset, datrom in matches]
+    for datrom in candidates:
+        if datrom.name == rom['name'] and os.path.splitext(datrom.name)[0] == set_base_noext:
+            return datrom
+    for datrom in candidates:
+        if datrom.name == rom['name']: return datrom
+    for datrom in candidates:
+        if os.path.splitext(datrom.name)[0] == set_base_noext: return datrom
+
+    return candidates[0]
+
+# Returns the path of the ZIP file of a set with the ROM rom_name in the same directory as
+# filename. If filename is a loose ROM the path of the loose ROM, see is_loose_ROM_file().
+# Called for every set, so os.path is used instead of FileName objects.
+def get_correct_set_filename(filename, rom_name, loose_extensions):
+    if is_loose_ROM_file(filename, loose_extensions):
+        return os.path.join(os.path.dirname(filename), os.path.basename(rom_name))
+    rom_base_noext = os.path.splitext(os.path.basename(rom_name))[0]
+
+    return os.path.join(os.path.dirname(filename), rom_base_noext + '.zip')
+
+# Creates a ROMset object from the file information returned by get_ZIP_file_info()
+# and determines the status of the set.
+def build_ROM_set(filename, file_info, DAT):
+    set = ROMset(filename)
+    if file_info['zfilename'] is None:
         set.status = ROMset.SET_STATUS_ERROR
         return set
-    zfilename = zip_f.namelist()[0]
 
-    # --- Build ROM list in set and calculate checksums ---
-    # Decompress and calculate hashes and size.
-    buffer = zip_f.read(zfilename)
-    # Skip ROM header if necessary.
-    if headerOffset > 0:
-        rule_output = []
-        for rule in headerRules:
-            offset = rule['offset']
-            value = rule['value']
-            num_bytes = int(len(value) / 2)
-            log_debug('HeaderRule offset {} num_bytes {}'.format(offset, num_bytes))
-            bytes_hex = buffer[offset:offset + num_bytes].hex()
-            log_debug('value     {}'.format(value))
-            log_debug('bytes_hex {}'.format(bytes_hex))
-            rule_output.append(value.lower() == bytes_hex.lower())
-        if all(rule_output):
-            log_debug('Rules verified.')
-            offsetBytes = headerOffset
-        else:
-            log_debug('Rules NOT verified.')
-            offsetBytes = 0
-    else:
-        offsetBytes = 0
-    log_debug('offsetBytes {}'.format(offsetBytes))
-    checksums = misc_calculate_stream_checksums(buffer[offsetBytes:])
-    log_debug('zfilename   "{}" size {:,}'.format(zfilename, checksums['size']))
-    log_debug('CRC         "{}"'.format(checksums['crc']))
-    log_debug('SHA1        "{}"'.format(checksums['sha1']))
+    # --- Build ROM list in set ---
+    # The DAT is searched with the hashes computed by the scanner. DATs may list ROMs
+    # with a header with the checksums of the whole ROM, which are used if the ROM data is
+    # not found.
+    zfilename = file_info['zfilename']
+    checksums = file_info['checksums']
+    DAT_matches = DAT.find_ROMs(checksums)
+    if not DAT_matches and file_info['header_checksums'] is not None:
+        DAT_matches = DAT.find_ROMs(file_info['header_checksums'])
+        if DAT_matches: checksums = file_info['header_checksums']
     rom = set.new_rom()
     rom['name'] = zfilename
     rom['correct_name'] = zfilename
@@ -799,31 +2567,28 @@ def get_ROM_set_status(filename, DAT, headerOffset, headerRules):
     rom['crc'] = checksums['crc']
     rom['md5'] = checksums['md5']
     rom['sha1'] = checksums['sha1']
+    rom['hashes'] = file_info['hashes']
     set.rom_list.append(rom)
-    zip_f.close()
 
     # --- Determine status of the single ROM ---
     rom = set.rom_list[0]
-    if DAT.ROM_CRC_exists(rom['crc']):
+    datrom = resolve_DAT_ROM(set, rom, DAT_matches)
+    if datrom is not None:
         # If ROM found check if filename is correct.
-        datrom = DAT.get_ROM_CRC(rom['crc'])
-        if rom['name'] == datrom['name']:
+        if rom['name'] == datrom.name:
             rom['status'] = ROMset.ROM_STATUS_GOOD
-            log_debug('ROM {} "{}"'.format(rom['status'], rom['name']))
+            log_debug('ROM {} "{}"', rom['status'], rom['name'])
         else:
             rom['status'] = ROMset.ROM_STATUS_BADNAME
-            rom['correct_name'] = datrom['name']
-            c_rom_name_FN = FileName(datrom['name'])
-            set_FN = FileName(set.filename)
-            c_set_FN = FileName(set_FN.getDir())
-            c_set_FN = c_set_FN.pjoin(c_rom_name_FN.getBase_noext() + '.zip')
-            set.correct_filename = c_set_FN.getPath()
-            log_debug('ROM {} "{}"'.format(rom['status'], rom['name']))
-            log_debug('Good Name   "{}"'.format(datrom['name']))
+            rom['correct_name'] = datrom.name
+            set.correct_filename = get_correct_set_filename(set.filename, datrom.name,
+                DAT.get_ROM_extensions())
+            log_debug('ROM {} "{}"', rom['status'], rom['name'])
+            log_debug('Good Name   "{}"', datrom.name)
     else:
         # ROM not found.
         rom['status'] = ROMset.ROM_STATUS_UNKNOWN
-        log_debug('ROM {} "{}"'.format(rom['status'], rom['name']))
+        log_debug('ROM {} "{}"', rom['status'], rom['name'])
 
     # --- Determine status of SET ---
     # If the ROM has a bad name mark the set as bad name.
@@ -843,16 +2608,14 @@ def get_ROM_set_status(filename, DAT, headerOffset, headerRules):
     # This is a unusual case.
     elif rom['status'] == ROMset.ROM_STATUS_GOOD:
         # Determine SET correct name.
-        C_ROM_FN = FileName(rom['correct_name'])
-        set_FN = FileName(set.filename)
-        C_set_FN = FileName(set_FN.getDir()).pjoin(C_ROM_FN.getBase_noext() + '.zip')
-        log_debug('Set name    "{}"'.format(set_FN.getPath()))
-        log_debug('Good name   "{}"'.format(C_set_FN.getPath()))
-        set.correct_filename = C_set_FN.getPath()
+        set.correct_filename = get_correct_set_filename(set.filename, rom['correct_name'],
+            DAT.get_ROM_extensions())
+        log_debug('Set name    "{}"', set.filename)
+        log_debug('Good name   "{}"', set.correct_filename)
 
         # Check if set name has the correct name.
         # The set name must be the same as the correct ROM name.
-        if set_FN.getPath() != C_set_FN.getPath():
+        if set.filename != set.correct_filename:
             log_debug('Set status BADNAME. ROM filename good, wrong ZIP filename.')
             set.status = ROMset.ROM_STATUS_BADNAME
             return set
@@ -863,6 +2626,118 @@ def get_ROM_set_status(filename, DAT, headerOffset, headerRules):
 
     return set
 
+# --- Content index ------------------------------------------------------------------------------
+# ROMs are identified by content in all the collections, see ScanDatabase. The content key is
+# the CRC and size of the ROM, like in the DATs, which are computed in all the scanner modes,
+# so ROMs scanned with --quick and with all the hashes have the same key. ROMs with the same
+# key are compared by SHA1 when both have it, see split_content_group(). If the CRC was
+# not computed (--hashes) the SHA1 or the MD5 is used. Missing ROMs are not in the index,
+# their content key is ''.
+def get_ROM_content_key(rom):
+    if rom['status'] == ROMset.ROM_STATUS_MISSING: return ''
+    if rom['crc']: return 'crc:{}:{}'.format(rom['crc'], rom['size'])
+    if rom['sha1']: return 'sha1:' + rom['sha1']
+    if rom['md5']: return 'md5:' + rom['md5']
+
+    return ''
+
+# A copy of a ROM in a collection, returned by the ScanDatabase content index functions.
+# sha1 is empty if the scanner did not compute it. collections has the names of all the
+# collections that scanned the file, see merge_file_locations().
+def new_content_location(content_key, sha1, collection, filename, set_status, rom_name, size, rom_status):
+    return {
+        'content_key' : content_key,
+        'sha1' : sha1,
+        'collection' : collection,
+        'collections' : [collection],
+        'filename' : filename,
+        'set_status' : set_status,
+        'rom_name' : rom_name,
+        'size' : size,
+        'rom_status' : rom_status,
+        'keep' : False,
+    }
+
+# The content key only has the CRC and size, so ROMs with the same content key are split by
+# SHA1: ROMs with a SHA1 are copies only if the SHA1 is the same, and a CRC collision is never
+# a duplicate. ROMs without a SHA1 (quick scans) are copies of the ROMs with a SHA1 if all of
+# them have the same SHA1, otherwise they are a group of their own.
+# Returns a list of groups, the lists of copies of each ROM sorted like location_list.
+def split_content_group(location_list):
+    sha1_groups = {}
+    for location in location_list:
+        if location['sha1']: sha1_groups.setdefault(location['sha1'], []).append(location)
+    group_list = list(sha1_groups.values())
+    unhashed_list = [location for location in location_list if not location['sha1']]
+    if unhashed_list:
+        if len(group_list) == 1:
+            group_list = [location_list]
+        else:
+            group_list.append(unhashed_list)
+
+    return group_list
+
+# The same file is scanned by several collections if they share a ROM_dir. Its locations are
+# a single copy of the ROM: only the first location is returned, with the names of all the
+# collections in location['collections'].
+def merge_file_locations(location_list):
+    file_dic = {}
+    merged_list = []
+    for location in location_list:
+        file_key = (location['filename'], location['rom_name'])
+        merged = file_dic.get(file_key)
+        if merged is None:
+            file_dic[file_key] = location
+            merged_list.append(location)
+        else:
+            merged['collections'].append(location['collection'])
+
+    return merged_list
+
+# Order in which the copies of a ROM are kept. Copies in Good sets are kept first.
+DUPLICATE_KEEP_ORDER = {
+    ROMset.SET_STATUS_GOOD : 0,
+    ROMset.SET_STATUS_BADNAME : 1,
+    ROMset.SET_STATUS_PARTIAL : 2,
+    ROMset.SET_STATUS_UNKNOWN : 3,
+    ROMset.SET_STATUS_ERROR : 4,
+}
+
+# Chooses the copy of each ROM to keep and computes the duplicate statistics of each
+# collection. groups is the list returned by ScanDatabase.get_duplicate_groups() and totals by
+# ScanDatabase.get_content_totals(). Sets location['keep'] of the kept copies.
+# A ROM is a duplicate if there is another copy in any collection. Copies that are not kept
+# are reclaimable. A file scanned by several collections is counted once, in the first of
+# them, see merge_file_locations().
+# Returns a dictionary, key is the collection name.
+def get_duplicate_statistics(groups, totals):
+    stats_dic = {}
+    for collection_name, (num_ROMs, num_bytes) in sorted(totals.items()):
+        stats_dic[collection_name] = {
+            'name' : collection_name,
+            'ROMs' : num_ROMs,
+            'bytes' : num_bytes,
+            'duplicate_ROMs' : 0,
+            'duplicate_bytes' : 0,
+            'reclaimable_ROMs' : 0,
+            'reclaimable_bytes' : 0,
+        }
+    for location_list in groups:
+        kept = min(location_list, key = lambda location: (
+            DUPLICATE_KEEP_ORDER.get(location['set_status'], len(DUPLICATE_KEEP_ORDER)),
+            location['rom_status'] != ROMset.ROM_STATUS_GOOD,
+            location['collection'], location['filename'], location['rom_name']))
+        kept['keep'] = True
+        for location in location_list:
+            stats = stats_dic[location['collection']]
+            stats['duplicate_ROMs'] += 1
+            stats['duplicate_bytes'] += location['size']
+            if location['keep']: continue
+            stats['reclaimable_ROMs'] += 1
+            stats['reclaimable_bytes'] += location['size']
+
+    return stats_dic
+
 def get_collection_statistics(collection):
     stats = {
         'name' : '',
@@ -872,6 +2747,7 @@ def get_collection_statistics(collection):
         'missing' : 0,
         'unknown' : 0,
         'error' : 0,
+        'partial' : 0,
     }
 
     stats['name'] = collection.name
@@ -883,26 +2759,513 @@ def get_collection_statistics(collection):
         elif set.status == ROMset.SET_STATUS_MISSING: stats['missing'] += 1
         elif set.status == ROMset.SET_STATUS_UNKNOWN: stats['unknown'] += 1
         elif set.status == ROMset.SET_STATUS_ERROR:   stats['error']   += 1
+        elif set.status == ROMset.SET_STATUS_PARTIAL: stats['partial'] += 1
         else:
             log_error('Unrecognised SET status. Logical error.')
             sys.exit(10)
 
     return stats
 
+# --- Scan results database ----------------------------------------------------------------------
+# Scanner results of all the collections are stored in a SQLite database in the data directory.
+# Sets of a collection keep the order of ROMcollection.sets in column sort_idx.
+# There are indices on the set status, set basename, ROM CRC and ROM SHA1 so the list
+# commands do not need to load the whole collection.
+# The collections table is a summary of each scan: the get_collection_statistics() counters,
+# the scan time and the DAT used. The status commands only read this table.
+# The roms table is also the content index of all the collections: every ROM has a content
+# key, see get_ROM_content_key(), with an index, so the copies of a ROM in all the collections
+# are found with one index lookup. The index is updated with the ROMs of the sets every time
+# the results of a collection are saved or updated.
+class ScanDatabase:
+    SCHEMA_VERSION = 5
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS collections (
+        name TEXT PRIMARY KEY,
+        dirname TEXT NOT NULL,
+        scan_time REAL NOT NULL,
+        DAT_name TEXT NOT NULL,
+        DAT_sha1 TEXT NOT NULL,
+        num_DAT_sets INTEGER NOT NULL,
+        total INTEGER NOT NULL,
+        have INTEGER NOT NULL,
+        badname INTEGER NOT NULL,
+        missing INTEGER NOT NULL,
+        unknown INTEGER NOT NULL,
+        error INTEGER NOT NULL,
+        partial INTEGER NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS sets (
+        id INTEGER PRIMARY KEY,
+        collection TEXT NOT NULL,
+        sort_idx INTEGER NOT NULL,
+        filename TEXT NOT NULL,
+        basename TEXT NOT NULL,
+        correct_filename TEXT NOT NULL,
+        status TEXT NOT NULL,
+        file_size INTEGER,
+        file_mtime_ns INTEGER
+    );
+    CREATE INDEX IF NOT EXISTS sets_collection_status ON sets (collection, status);
+    CREATE INDEX IF NOT EXISTS sets_collection_basename ON sets (collection, basename);
+    CREATE INDEX IF NOT EXISTS sets_collection_sort ON sets (collection, sort_idx);
+    CREATE TABLE IF NOT EXISTS roms (
+        set_id INTEGER NOT NULL,
+        collection TEXT NOT NULL,
+        name TEXT NOT NULL,
+        correct_name TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        crc TEXT NOT NULL,
+        md5 TEXT NOT NULL,
+        sha1 TEXT NOT NULL,
+        hashes TEXT NOT NULL,
+        status TEXT NOT NULL,
+        content_key TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS roms_set ON roms (set_id);
+    CREATE INDEX IF NOT EXISTS roms_collection ON roms (collection);
+    CREATE INDEX IF NOT EXISTS roms_crc ON roms (crc);
+    CREATE INDEX IF NOT EXISTS roms_sha1 ON roms (sha1);
+    CREATE INDEX IF NOT EXISTS roms_content_key ON roms (content_key);
+    """
+
+    def __init__(self, db_FN):
+        self.db_FN = db_FN
+        FileName(db_FN.getDir()).makedirs()
+        self.conn = sqlite3.connect(db_FN.getPath())
+        # Scanner results are recreated by rescanning, so if the schema changed just drop them.
+        db_version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+        if db_version != ScanDatabase.SCHEMA_VERSION:
+            if db_version != 0:
+                log_warn('Scanner database schema changed. Collections must be scanned again.')
+            with self.conn:
+                for table in ('collections', 'sets', 'roms'):
+                    self.conn.execute('DROP TABLE IF EXISTS {}'.format(table))
+                self.conn.execute('PRAGMA user_version = {}'.format(ScanDatabase.SCHEMA_VERSION))
+        self.conn.executescript(ScanDatabase.SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def collection_exists(self, collection_name):
+        cursor = self.conn.execute('SELECT 1 FROM collections WHERE name = ?', (collection_name,))
+        return cursor.fetchone() is not None
+
+    # Replaces the scanner results of a collection with the sets of a ROMcollection object.
+    def save_collection(self, collection):
+        with self.conn:
+            self._delete_collection(collection.name)
+            stats = get_collection_statistics(collection)
+            self.conn.execute('INSERT INTO collections (name, dirname, scan_time, DAT_name, DAT_sha1, '
+                'num_DAT_sets, total, have, badname, missing, unknown, error, partial) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (collection.name, collection.dirname, collection.scan_time,
+                 collection.DAT_name, collection.DAT_sha1, stats['total_DAT'],
+                 stats['total'], stats['have'], stats['badname'], stats['missing'],
+                 stats['unknown'], stats['error'], stats['partial']))
+            for sort_idx, set in enumerate(collection.sets):
+                self._insert_set(collection.name, sort_idx, set)
+
+    def _delete_collection(self, collection_name):
+        self.conn.execute('DELETE FROM roms WHERE collection = ?', (collection_name,))
+        self.conn.execute('DELETE FROM sets WHERE collection = ?', (collection_name,))
+        self.conn.execute('DELETE FROM collections WHERE name = ?', (collection_name,))
+
+    def _insert_set(self, collection_name, sort_idx, set):
+        cursor = self.conn.execute('INSERT INTO sets '
+            '(collection, sort_idx, filename, basename, correct_filename, status, file_size, file_mtime_ns) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (collection_name, sort_idx, set.filename, set.basename, set.correct_filename, set.status,
+             set.file_size, set.file_mtime_ns))
+        set_id = cursor.lastrowid
+        self.conn.executemany('INSERT INTO roms '
+            '(set_id, collection, name, correct_name, size, crc, md5, sha1, hashes, status, content_key) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [(set_id, collection_name, rom['name'], rom['correct_name'], rom['size'], rom['crc'],
+              rom['md5'], rom['sha1'], ','.join(rom['hashes']), rom['status'],
+              get_ROM_content_key(rom)) for rom in set.rom_list])
+
+        return set_id
+
+    # Returns a dictionary like get_collection_statistics() or None if the collection
+    # has not been scanned. Also has the scan time and the DAT name and SHA1.
+    def get_collection_statistics(self, collection_name):
+        cursor = self.conn.execute('SELECT num_DAT_sets, total, have, badname, missing, unknown, '
+            'error, partial, scan_time, DAT_name, DAT_sha1 FROM collections WHERE name = ?', (collection_name,))
+        row = cursor.fetchone()
+        if row is None: return None
+        stats = {
+            'name' : collection_name,
+            'total_DAT' : row[0],
+            'total' : row[1],
+            'have' : row[2],
+            'badname' : row[3],
+            'missing' : row[4],
+            'unknown' : row[5],
+            'error' : row[6],
+            'partial' : row[7],
+            'scan_time' : row[8],
+            'DAT_name' : row[9],
+            'DAT_sha1' : row[10],
+        }
+
+        return stats
+
+    # Returns a list of ROMset objects in the same order as ROMcollection.sets.
+    # If statuses is not None only sets with those status are returned.
+    def get_sets(self, collection_name, statuses = None):
+        query = ('SELECT id, filename, correct_filename, status, file_size, file_mtime_ns '
+            'FROM sets WHERE collection = ?')
+        params = [collection_name]
+        if statuses is not None:
+            query += ' AND status IN ({})'.format(', '.join('?' * len(statuses)))
+            params.extend(statuses)
+        query += ' ORDER BY sort_idx'
+        set_list = []
+        set_dict = {}
+        for set_id, filename, correct_filename, status, file_size, file_mtime_ns in \
+            self.conn.execute(query, params):
+            set = ROMset(filename)
+            set.correct_filename = correct_filename
+            set.status = status
+            set.file_size = file_size
+            set.file_mtime_ns = file_mtime_ns
+            set_list.append(set)
+            set_dict[set_id] = set
+        if not set_list: return set_list
+
+        # Load the ROMs of the sets.
+        query = ('SELECT roms.set_id, roms.name, roms.correct_name, roms.size, roms.crc, roms.md5, '
+            'roms.sha1, roms.hashes, roms.status FROM roms JOIN sets ON roms.set_id = sets.id '
+            'WHERE sets.collection = ?')
+        params = [collection_name]
+        if statuses is not None:
+            query += ' AND sets.status IN ({})'.format(', '.join('?' * len(statuses)))
+            params.extend(statuses)
+        query += ' ORDER BY roms.rowid'
+        for row in self.conn.execute(query, params):
+            set = set_dict[row[0]]
+            rom = set.new_rom()
+            rom['name'] = row[1]
+            rom['correct_name'] = row[2]
+            rom['size'] = row[3]
+            rom['crc'] = row[4]
+            rom['md5'] = row[5]
+            rom['sha1'] = row[6]
+            rom['hashes'] = tuple(row[7].split(',')) if row[7] else ()
+            rom['status'] = row[8]
+            set.rom_list.append(rom)
+
+        return set_list
+
+    # Updates the scanner results of a collection after some sets were renamed or deleted by
+    # the fix commands, so the collection does not need to be scanned again.
+    # removed is a list of filenames of sets that no longer exist and new_sets a list of
+    # ROMset objects to add. Missing sets are added and removed like
+    # ROMcollection.process_files() does, so the results are the same as a new scan.
+    # If scan_time is not None it is the new time of the scan of the collection.
+    def update_sets(self, collection_name, dirname, DAT, removed, new_sets, scan_time = None):
+        # Key is a file name of a DAT set, see get_DAT_set_basenames(). Built when needed.
+        DAT_set_dic = {}
+        def get_DAT_set(basename):
+            if not DAT_set_dic:
+                for dat_set in DAT.sets:
+                    for DAT_basename in get_DAT_set_basenames(dat_set):
+                        DAT_set_dic.setdefault(DAT_basename, dat_set)
+            return DAT_set_dic.get(basename)
+        def basename_exists(basename):
+            cursor = self.conn.execute('SELECT 1 FROM sets WHERE collection = ? AND basename = ?',
+                (collection_name, basename))
+            return cursor.fetchone() is not None
+
+        with self.conn:
+            removed_basenames = set()
+            for filename in removed:
+                basename = FileName(filename).getBase()
+                self._delete_sets('collection = ? AND basename = ? AND filename = ?',
+                    (collection_name, basename, filename))
+                removed_basenames.add(basename)
+            for rom_set in new_sets:
+                missing_basename = rom_set.basename
+                # A loose ROM replaces the missing ZIP file of its DAT set.
+                if is_loose_ROM_file(rom_set.filename, DAT.get_ROM_extensions()):
+                    dat_set = get_DAT_set(rom_set.basename)
+                    if dat_set is not None: missing_basename = dat_set.name + '.zip'
+                self._delete_sets('collection = ? AND basename = ? AND status = ?',
+                    (collection_name, missing_basename, ROMset.SET_STATUS_MISSING))
+                self._insert_set(collection_name, -1, rom_set)
+                removed_basenames.discard(rom_set.basename)
+
+            # A set removed from ROM_dir may have the name of a DAT set.
+            for basename in sorted(removed_basenames):
+                if basename_exists(basename): continue
+                dat_set = get_DAT_set(basename)
+                if dat_set is None: continue
+                if any(basename_exists(DAT_basename) for DAT_basename in get_DAT_set_basenames(dat_set)):
+                    continue
+                self._insert_set(collection_name, -1, new_missing_ROM_set(dirname, dat_set))
+
+            self._sort_sets(collection_name)
+            self._update_statistics(collection_name)
+            if scan_time is not None:
+                self.conn.execute('UPDATE collections SET scan_time = ? WHERE name = ?',
+                    (scan_time, collection_name))
+
+    # --- Content index ---
+    # Returns the ROMs that verify the where condition on the roms table, in all the
+    # collections. A list of dictionaries, see new_content_location().
+    def _get_content_locations(self, where, params):
+        query = ('SELECT roms.content_key, roms.sha1, roms.collection, sets.filename, sets.status, '
+            'roms.name, roms.size, roms.status FROM roms JOIN sets ON roms.set_id = sets.id WHERE {} '
+            'ORDER BY roms.content_key, roms.collection, sets.filename, roms.name'.format(where))
+        return [new_content_location(*row) for row in self.conn.execute(query, params)]
+
+    # Returns the copies of a ROM in all the collections. If sha1 is not empty the ROMs with
+    # a different SHA1 are not copies, see split_content_group().
+    def find_content(self, content_key, sha1 = ''):
+        return self._get_content_locations('roms.content_key = ? AND '
+            '(? = \'\' OR roms.sha1 = \'\' OR roms.sha1 = ?)', (content_key, sha1, sha1))
+
+    # Returns the ROMs with a hash, hash_name is crc, md5 or sha1. MD5 is not indexed.
+    def find_hash(self, hash_name, hash_value):
+        return self._get_content_locations('roms.{} = ? AND roms.content_key != ?'.format(hash_name),
+            (hash_value.upper(), ''))
+
+    # Returns a list of tuples (content_key, sha1) of the ROMs of the set with filename, an
+    # empty list if the file is not a set of any collection.
+    def get_set_content_keys(self, filename):
+        cursor = self.conn.execute('SELECT roms.content_key, roms.sha1 FROM roms JOIN sets ON roms.set_id = sets.id '
+            'WHERE sets.filename = ? AND roms.content_key != ? ORDER BY roms.rowid', (filename, ''))
+        return [(row[0], row[1]) for row in cursor]
+
+    # Returns the ROMs with more than one copy. A list of groups, each one the list of the
+    # copies of a ROM, see new_content_location(). The locations of the same file are merged,
+    # see merge_file_locations(), and the ROMs with the same content key are split by SHA1,
+    # see split_content_group().
+    def get_duplicate_groups(self):
+        location_list = self._get_content_locations('roms.content_key IN (SELECT content_key FROM roms '
+            'WHERE content_key != ? GROUP BY content_key HAVING COUNT(*) > 1)', ('',))
+        key_groups = {}
+        for location in location_list:
+            key_groups.setdefault(location['content_key'], []).append(location)
+        groups = []
+        for key_location_list in key_groups.values():
+            groups.extend(group for group in split_content_group(merge_file_locations(key_location_list))
+                if len(group) > 1)
+
+        return groups
+
+    # Returns a dictionary, key is the collection name and value a tuple with the number of
+    # ROMs in the content index and their size in bytes.
+    def get_content_totals(self):
+        cursor = self.conn.execute('SELECT collection, COUNT(*), SUM(size) FROM roms '
+            'WHERE content_key != ? GROUP BY collection', ('',))
+        return {row[0] : (row[1], row[2]) for row in cursor}
+
+    def _delete_sets(self, where, params):
+        self.conn.execute('DELETE FROM roms WHERE set_id IN (SELECT id FROM sets WHERE {})'.format(where), params)
+        self.conn.execute('DELETE FROM sets WHERE {}'.format(where), params)
+
+    # Sets are sorted by basename like ROMcollection.process_files(). Only the sets that
+    # changed position are updated.
+    def _sort_sets(self, collection_name):
+        rows = self.conn.execute('SELECT id, sort_idx, basename FROM sets WHERE collection = ? '
+            'ORDER BY sort_idx', (collection_name,)).fetchall()
+        rows.sort(key = lambda row: row[2].lower())
+        self.conn.executemany('UPDATE sets SET sort_idx = ? WHERE id = ?',
+            [(sort_idx, row[0]) for sort_idx, row in enumerate(rows) if row[1] != sort_idx])
+
+    def _update_statistics(self, collection_name):
+        counters = {
+            ROMset.SET_STATUS_GOOD : 0,
+            ROMset.SET_STATUS_BADNAME : 0,
+            ROMset.SET_STATUS_MISSING : 0,
+            ROMset.SET_STATUS_UNKNOWN : 0,
+            ROMset.SET_STATUS_ERROR : 0,
+            ROMset.SET_STATUS_PARTIAL : 0,
+        }
+        cursor = self.conn.execute('SELECT status, COUNT(*) FROM sets WHERE collection = ? '
+            'GROUP BY status', (collection_name,))
+        for status, count in cursor: counters[status] = count
+        self.conn.execute('UPDATE collections SET total = ?, have = ?, badname = ?, missing = ?, '
+            'unknown = ?, error = ?, partial = ? WHERE name = ?',
+            (sum(counters.values()), counters[ROMset.SET_STATUS_GOOD],
+             counters[ROMset.SET_STATUS_BADNAME], counters[ROMset.SET_STATUS_MISSING],
+             counters[ROMset.SET_STATUS_UNKNOWN], counters[ROMset.SET_STATUS_ERROR],
+             counters[ROMset.SET_STATUS_PARTIAL], collection_name))
+
+# --- Raw ZIP functions --------------------------------------------------------------------------
+# Members are copied from one ZIP file to another without decompressing and compressing them
+# again. The compressed data is copied unchanged and only the local file headers, the central
+# directory and the end of central directory record are written, with the new member names.
+# See https://pkware.cachefly.net/webdocs/casestudies/APPNOTE.TXT
+ZIP_LOCAL_HEADER_STRUCT = struct.Struct('<4s5H3L2H')
+ZIP_CENTRAL_DIR_STRUCT = struct.Struct('<4s4B4H3L5H2L')
+ZIP_END_CENTRAL_DIR_STRUCT = struct.Struct('<4s4H2LH')
+ZIP_LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+ZIP_CENTRAL_DIR_SIGNATURE = b'PK\x01\x02'
+ZIP_END_CENTRAL_DIR_SIGNATURE = b'PK\x05\x06'
+ZIP_FLAG_ENCRYPTED = 0x01
+ZIP_FLAG_DATA_DESCRIPTOR = 0x08
+ZIP_FLAG_UTF8 = 0x800
+ZIP_MAX_32 = 0xFFFFFFFF
+
+ZIP_EXTRA_HEADER_STRUCT = struct.Struct('<2H')
+ZIP_EXTRA_ZIP64 = 0x0001
+ZIP_EXTRA_UNICODE_PATH = 0x7075
+
+# Reads the local file header of a member in the ZIP file object f.
+# Returns a tuple (data_offset, extra), the offset of the compressed data and the local
+# extra field, which may be different from the central directory one (zinfo.extra).
+def zip_read_local_header(f, zinfo):
+    f.seek(zinfo.header_offset)
+    header = f.read(ZIP_LOCAL_HEADER_STRUCT.size)
+    if len(header) != ZIP_LOCAL_HEADER_STRUCT.size or header[0:4] != ZIP_LOCAL_HEADER_SIGNATURE:
+        raise zipfile.BadZipFile('Bad local file header in {}'.format(zinfo.filename))
+    fields = ZIP_LOCAL_HEADER_STRUCT.unpack(header)
+    name_len, extra_len = fields[9], fields[10]
+    f.seek(name_len, os.SEEK_CUR)
+    extra = f.read(extra_len)
+    if len(extra) != extra_len:
+        raise zipfile.BadZipFile('Bad local file header in {}'.format(zinfo.filename))
+
+    return (zinfo.header_offset + ZIP_LOCAL_HEADER_STRUCT.size + name_len + extra_len, extra)
+
+# Returns the offset of the compressed data of a member in the ZIP file object f.
+def zip_get_member_data_offset(f, zinfo):
+    return zip_read_local_header(f, zinfo)[0]
+
+# Returns the extra field without the blocks with a header ID in header_ids.
+# Malformed trailing bytes are dropped.
+def zip_strip_extra_field(extra, header_ids):
+    blocks = []
+    position = 0
+    while position + ZIP_EXTRA_HEADER_STRUCT.size <= len(extra):
+        header_id, size = ZIP_EXTRA_HEADER_STRUCT.unpack_from(extra, position)
+        end = position + ZIP_EXTRA_HEADER_STRUCT.size + size
+        if end > len(extra): break
+        if header_id not in header_ids: blocks.append(extra[position:end])
+        position = end
+
+    return b''.join(blocks)
+
+# Returns a tuple (name_bytes, flag_bits) with the name of a member copied with new_name.
+# If the name does not change the original bytes and UTF-8 flag are kept, so names that
+# zipfile decoded with the wrong code page (UTF-8 names without the flag, written by Info-ZIP)
+# are not modified.
+def zip_get_member_name_bytes(zinfo, new_name):
+    if new_name == zinfo.filename:
+        encoding = 'utf-8' if zinfo.flag_bits & ZIP_FLAG_UTF8 else 'cp437'
+        return (zinfo.orig_filename.encode(encoding), zinfo.flag_bits)
+    try:
+        return (new_name.encode('ascii'), zinfo.flag_bits & ~ZIP_FLAG_UTF8)
+    except UnicodeEncodeError:
+        return (new_name.encode('utf-8'), zinfo.flag_bits | ZIP_FLAG_UTF8)
+
+# Creates dst_fname with the members in member_list. member_list is a list of tuples
+# (src_fname, zinfo, new_name), zinfo is the ZipInfo of the member in src_fname.
+# The local and central extra fields (timestamps, uid and gid) and the member comments are
+# copied, except the ZIP64 field and, for renamed members, the Info-ZIP Unicode path field.
+# If file_cache is a ZipSourceFileCache the source files are kept open for the next call.
+# ZIP64 archives are not supported. Returns False and does not create dst_fname if a member
+# cannot be copied in raw mode.
+def zip_copy_members_raw(dst_fname, member_list, file_cache = None):
+    for src_fname, zinfo, new_name in member_list:
+        if zinfo.compress_size >= ZIP_MAX_32 or zinfo.file_size >= ZIP_MAX_32 or \
+            zinfo.header_offset >= ZIP_MAX_32:
+            log_debug('ZIP64 member "{}" cannot be copied in raw mode', zinfo.filename)
+            return False
+    central_dir = []
+    src_files = {}
+    try:
+        with open(dst_fname, 'wb') as f_out:
+            for src_fname, zinfo, new_name in member_list:
+                if file_cache is not None:
+                    f_in = file_cache.open(src_fname)
+                    data_offset, local_extra = file_cache.get_local_header(src_fname, f_in, zinfo)
+                else:
+                    if src_fname not in src_files: src_files[src_fname] = open(src_fname, 'rb')
+                    f_in = src_files[src_fname]
+                    data_offset, local_extra = zip_read_local_header(f_in, zinfo)
+                name_bytes, flag_bits = zip_get_member_name_bytes(zinfo, new_name)
+                strip_ids = (ZIP_EXTRA_ZIP64,) if new_name == zinfo.filename else \
+                    (ZIP_EXTRA_ZIP64, ZIP_EXTRA_UNICODE_PATH)
+                local_extra = zip_strip_extra_field(local_extra, strip_ids)
+                central_extra = zip_strip_extra_field(zinfo.extra, strip_ids)
+                # CRC and sizes are written in the local header, data descriptor not needed.
+                flag_bits &= ~ZIP_FLAG_DATA_DESCRIPTOR
+                dt = zinfo.date_time
+                dos_date = (dt[0] - 1980) << 9 | dt[1] << 5 | dt[2]
+                dos_time = dt[3] << 11 | dt[4] << 5 | (dt[5] // 2)
+                header_offset = f_out.tell()
+                if header_offset >= ZIP_MAX_32:
+                    raise OverflowError('ZIP64 archive')
+                f_out.write(ZIP_LOCAL_HEADER_STRUCT.pack(ZIP_LOCAL_HEADER_SIGNATURE,
+                    zinfo.extract_version, flag_bits, zinfo.compress_type, dos_time, dos_date,
+                    zinfo.CRC, zinfo.compress_size, zinfo.file_size, len(name_bytes), len(local_extra)))
+                f_out.write(name_bytes)
+                f_out.write(local_extra)
+                # Copy compressed data.
+                f_in.seek(data_offset)
+                remaining = zinfo.compress_size
+                while remaining > 0:
+                    piece = f_in.read(min(STREAM_BLOCK_SIZE, remaining))
+                    if not piece:
+                        raise zipfile.BadZipFile('Truncated member {}'.format(zinfo.filename))
+                    f_out.write(piece)
+                    remaining -= len(piece)
+                central_dir.append(ZIP_CENTRAL_DIR_STRUCT.pack(ZIP_CENTRAL_DIR_SIGNATURE,
+                    zinfo.create_version, zinfo.create_system, zinfo.extract_version, 0,
+                    flag_bits, zinfo.compress_type, dos_time, dos_date,
+                    zinfo.CRC, zinfo.compress_size, zinfo.file_size, len(name_bytes),
+                    len(central_extra), len(zinfo.comment), 0,
+                    zinfo.internal_attr, zinfo.external_attr, header_offset) +
+                    name_bytes + central_extra + zinfo.comment)
+            # Write central directory.
+            central_dir_offset = f_out.tell()
+            for entry in central_dir: f_out.write(entry)
+            central_dir_size = f_out.tell() - central_dir_offset
+            if central_dir_offset >= ZIP_MAX_32 or len(central_dir) >= 0xFFFF:
+                raise OverflowError('ZIP64 archive')
+            f_out.write(ZIP_END_CENTRAL_DIR_STRUCT.pack(ZIP_END_CENTRAL_DIR_SIGNATURE,
+                0, 0, len(central_dir), len(central_dir), central_dir_size, central_dir_offset, 0))
+    except OverflowError:
+        os.remove(dst_fname)
+        return False
+    except:
+        if os.path.exists(dst_fname): os.remove(dst_fname)
+        raise
+    finally:
+        for f_in in src_files.values(): f_in.close()
+
+    return True
+
+# Renames a member of a ZIP file. The new ZIP file is dst_fname.
+# Returns False if the member could not be copied in raw mode, see zip_copy_members_raw().
+def zip_rename_member_raw(src_fname, dst_fname, old_name, new_name):
+    with zipfile.ZipFile(src_fname, 'r') as zip_f:
+        member_list = []
+        for zinfo in zip_f.infolist():
+            name = new_name if zinfo.filename == old_name else zinfo.filename
+            member_list.append((src_fname, zinfo, name))
+
+    return zip_copy_members_raw(dst_fname, member_list)
+
 # Fixes a ROM set with status SET_STATUS_BADNAME
-# Rename ZIP file and the single ROM in the ZIP file.
-def fix_ROM_set(set):
+# Rename ZIP file and the single ROM in the ZIP file. Returns True if the set was fixed.
+def fix_ROM_set(set, loose_extensions):
     log_info('\nFixing set "{}"'.format(set.basename))
 
     # If set has not valid ROMs cannot be fixed.
     if not set.rom_list:
         log_info('Set has no ROMs, cannot be fixed.')
-        return
+        return False
     if set.rom_list[0]['status'] == ROMset.ROM_STATUS_UNKNOWN:
         log_info('Set has an unknown ROM, cannot be fixed.')
-        return
+        return False
 
     # First rename the set (ZIP file) and then rename the single ROM in the set.
+    # Loose ROMs only need to be renamed.
     set_FN = FileName(set.filename)
     set_new_FN = FileName(set.correct_filename)
     if set_FN.getPath() != set_new_FN.getPath():
@@ -910,30 +3273,561 @@ def fix_ROM_set(set):
         os.rename(set_FN.getPath(), set_new_FN.getPath())
     else:
         log_info('Set name is correct "{}"'.format(set_new_FN.getPath()))
+    if is_loose_ROM_file(set.filename, loose_extensions): return True
     set_fname = set_new_FN.getPath()
     set_dir = set_new_FN.getDir()
     temp_fname = os.path.join(set_dir, '_prm_.zip')
     new_rom_name = set.rom_list[0]['correct_name']
 
     # Then rename the compressed ROM inside the set.
-    # Files in a ZIP file cannot be renamed directly.
-    # Open ZIP file, read ROM in memory, overwrite ROM in ZIP file with new name.
+    # Files in a ZIP file cannot be renamed directly. Copy the compressed ROM to a new ZIP file
+    # with the new name, see zip_rename_member_raw(). If that is not possible (ZIP64 files)
+    # read ROM in memory and compress it again with the new name.
     # https://stackoverflow.com/questions/34432130/rename-a-zipped-file-in-python
     zip_f = zipfile.ZipFile(set_fname, 'r')
     rom_name = zip_f.namelist()[0]
     zip_f.close()
     if rom_name != new_rom_name:
         log_info('Creating temp file "{}"'.format(temp_fname))
-        zin = zipfile.ZipFile(set_fname, 'r')
-        # zout = zipfile.ZipFile(temp_fname, 'w', compression = zipfile.ZIP_DEFLATED, compresslevel = 9)
-        zout = zipfile.ZipFile(temp_fname, 'w', compression = zipfile.ZIP_DEFLATED)
-        buffer = zin.read(rom_name)
-        zout.writestr(new_rom_name, buffer)
-        zin.close()
-        zout.close()
+        if not zip_rename_member_raw(set_fname, temp_fname, rom_name, new_rom_name):
+            log_info('Cannot copy ROM in raw mode. Compressing ROM again.')
+            zin = zipfile.ZipFile(set_fname, 'r')
+            # zout = zipfile.ZipFile(temp_fname, 'w', compression = zipfile.ZIP_DEFLATED, compresslevel = 9)
+            zout = zipfile.ZipFile(temp_fname, 'w', compression = zipfile.ZIP_DEFLATED, allowZip64 = True)
+            buffer = zin.read(rom_name)
+            zout.writestr(new_rom_name, buffer)
+            zin.close()
+            zout.close()
         log_info('RM "{}"'.format(set_fname))
         os.remove(set_fname)
         log_info('MV "{}"\n-> "{}"'.format(temp_fname, set_fname))
         os.rename(temp_fname, set_fname)
     else:
         log_info('ROM name is correct "{}"'.format(rom_name))
+
+    return True
+
+# --- Import of ROMs in the Incoming_dir ---------------------------------------------------------
+# Bloom filter of 32 bit integers. Used to reject files whose CRC is not in any DAT without
+# searching the DATs. There are no false negatives and about error_rate false positives.
+class BloomFilter:
+    def __init__(self, num_items, error_rate = 0.01):
+        num_items = max(1, num_items)
+        self.num_bits = max(64, int(math.ceil(-num_items * math.log(error_rate) / math.log(2) ** 2)))
+        self.num_hashes = max(1, int(round(self.num_bits / num_items * math.log(2))))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+
+    # Bit positions of a key, with double hashing. The key is mixed with the splitmix64
+    # finalizer to get the two hashes.
+    def _positions(self, key):
+        z = (key + 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+        z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+        z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+        z ^= z >> 31
+        h1 = z & 0xFFFFFFFF
+        h2 = (z >> 32) | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key):
+        for pos in self._positions(key):
+            if not self.bits[pos >> 3] & (1 << (pos & 7)): return False
+        return True
+
+# Index of the ROMs of all the collections, used by the import command.
+# Collections are grouped by header detector because a headered ROM has different checksums
+# in each group. All the DAT CRCs are in a Bloom filter, which is checked before searching
+# the DATs. ZIP members whose central directory CRC is not in the filter are rejected
+# without decompressing them.
+class ImportIndex:
+    def __init__(self):
+        # List of dictionaries with keys detector, the compiled HeaderDetector or None, and
+        # collections, a list of tuples (collection_conf, DATfile).
+        self.groups = []
+        self.detector_list = []
+        self.bloom = None
+        self.num_CRCs = 0
+
+    def add_collection(self, collection_conf, DAT):
+        detector = get_collection_detector(collection_conf)
+        detector_key = detector.key if detector is not None else None
+        for group in self.groups:
+            group_key = group['detector'].key if group['detector'] is not None else None
+            if group_key == detector_key:
+                group['collections'].append((collection_conf, DAT))
+                return
+        self.groups.append({
+            'detector' : detector,
+            'collections' : [(collection_conf, DAT)],
+        })
+        if detector is not None: self.detector_list.append(detector)
+
+    def build_filter(self):
+        crc_set = set()
+        for group in self.groups:
+            for collection_conf, DAT in group['collections']:
+                crc_set.update(DAT.crc_index)
+        self.num_CRCs = len(crc_set)
+        self.bloom = BloomFilter(self.num_CRCs)
+        for crc in crc_set:
+            self.bloom.add(int(crc, 16))
+        log_info('Import filter has {:,} CRCs in {:,} bytes'.format(self.num_CRCs, len(self.bloom.bits)))
+
+    # Returns True if a ROM with the CRC crc (an integer) is not in any DAT. If some collection
+    # has a header detector the headerless CRC may be in a DAT, so the ROM must be read.
+    def reject_CRC(self, crc):
+        return not self.detector_list and crc not in self.bloom
+
+    # Reads from f the bytes needed by the detectors of all the groups.
+    def read_detector_head(self, f):
+        if not self.detector_list: return b''
+        if any(detector.needs_tail for detector in self.detector_list): return f.read()
+
+        return f.read(max(detector.head_size for detector in self.detector_list))
+
+    # Identifies a ROM, see new_import_ROM(). f is a file object with the ROM data and size
+    # is the size of the ROM.
+    # raw_crc is the CRC of the ROM data (in ZIP files it is in the central directory) or None.
+    # The checksums of the ROM with and without header are computed in a single pass over f,
+    # then the CRCs are checked with the Bloom filter before searching the DATs.
+    # Sets rom['status'] and fills rom['matches'], a list of tuples
+    # (collection_conf, DAT, checksums, DAT_matches).
+    def identify(self, rom, f, size, raw_crc, hashes = HASH_ALGORITHMS):
+        head_bytes = self.read_detector_head(f)
+        group_blocks = []
+        for group in self.groups:
+            block = group['detector'].match(head_bytes, size) if group['detector'] is not None else None
+            group_blocks.append(block if block is not None else DETECTOR_FULL_BLOCK)
+        block_set = set(group_blocks)
+        block_set.add(DETECTOR_FULL_BLOCK)
+        # No header found, the CRC of the ROM is already known.
+        if raw_crc is not None and len(block_set) == 1 and raw_crc not in self.bloom:
+            rom['status'] = IMPORT_ROM_FILTERED
+            return
+
+        # The CRC is always needed by the filter.
+        pass_hashes = tuple(h for h in HASH_ALGORITHMS if h == 'crc' or h in hashes)
+        checksums_dic = misc_calculate_stream_checksums_blocks(f, list(block_set), head_bytes, pass_hashes)
+        for block in list(checksums_dic):
+            checksums = checksums_dic[block]
+            if int(checksums['crc'], 16) not in self.bloom:
+                del checksums_dic[block]
+            elif 'crc' not in hashes:
+                checksums['crc'] = ''
+        if not checksums_dic:
+            rom['status'] = IMPORT_ROM_FILTERED
+            return
+        for group, block in zip(self.groups, group_blocks):
+            for collection_conf, DAT in group['collections']:
+                for search_block in (block, DETECTOR_FULL_BLOCK):
+                    if search_block not in checksums_dic: continue
+                    checksums = checksums_dic[search_block]
+                    DAT_matches = DAT.find_ROMs(checksums)
+                    if DAT_matches:
+                        rom['matches'].append((collection_conf, DAT, checksums, DAT_matches))
+                        break
+        rom['status'] = IMPORT_ROM_FOUND if rom['matches'] else IMPORT_ROM_UNKNOWN
+
+IMPORT_ROM_FILTERED = 'Filtered'
+IMPORT_ROM_UNKNOWN  = 'Unknown'
+IMPORT_ROM_FOUND    = 'Found'
+IMPORT_ROM_ERROR    = 'Error'
+
+# A ROM in the Incoming_dir is a file or a member of a ZIP file. If the ROM is in a ZIP file
+# zinfo is the ZipInfo object of the member, otherwise it is None.
+def new_import_ROM(filename, zinfo, name):
+    return {
+        'filename' : filename,
+        'zinfo' : zinfo,
+        'name' : name,
+        'status' : IMPORT_ROM_UNKNOWN,
+        'matches' : [],
+    }
+
+# Identifies all the ROMs in a file of the Incoming_dir. The file is opened once. ZIP members
+# are rejected with the CRC of the central directory when possible, see ImportIndex.reject_CRC().
+# Other files are loose ROMs.
+# Returns a list of ROMs, see new_import_ROM().
+def import_identify_file(filename, index, hashes = HASH_ALGORITHMS):
+    log_debug('\nProcessing "{}"', filename)
+    rom_list = []
+    try:
+        with open(filename, 'rb') as f:
+            try:
+                zip_f = zipfile.ZipFile(f, 'r')
+            except zipfile.BadZipfile:
+                zip_f = None
+            if zip_f is None:
+                f.seek(0)
+                rom = new_import_ROM(filename, None, FileName(filename).getBase())
+                rom_list.append(rom)
+                index.identify(rom, f, os.fstat(f.fileno()).st_size, None, hashes)
+                return rom_list
+            with zip_f:
+                for zinfo in zip_f.infolist():
+                    if zinfo.filename.endswith('/'): continue
+                    rom = new_import_ROM(filename, zinfo, os.path.basename(zinfo.filename))
+                    rom_list.append(rom)
+                    if index.reject_CRC(zinfo.CRC):
+                        rom['status'] = IMPORT_ROM_FILTERED
+                        continue
+                    try:
+                        with zip_f.open(zinfo) as zf:
+                            index.identify(rom, zf, zinfo.file_size, zinfo.CRC, hashes)
+                    except (zipfile.BadZipfile, NotImplementedError, zlib.error, EOFError) as e:
+                        log_warn('Cannot read "{}" in "{}": {}'.format(zinfo.filename, filename, str(e)))
+                        rom['status'] = IMPORT_ROM_ERROR
+    except OSError as e:
+        log_warn('Cannot read "{}": {}'.format(filename, str(e)))
+        if not rom_list: rom_list.append(new_import_ROM(filename, None, FileName(filename).getBase()))
+        rom_list[-1]['status'] = IMPORT_ROM_ERROR
+
+    return rom_list
+
+# Copies a ROM of the Incoming_dir to a new ZIP file dst_fname with name new_name.
+# ROMs in ZIP files are copied without decompressing them, see zip_copy_members_raw().
+# The ZIP file is written to a temporary file first so dst_fname is never left incomplete.
+def import_copy_ROM(rom, dst_fname, new_name):
+    temp_fname = os.path.join(os.path.dirname(dst_fname), '_prm_import_.zip')
+    if rom['zinfo'] is not None:
+        if not zip_copy_members_raw(temp_fname, [(rom['filename'], rom['zinfo'], new_name)]):
+            log_info('Cannot copy ROM in raw mode. Compressing ROM again.')
+            with zipfile.ZipFile(rom['filename'], 'r') as zin, \
+                zipfile.ZipFile(temp_fname, 'w', compression = zipfile.ZIP_DEFLATED, allowZip64 = True) as zout:
+                with zin.open(rom['zinfo']) as f_in, zout.open(new_name, 'w', force_zip64 = True) as f_out:
+                    for piece in misc_read_bytes_in_chunks(f_in): f_out.write(piece)
+    else:
+        with zipfile.ZipFile(temp_fname, 'w', compression = zipfile.ZIP_DEFLATED, allowZip64 = True) as zout:
+            zout.write(rom['filename'], new_name)
+    os.replace(temp_fname, dst_fname)
+
+# --- MAME collections ---------------------------------------------------------------------------
+# Stores all the sets of a MAME collection. The ZIP files are not decompressed, the CRC and
+# size of the ROMs in the ZIP central directory are used.
+class MAMEcollection(ROMcollection):
+    def __init__(self, collection_conf):
+        ROMcollection.__init__(self, collection_conf)
+        self.set_type = collection_conf['SetType']
+
+    # Fills self.sets with the status of every ZIP file in ROM_dir and adds the missing sets.
+    def process_MAME_files(self, DAT):
+        set_list = MAME_build_set_list(DAT, self.set_type)
+        self.num_DAT_sets = len(set_list)
+        if DAT.file_id is not None:
+            self.DAT_name = DAT.file_id['name']
+            self.DAT_sha1 = DAT.file_id['sha1']
+        self.scan_time = time.time()
+        set_dic = dict(set_list)
+        found_set = set()
+        for filename in sorted(self.get_file_list()):
+            FN = FileName(filename)
+            set_name = FN.getBase_noext() if FN.getExt().lower() == '.zip' else None
+            self.sets.append(build_MAME_ROM_set(filename, set_dic.get(set_name)))
+            if set_name in set_dic: found_set.add(set_name)
+        num_missing = 0
+        for set_name, DAT_ROMs in set_list:
+            if set_name in found_set: continue
+            rom_set = ROMset(FileName(self.dirname).pjoin(set_name + '.zip').getPath())
+            rom_set.status = ROMset.SET_STATUS_MISSING
+            for DAT_rom in DAT_ROMs:
+                rom = rom_set.new_rom()
+                rom['name'] = rom['correct_name'] = DAT_rom.name
+                rom['size'] = DAT_rom.size
+                rom['crc'] = DAT_rom.crc
+                rom['sha1'] = DAT_rom.sha1
+                rom['status'] = ROMset.ROM_STATUS_MISSING
+                rom_set.rom_list.append(rom)
+            self.sets.append(rom_set)
+            num_missing += 1
+        log_info('Added {} missing sets.'.format(num_missing))
+        self.sets.sort(key = lambda rom_set: rom_set.basename.lower())
+        for i, rom_set in enumerate(self.sets):
+            self.basename_index[rom_set.basename] = i
+
+# Creates a ROMset object of a MAME ZIP file. DAT_ROMs is the list of ROMs of the set, see
+# MAME_build_set_list(), or None if the file is not a set of the collection.
+# ROMs are found by name and CRC. A ROM with the correct CRC but a wrong name is BADNAME.
+# Files in the ZIP that are not ROMs of the set are UNKNOWN.
+def build_MAME_ROM_set(filename, DAT_ROMs):
+    rom_set = ROMset(filename)
+    try:
+        with zipfile.ZipFile(filename, 'r') as zip_f:
+            zinfo_list = [zinfo for zinfo in zip_f.infolist() if not zinfo.filename.endswith('/')]
+    except (zipfile.BadZipfile, OSError):
+        rom_set.status = ROMset.SET_STATUS_UNKNOWN if DAT_ROMs is None else ROMset.SET_STATUS_ERROR
+        return rom_set
+    zinfo_name_dic = {zinfo.filename : zinfo for zinfo in zinfo_list}
+    zinfo_key_dic = {}
+    for zinfo in zinfo_list:
+        zinfo_key_dic.setdefault(('{:08X}'.format(zinfo.CRC), zinfo.file_size), []).append(zinfo)
+    used_set = set()
+    for DAT_rom in (DAT_ROMs or []):
+        rom = rom_set.new_rom()
+        rom['name'] = rom['correct_name'] = DAT_rom.name
+        rom['size'] = DAT_rom.size
+        rom['crc'] = DAT_rom.crc
+        rom['sha1'] = DAT_rom.sha1
+        zinfo = zinfo_name_dic.get(DAT_rom.name)
+        if zinfo is not None and '{:08X}'.format(zinfo.CRC) == DAT_rom.crc and zinfo.file_size == DAT_rom.size:
+            rom['status'] = ROMset.ROM_STATUS_GOOD
+            rom['hashes'] = ('crc',)
+            used_set.add(zinfo.filename)
+        else:
+            zinfo_list_key = [z for z in zinfo_key_dic.get((DAT_rom.crc, DAT_rom.size), [])
+                if z.filename not in used_set]
+            if zinfo_list_key:
+                rom['name'] = zinfo_list_key[0].filename
+                rom['status'] = ROMset.ROM_STATUS_BADNAME
+                rom['hashes'] = ('crc',)
+                used_set.add(zinfo_list_key[0].filename)
+            else:
+                rom['status'] = ROMset.ROM_STATUS_MISSING
+        rom_set.rom_list.append(rom)
+    for zinfo in zinfo_list:
+        if zinfo.filename in used_set: continue
+        rom = rom_set.new_rom()
+        rom['name'] = rom['correct_name'] = zinfo.filename
+        rom['size'] = zinfo.file_size
+        rom['crc'] = '{:08X}'.format(zinfo.CRC)
+        rom['hashes'] = ('crc',)
+        rom['status'] = ROMset.ROM_STATUS_UNKNOWN
+        rom_set.rom_list.append(rom)
+
+    # Determine status of the set.
+    rom_status_set = {rom['status'] for rom in rom_set.rom_list}
+    if DAT_ROMs is None:
+        rom_set.status = ROMset.SET_STATUS_UNKNOWN
+    elif ROMset.ROM_STATUS_MISSING in rom_status_set:
+        rom_set.status = ROMset.SET_STATUS_PARTIAL
+    elif ROMset.ROM_STATUS_BADNAME in rom_status_set or ROMset.ROM_STATUS_UNKNOWN in rom_status_set:
+        rom_set.status = ROMset.SET_STATUS_BADNAME
+    else:
+        rom_set.status = ROMset.SET_STATUS_GOOD
+
+    return rom_set
+
+# --- MAME rebuild -------------------------------------------------------------------------------
+# Index of the ROMs in the ZIP files of some directories, used as a source of ROMs by the
+# rebuild. Only the ZIP central directories are read. Key is the tuple (CRC, size) and value
+# a list of tuples (ZIP filename, ZipInfo).
+class ZipSourceIndex:
+    def __init__(self):
+        self.index = {}
+        self.num_files = 0
+        self.num_members = 0
+
+    def add_dir(self, dirname):
+        dir_FN = FileName(dirname)
+        if not dir_FN.isdir():
+            log_warn('Source directory does not exist "{}"'.format(dir_FN.getPath()))
+            return
+        log_info('Indexing ZIP files in "{}"...'.format(dir_FN.getPath()))
+        zip_filter = FileFilter(extensions = ('.zip',))
+        for filename in sorted(e.path for e in dir_FN.recursiveScanDirEntries(zip_filter)):
+            try:
+                with zipfile.ZipFile(filename, 'r') as zip_f:
+                    zinfo_list = zip_f.infolist()
+            except (zipfile.BadZipfile, OSError) as e:
+                log_warn('Cannot read "{}": {}'.format(filename, str(e)))
+                continue
+            self.num_files += 1
+            for zinfo in zinfo_list:
+                if zinfo.filename.endswith('/'): continue
+                key = ('{:08X}'.format(zinfo.CRC), zinfo.file_size)
+                self.index.setdefault(key, []).append((filename, zinfo))
+                self.num_members += 1
+
+    # Returns a tuple (ZIP filename, ZipInfo) with the ROM or None if not found. A member of
+    # preferred_fname is returned if possible.
+    def find(self, crc, size, preferred_fname = None):
+        source_list = self.index.get((crc, size))
+        if not source_list: return None
+        for source in source_list:
+            if source[0] == preferred_fname: return source
+
+        return source_list[0]
+
+# Source ZIP files opened by the rebuild. The most recently used files are kept open and the
+# offset of the compressed data of the members already located is remembered, so a ZIP file
+# that is the source of many sets is not opened and parsed again for every set.
+# Not thread safe, each rebuild thread has its own cache.
+class ZipSourceFileCache:
+    def __init__(self, max_files = 64):
+        self.max_files = max_files
+        self.files = OrderedDict()
+        self.local_headers = {}
+        self.num_opens = 0
+
+    def open(self, fname):
+        f = self.files.get(fname)
+        if f is not None:
+            self.files.move_to_end(fname)
+            return f
+        if len(self.files) >= self.max_files:
+            old_fname, old_f = self.files.popitem(last = False)
+            old_f.close()
+        f = open(fname, 'rb')
+        self.files[fname] = f
+        self.num_opens += 1
+
+        return f
+
+    # Returns zip_read_local_header() of a member. Members shared by several sets are read once.
+    def get_local_header(self, fname, f, zinfo):
+        key = (fname, zinfo.header_offset)
+        if key not in self.local_headers:
+            self.local_headers[key] = zip_read_local_header(f, zinfo)
+
+        return self.local_headers[key]
+
+    def close(self):
+        for f in self.files.values(): f.close()
+        self.files.clear()
+
+# Creates the ZIP file dst_fname of a set with the members in member_list, a list of tuples
+# (src_fname, zinfo, ROM name). Members are copied without decompressing them if possible,
+# see zip_copy_members_raw(). Otherwise they are decompressed and compressed again.
+def MAME_rebuild_set(dst_fname, member_list, file_cache = None):
+    if zip_copy_members_raw(dst_fname, member_list, file_cache): return
+    log_debug('Cannot copy "{}" in raw mode. Compressing ROMs again.', dst_fname)
+    with zipfile.ZipFile(dst_fname, 'w', compression = zipfile.ZIP_DEFLATED, allowZip64 = True) as zout:
+        for src_fname, zinfo, name in member_list:
+            with zipfile.ZipFile(src_fname, 'r') as zin:
+                with zin.open(zinfo) as f_in, zout.open(name, 'w', force_zip64 = True) as f_out:
+                    for piece in misc_read_bytes_in_chunks(f_in): f_out.write(piece)
+
+# --- Directory watchers -------------------------------------------------------------------------
+# Watchers report the files created, modified, renamed or deleted in some directories and
+# their subdirectories. Both watchers have the same interface, read_events().
+# InotifyWatcher uses the Linux inotify API with ctypes. PollingWatcher compares the size and
+# modification time of all the files periodically and works on any platform.
+class InotifyWatcher:
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM  = 0x00000040
+    IN_MOVED_TO    = 0x00000080
+    IN_CREATE      = 0x00000100
+    IN_DELETE      = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF   = 0x00000800
+    IN_Q_OVERFLOW  = 0x00004000
+    IN_IGNORED     = 0x00008000
+    IN_ISDIR       = 0x40000000
+    IN_CLOEXEC     = 0o2000000
+    WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | \
+        IN_DELETE_SELF | IN_MOVE_SELF
+    EVENT_STRUCT = struct.Struct('iIII')
+
+    # Raises OSError if inotify is not available.
+    def __init__(self, dirname_list):
+        libc_name = ctypes.util.find_library('c')
+        if libc_name is None: raise OSError('C library not found')
+        self.libc = ctypes.CDLL(libc_name, use_errno = True)
+        if not hasattr(self.libc, 'inotify_init1'): raise OSError('inotify not available')
+        self.fd = self.libc.inotify_init1(InotifyWatcher.IN_CLOEXEC)
+        if self.fd < 0: raise OSError(ctypes.get_errno(), 'inotify_init1() failed')
+        self.dirname_list = dirname_list
+        self.wd_dic = {} # Key is the watch descriptor, value the directory name.
+        for dirname in dirname_list: self._add_watches(dirname)
+        log_info('Watching {:,} directories with inotify'.format(len(self.wd_dic)))
+
+    # inotify watches are not recursive, every subdirectory needs a watch.
+    def _add_watches(self, dirname):
+        for root, dirs, files in os.walk(dirname):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(root), InotifyWatcher.WATCH_MASK)
+            if wd < 0:
+                log_warn('Cannot watch "{}" (errno {})'.format(root, ctypes.get_errno()))
+                continue
+            self.wd_dic[wd] = root
+
+    # Waits up to timeout seconds for events. Returns a tuple (changed, rescan). changed is a
+    # set with the paths of the files changed. rescan is a set of directories that have been
+    # created, moved or deleted, or the watched directories if events were lost. The contents
+    # of these directories must be scanned again.
+    def read_events(self, timeout):
+        changed = set()
+        rescan = set()
+        readable, writable, errors = select.select([self.fd], [], [], timeout)
+        if not readable: return (changed, rescan)
+        data = os.read(self.fd, 64 * 1024)
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, name_len = InotifyWatcher.EVENT_STRUCT.unpack_from(data, offset)
+            offset += InotifyWatcher.EVENT_STRUCT.size
+            name = os.fsdecode(data[offset:offset + name_len].rstrip(b'\0'))
+            offset += name_len
+            if mask & InotifyWatcher.IN_Q_OVERFLOW:
+                log_warn('inotify events lost')
+                rescan.update(self.dirname_list)
+                continue
+            if mask & InotifyWatcher.IN_IGNORED:
+                self.wd_dic.pop(wd, None)
+                continue
+            dirname = self.wd_dic.get(wd)
+            if dirname is None or not name: continue
+            path = os.path.join(dirname, name)
+            if mask & InotifyWatcher.IN_ISDIR:
+                if mask & (InotifyWatcher.IN_CREATE | InotifyWatcher.IN_MOVED_TO):
+                    self._add_watches(path)
+                rescan.add(path)
+            else:
+                changed.add(path)
+
+        return (changed, rescan)
+
+    def close(self):
+        os.close(self.fd)
+
+class PollingWatcher:
+    def __init__(self, dirname_list, interval):
+        self.dirname_list = dirname_list
+        self.interval = interval
+        self.snapshot = self._get_snapshot()
+        self.next_poll = time.time() + interval
+        log_info('Watching {:,} files polling every {} seconds'.format(len(self.snapshot), interval))
+
+    # Returns a dictionary, key is the file path and value the tuple (size, mtime_ns).
+    def _get_snapshot(self):
+        snapshot = {}
+        for dirname in self.dirname_list:
+            for root, dirs, files in os.walk(dirname):
+                for filename in files:
+                    path = os.path.join(root, filename)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    snapshot[path] = (st.st_size, st.st_mtime_ns)
+        return snapshot
+
+    # Same as InotifyWatcher.read_events(). Directories are never rescanned.
+    def read_events(self, timeout):
+        wait_time = self.next_poll - time.time()
+        if wait_time > timeout:
+            time.sleep(timeout)
+            return (set(), set())
+        if wait_time > 0: time.sleep(wait_time)
+        snapshot = self._get_snapshot()
+        self.next_poll = time.time() + self.interval
+        changed = {path for path in snapshot if snapshot[path] != self.snapshot.get(path)}
+        changed.update(path for path in self.snapshot if path not in snapshot)
+        self.snapshot = snapshot
+
+        return (changed, set())
+
+    def close(self):
+        pass
+
+# Returns an InotifyWatcher or a PollingWatcher if inotify is not available or poll_interval
+# is not None.
+def new_directory_watcher(dirname_list, poll_interval = None):
+    if poll_interval is None:
+        try:
+            return InotifyWatcher(dirname_list)
+        except (OSError, AttributeError) as e:
+            log_info('inotify not available ({}). Polling directories.'.format(str(e)))
+            poll_interval = 10
+
+    return PollingWatcher(dirname_list, poll_interval)
@@ -0,0 +1,292 @@
+#!/usr/bin/python3 -B
+
+#
+# Python ROM Manager for MAME ROM sets.
+#
+
+# Copyright (c) 2020 Wintermute0110 <wintermute0110@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+# --- Python standard library --------------------------------------------------------------------
+import argparse
+import concurrent.futures
+import os
+import threading
+import sys
+
+# --- PRM modules --------------------------------------------------------------------------------
+import common
+from common import log_error, log_warn, log_info, log_verb, log_debug
+from common import FileName
+from common import MAMEcollection
+
+# --- Class with program options and settings ----------------------------------------------------
+class Options:
+    def __init__(self):
+        self.config_file_name = 'configuration.xml'
+        self.dry_run = False
+        self.jobs = 1
+
+# Process the program options in variable args. Returns an Options object.
+def process_arguments(args):
+    options = Options()
+    if args.verbose:
+        if args.verbose == 1:
+            common.change_log_level(common.LOG_VERB)
+            log_info('Verbosity level set to VERBOSE')
+        elif args.verbose == 2:
+            common.change_log_level(common.LOG_DEBUG)
+            log_info('Verbosity level set to DEBUG')
+    if args.dryRun:
+        options.dry_run = True
+    if args.jobs is not None:
+        if args.jobs < 1:
+            log_error('--jobs must be 1 or greater.')
+            sys.exit(1)
+        options.jobs = args.jobs
+
+    return options
+
+def get_collection_conf(configuration, collection_name):
+    if collection_name not in configuration.MAME_collections:
+        log_error('MAME collection "{}" not found in the configuration file.'.format(collection_name))
+        sys.exit(1)
+
+    return configuration.MAME_collections[collection_name]
+
+# Loads the MAME DAT of a collection. The compiled DAT is cached in the data directory.
+def load_collection_DAT(options, configuration, collection_conf):
+    DAT_dir_FN = FileName(configuration.common_opts['MAME_DAT_dir'])
+    DAT_FN = DAT_dir_FN.pjoin(collection_conf['DAT'])
+    DAT_cache_FN = options.data_dir_FN.pjoin(DAT_FN.getBase_noext() + '_DAT.bin')
+
+    return common.load_MAME_XML_DAT_file(DAT_FN, DAT_cache_FN)
+
+def perform_scanner(options, configuration, collection_name):
+    log_info('***** Scanning MAME collection {} *****'.format(collection_name))
+    collection_conf = get_collection_conf(configuration, collection_name)
+    DAT = load_collection_DAT(options, configuration, collection_conf)
+    collection = MAMEcollection(collection_conf)
+    collection.scan_files_in_dir()
+    collection.process_MAME_files(DAT)
+
+    return collection, DAT
+
+# Opens the database with the scanner results of all collections.
+def open_scan_database(options):
+    return common.ScanDatabase(options.data_dir_FN.pjoin('scan.db'))
+
+def save_scan_results(options, collection):
+    scan_db = open_scan_database(options)
+    print('Saving scanner results in "{}"'.format(scan_db.db_FN.getPath()))
+    scan_db.save_collection(collection)
+    scan_db.close()
+
+def print_scan_summary(collection_name, stats):
+    print('\n=== Scanner summary for collection "{}" ==='.format(collection_name))
+    print('Total SETs in DAT {:7,}'.format(stats['total_DAT']))
+    print('Total SETs        {:7,}'.format(stats['total']))
+    print('Have SETs         {:7,}'.format(stats['have']))
+    print('Badname SETs      {:7,}'.format(stats['badname']))
+    print('Partial SETs      {:7,}'.format(stats['partial']))
+    print('Miss SETs         {:7,}'.format(stats['missing']))
+    print('Unknown SETs      {:7,}'.format(stats['unknown']))
+    print('Error SETs        {:7,}'.format(stats['error']))
+
+# --- Main body functions ------------------------------------------------------------------------
+def command_listcollections(options):
+    log_info('Listing MAME collections in the configuration file')
+    configuration = common.parse_File_Config(options)
+    table_str = [
+        ['left', 'left', 'left', 'left'],
+        ['Collection', 'Set type', 'DAT file', 'ROM_dir'],
+    ]
+    for collection_conf in configuration.MAME_collections.values():
+        table_str.append([collection_conf['name'], collection_conf['SetType'],
+            collection_conf['DAT'], collection_conf['ROM_dir']])
+    print('')
+    for line in common.text_render_table(table_str): print(line)
+
+def command_scan(options, collection_name):
+    log_info('Scanning MAME collection {}'.format(collection_name))
+    configuration = common.parse_File_Config(options)
+    collection, DAT = perform_scanner(options, configuration, collection_name)
+    save_scan_results(options, collection)
+    print_scan_summary(collection_name, common.get_collection_statistics(collection))
+
+def command_status(options, collection_name):
+    log_info('View MAME collection scan results')
+    scan_db = open_scan_database(options)
+    stats = scan_db.get_collection_statistics(collection_name)
+    scan_db.close()
+    if stats is None:
+        print('Collection "{}" not found in {}'.format(collection_name, scan_db.db_FN.getPath()))
+        print('Exiting')
+        sys.exit(1)
+    print_scan_summary(collection_name, stats)
+
+def command_listIssues(options, collection_name):
+    log_info('List MAME collection sets with issues')
+    scan_db = open_scan_database(options)
+    set_list = scan_db.get_sets(collection_name, [common.ROMset.SET_STATUS_BADNAME,
+        common.ROMset.SET_STATUS_PARTIAL, common.ROMset.SET_STATUS_UNKNOWN,
+        common.ROMset.SET_STATUS_ERROR])
+    scan_db.close()
+    print('\n=== Scanner list of sets with issues ===')
+    for rom_set in set_list:
+        log_info('\033[91mSET\033[0m {} "{}"'.format(rom_set.status, rom_set.basename))
+        for rom in rom_set.rom_list:
+            if rom['status'] == common.ROMset.ROM_STATUS_GOOD: continue
+            if rom['status'] == common.ROMset.ROM_STATUS_BADNAME:
+                log_info('ROM {} "{}" -> "{}"'.format(rom['status'], rom['name'], rom['correct_name']))
+            else:
+                log_info('ROM {} "{}"'.format(rom['status'], rom['name']))
+    print('\nListed {} sets.'.format(len(set_list)))
+
+# Rebuilds the sets of a MAME collection that are missing, incomplete or have wrong names.
+# The ROMs are searched by CRC and size in the ZIP files of ROM_dir and the <Source_dir>
+# directories. Sets are built in temporary files by --jobs threads, copying the ROMs without
+# decompressing them. Every thread keeps the source files open, see ZipSourceFileCache.
+# When all the sets have been built the temporary files replace the old sets, so the ZIP files
+# of ROM_dir can be used as a source.
+def command_rebuild(options, collection_name):
+    log_info('Rebuilding MAME collection {}'.format(collection_name))
+    configuration = common.parse_File_Config(options)
+    collection_conf = get_collection_conf(configuration, collection_name)
+    collection, DAT = perform_scanner(options, configuration, collection_name)
+    set_dic = dict(common.MAME_build_set_list(DAT, collection.set_type))
+
+    # Index the source ROMs.
+    source_index = common.ZipSourceIndex()
+    source_index.add_dir(collection.dirname)
+    for dirname in collection_conf['Source_dirs']:
+        source_index.add_dir(dirname)
+    log_info('Source index has {:,} ROMs in {:,} ZIP files'.format(
+        source_index.num_members, source_index.num_files))
+
+    # Plan the rebuild. Sets are rebuilt only if more ROMs are available than the set has.
+    plan = []
+    for rom_set in collection.sets:
+        if rom_set.status not in (common.ROMset.SET_STATUS_MISSING, common.ROMset.SET_STATUS_PARTIAL,
+            common.ROMset.SET_STATUS_BADNAME): continue
+        set_name = FileName(rom_set.filename).getBase_noext()
+        if set_name not in set_dic: continue
+        num_have = len([rom for rom in rom_set.rom_list if rom['status'] in
+            (common.ROMset.ROM_STATUS_GOOD, common.ROMset.ROM_STATUS_BADNAME)])
+        member_list = []
+        for DAT_rom in set_dic[set_name]:
+            source = source_index.find(DAT_rom.crc, DAT_rom.size, rom_set.filename)
+            if source is not None:
+                member_list.append((source[0], source[1], DAT_rom.name))
+        if not member_list: continue
+        if len(member_list) <= num_have and rom_set.status != common.ROMset.SET_STATUS_BADNAME: continue
+        plan.append({
+            'filename' : rom_set.filename,
+            'temp_fname' : rom_set.filename + '.prm_tmp',
+            'member_list' : member_list,
+            'num_ROMs' : len(set_dic[set_name]),
+        })
+    log_info('{:,} sets to rebuild'.format(len(plan)))
+    if options.dry_run:
+        for action in plan:
+            num_sources = len({member[0] for member in action['member_list']})
+            print('Set "{}" {} of {} ROMs from {} files'.format(FileName(action['filename']).getBase(),
+                len(action['member_list']), action['num_ROMs'], num_sources))
+        print('Dry run. No files modified.')
+        return
+
+    # Build the sets in parallel.
+    thread_data = threading.local()
+    file_cache_list = []
+    lock = threading.Lock()
+    progress = common.ProgressReporter('Rebuilt set', len(plan))
+    def rebuild_set(action):
+        file_cache = getattr(thread_data, 'file_cache', None)
+        if file_cache is None:
+            file_cache = thread_data.file_cache = common.ZipSourceFileCache()
+            with lock: file_cache_list.append(file_cache)
+        common.MAME_rebuild_set(action['temp_fname'], action['member_list'], file_cache)
+        progress.update()
+
+    FileName(collection.dirname).makedirs()
+    try:
+        with concurrent.futures.ThreadPoolExecutor(options.jobs) as executor:
+            for future in [executor.submit(rebuild_set, action) for action in plan]:
+                future.result()
+    except:
+        for action in plan:
+            if os.path.exists(action['temp_fname']): os.remove(action['temp_fname'])
+        raise
+    finally:
+        for file_cache in file_cache_list: file_cache.close()
+    progress.finish()
+    for action in plan:
+        os.replace(action['temp_fname'], action['filename'])
+    num_opens = sum(file_cache.num_opens for file_cache in file_cache_list)
+    log_info('Rebuilt {:,} sets opening {:,} source files'.format(len(plan), num_opens))
+
+    # Rescan the collection. Only the ZIP central directories are read.
+    collection, DAT = perform_scanner(options, configuration, collection_name)
+    save_scan_results(options, collection)
+    print_scan_summary(collection_name, common.get_collection_statistics(collection))
+
+def command_usage():
+  print("""Usage: prm-mame.py [options] COMMAND [COLLECTION]
+
+Commands:
+usage                     Print usage information (this text).
+list                      Display MAME collections in the configuration file.
+scan COLLECTION           Scan ROM_dir in a MAME collection and print results.
+status COLLECTION         View scanner results.
+listIssues COLLECTION     List sets with issues (BadName, Partial, Unknown, Error).
+rebuild COLLECTION        Rebuild missing and incomplete sets from ROM_dir and Source_dir.
+
+Options:
+-h, --help                Print short command reference.
+-v, --verbose             Print more information about what's going on.
+--jobs N                  Use N threads to rebuild sets.
+--dryRun                  Don't modify any files, just print the operations to be done.""")
+
+# -----------------------------------------------------------------------------
+# main function
+# -----------------------------------------------------------------------------
+if __name__ == '__main__':
+    print('\033[36mPython ROM Manager for MAME ROM sets\033[0m version ' + common.PRM_VERSION)
+
+    # --- Initialise data and temp directories
+    this_FN = FileName(__file__)
+    data_dir_FN = FileName(this_FN.getDir()).pjoin('data')
+    log_info('Data dir "{}"'.format(data_dir_FN.getPath()))
+
+    # --- Command line parser
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-v', '--verbose', help = 'Be verbose', action = 'count')
+    parser.add_argument('--dryRun', help = 'Do not modify any files', action = 'store_true')
+    parser.add_argument('--jobs', help = 'Number of rebuild threads', type = int)
+    parser.add_argument('command', help = 'Main action to do', nargs = 1)
+    parser.add_argument('collection', help = 'MAME collection name', nargs = '?')
+    args = parser.parse_args()
+    options = process_arguments(args)
+    options.data_dir_FN = data_dir_FN
+
+    command = args.command[0]
+    if command == 'usage': command_usage()
+    elif command == 'list': command_listcollections(options)
+    elif command == 'scan': command_scan(options, args.collection)
+    elif command == 'status': command_status(options, args.collection)
+    elif command == 'listIssues': command_listIssues(options, args.collection)
+    elif command == 'rebuild': command_rebuild(options, args.collection)
+    else:
+        print('\033[31m[ERROR]\033[0m Unrecognised command "{}"'.format(command))
+        sys.exit(1)
+
+    # Sayonara
+    sys.exit(0)
@@ -17,8 +17,13 @@
 
 # --- Python standard library --------------------------------------------------------------------
 import argparse
+import concurrent.futures
+import contextlib
+import math
+import multiprocessing
 import os
-import pickle
+import threading
+import time
 import pprint
 import sys
 
@@ -32,6 +37,18 @@ from common import ROMcollection
 class Options:
     def __init__(self):
         self.config_file_name = 'configuration.xml'
+        self.dry_run = False
+        self.jobs = 1
+        self.threads = 1
+        self.queue_depth = 8
+        self.use_cache = True
+        self.quick = False
+        self.hashes = common.HASH_ALGORITHMS
+        self.sample_size = 200
+        self.poll_interval = None
+        self.profile = False
+        self.metrics_file = None
+        self.metrics = None
 
 # Process the program options in variable args. Returns an Options object.
 def process_arguments(args):
@@ -44,29 +61,134 @@ def process_arguments(args):
             common.change_log_level(common.LOG_DEBUG)
             log_info('Verbosity level set to DEBUG')
     if args.dryRun:
-        __prog_option_dry_run = 1
+        options.dry_run = True
+    if args.jobs is not None:
+        if args.jobs < 1:
+            log_error('--jobs must be 1 or greater.')
+            sys.exit(1)
+        options.jobs = args.jobs
+    if args.threads is not None:
+        if args.threads < 1:
+            log_error('--threads must be 1 or greater.')
+            sys.exit(1)
+        options.threads = args.threads
+    if args.queueDepth is not None:
+        if args.queueDepth < 1:
+            log_error('--queueDepth must be 1 or greater.')
+            sys.exit(1)
+        options.queue_depth = args.queueDepth
+    if args.noCache:
+        options.use_cache = False
+    if args.quick:
+        options.quick = True
+        options.hashes = ('crc',)
+    if args.sample is not None:
+        if args.sample < 1:
+            log_error('--sample must be 1 or greater.')
+            sys.exit(1)
+        options.sample_size = args.sample
+    if args.profile:
+        options.profile = True
+    if args.metricsJSON:
+        options.metrics_file = args.metricsJSON
+    if options.profile or options.metrics_file:
+        options.metrics = common.Metrics()
+    if args.poll is not None:
+        if args.poll < 1:
+            log_error('--poll must be 1 or greater.')
+            sys.exit(1)
+        options.poll_interval = args.poll
+    if args.hashes:
+        if args.quick:
+            log_error('--quick only computes the CRC, it cannot be used with --hashes.')
+            sys.exit(1)
+        hashes = [h.strip().lower() for h in args.hashes.split(',')]
+        for h in hashes:
+            if h not in common.HASH_ALGORITHMS:
+                log_error('Unknown hash "{}" in --hashes. Valid hashes are {}.'.format(
+                    h, ', '.join(common.HASH_ALGORITHMS)))
+                sys.exit(1)
+        options.hashes = tuple(h for h in common.HASH_ALGORITHMS if h in hashes)
 
     return options
 
-def perform_scanner(configuration, collection_name):
-    log_info('***** Scanning collection {} *****'.format(collection_name))
+def get_collection_conf(configuration, collection_name):
     if collection_name not in configuration.collections:
         log_error('Collection "{}" not found in the configuration file.'.format(collection_name))
         sys.exit(1)
-    collection_conf = configuration.collections[collection_name]
 
-    # Load DAT file.
+    return configuration.collections[collection_name]
+
+# Loads the DAT file of a collection. The compiled DAT is cached in the data directory.
+def load_collection_DAT(options, configuration, collection_conf):
     DAT_dir_FN = FileName(configuration.common_opts['NoIntro_DAT_dir'])
     DAT_FN = DAT_dir_FN.pjoin(collection_conf['DAT'])
-    DAT = common.load_XML_DAT_file(DAT_FN)
+    DAT_cache_FN = options.data_dir_FN.pjoin(DAT_FN.getBase_noext() + '_DAT.bin')
+
+    return common.load_XML_DAT_file(DAT_FN, DAT_cache_FN)
+
+# Returns the checksum cache of a collection or None if the cache is disabled.
+def open_checksum_cache(options, collection):
+    if not options.use_cache: return None
+    cache_FN = options.data_dir_FN.pjoin(collection.name + '_checksums.bin')
+    cache = common.ChecksumCache(cache_FN, collection.header_detector, options.quick, options.hashes)
+    cache.load()
+
+    return cache
+
+# If pool is not None the worker processes are shared with other scanners, see command_scanall().
+# num_jobs is the number of processes of pool, options.jobs if None.
+def perform_scanner(options, configuration, collection_name, pool = None, show_progress = True,
+    num_jobs = None):
+    log_info('***** Scanning collection {} *****'.format(collection_name))
+    collection_conf = get_collection_conf(configuration, collection_name)
+    with measure_phase(options, collection_name, 'DAT_load'):
+        DAT = load_collection_DAT(options, configuration, collection_conf)
 
     # Scan files in ROM_dir.
-    collection = ROMcollection(collection_conf )
+    # Checksums of files not modified since last scan are read from the cache.
+    collection = ROMcollection(collection_conf)
     collection.scan_files_in_dir()
-    collection.process_files(DAT)
+    with measure_phase(options, collection_name, 'cache_load'):
+        cache = open_checksum_cache(options, collection)
+    num_jobs = options.jobs if num_jobs is None else num_jobs
+    collection.process_files(DAT, num_jobs, cache, options.quick, options.hashes,
+        pool, show_progress, options.threads, options.queue_depth, options.metrics)
+    if cache is not None:
+        with measure_phase(options, collection_name, 'cache_save'):
+            cache.save()
 
     return collection
 
+# Measures a phase of a command with --profile or --metricsJSON, see common.Metrics.
+def measure_phase(options, collection_name, phase_name):
+    if options.metrics is None: return contextlib.nullcontext({})
+
+    return options.metrics.phase(collection_name, phase_name)
+
+# Prints and saves the metrics of a command with --profile or --metricsJSON.
+def report_metrics(options, command):
+    if options.metrics is None: return
+    if options.profile: options.metrics.print_report()
+    if options.metrics_file:
+        options.metrics.save_JSON(options.metrics_file, command)
+        print('Metrics saved in "{}"'.format(options.metrics_file))
+
+# Opens the database with the scanner results of all collections.
+def open_scan_database(options):
+    return common.ScanDatabase(options.data_dir_FN.pjoin('scan.db'))
+
+# Opens the scanner results database and checks the collection has been scanned.
+def open_scan_database_collection(options, collection_name):
+    scan_db = open_scan_database(options)
+    if not scan_db.collection_exists(collection_name):
+        print('Collection "{}" not found in {}'.format(collection_name, scan_db.db_FN.getPath()))
+        print('Exiting')
+        sys.exit(1)
+    print('Loading scanner results in "{}"'.format(scan_db.db_FN.getPath()))
+
+    return scan_db
+
 # --- Main body functions ------------------------------------------------------------------------
 def command_listcollections(options):
     log_info('Listing ROM Collections in the configuration file')
@@ -93,13 +215,13 @@ def command_listcollections(options):
 def command_scan(options, collection_name):
     log_info('Scanning collection')
     configuration = common.parse_File_Config(options)
-    collection = perform_scanner(configuration, collection_name)
+    collection = perform_scanner(options, configuration, collection_name)
     # Save scanner results for later.
-    scan_FN = options.data_dir_FN.pjoin(collection.name + '_scan.bin')
-    print('Saving scanner results in "{}"'.format(scan_FN.getPath()))
-    f = open(scan_FN.getPath(), 'wb')
-    pickle.dump(collection, f)
-    f.close()
+    scan_db = open_scan_database(options)
+    print('Saving scanner results in "{}"'.format(scan_db.db_FN.getPath()))
+    with measure_phase(options, collection_name, 'db_save'):
+        scan_db.save_collection(collection)
+    scan_db.close()
 
     # Print scanner summary.
     stats = common.get_collection_statistics(collection)
@@ -111,38 +233,94 @@ def command_scan(options, collection_name):
     print('Miss SETs         {:5,}'.format(stats['missing']))
     print('Unknown SETs      {:5,}'.format(stats['unknown']))
     print('Error SETs        {:5,}'.format(stats['error']))
+    report_metrics(options, 'scan ' + collection_name)
 
+# Collections are grouped by the disk where the ROM_dir is. There is one scanner thread for
+# each disk that scans the collections in that disk one after another, so a slow disk does not
+# delay the collections in other disks. All the threads share the same pool of --jobs worker
+# processes to decompress and hash the ROMs.
 def command_scanall(options):
     log_info('Scanning all collections')
     configuration = common.parse_File_Config(options)
 
-    # Scan collection by collection.
-    stats_list = []
+    # Group collections by disk.
+    disk_collections = {}
+    for collection_name, collection_conf in configuration.collections.items():
+        try:
+            disk_id = os.stat(collection_conf['ROM_dir']).st_dev
+        except OSError:
+            disk_id = None
+        disk_collections.setdefault(disk_id, []).append(collection_name)
+    log_info('Scanning {} collections in {} disks'.format(
+        len(configuration.collections), len(disk_collections)))
+
+    # Scan collection by collection in each disk.
+    # The --jobs worker processes are split between the disks, each disk has its own pool,
+    # so the files of a slow disk do not keep busy the workers of the other disks. A disk
+    # with one worker is scanned without a pool.
+    stats_dic = {}
+    db_lock = threading.Lock()
+    show_progress = len(disk_collections) == 1
+    def scan_disk_collections(collection_names, num_jobs):
+        if num_jobs > 1:
+            pool = multiprocessing.Pool(num_jobs,
+                initializer = common.change_log_level, initargs = (common.log_level,))
+        else:
+            pool = None
+        try:
+            for collection_name in collection_names:
+                collection = perform_scanner(options, configuration, collection_name, pool,
+                    show_progress, num_jobs)
+                # Save scanner results for later.
+                with db_lock:
+                    scan_db = open_scan_database(options)
+                    print('Saving scanner results in "{}"'.format(scan_db.db_FN.getPath()))
+                    with measure_phase(options, collection_name, 'db_save'):
+                        scan_db.save_collection(collection)
+                    scan_db.close()
+                    stats_dic[collection_name] = common.get_collection_statistics(collection)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+    if disk_collections:
+        num_disks = len(disk_collections)
+        with concurrent.futures.ThreadPoolExecutor(num_disks) as executor:
+            futures = []
+            for i, collection_names in enumerate(disk_collections.values()):
+                num_jobs = max(1, options.jobs // num_disks + (1 if i < options.jobs % num_disks else 0))
+                futures.append(executor.submit(scan_disk_collections, collection_names, num_jobs))
+            for future in futures: future.result()
+
+    # Print scanner summary.
+    table_str = [
+        ['left', 'left', 'left', 'left', 'left', 'left', 'left', 'left'],
+        ['Collection', 'DAT SETs', 'Total ROMs', 'Have ROMs',
+         'BadName ROMs', 'Miss ROMs', 'Unknown ROMs', 'Error files'],
+    ]
     for collection_name in configuration.collections:
-        collection = perform_scanner(configuration, collection_name)
-        # Save scanner results for later.
-        scan_FN = options.data_dir_FN.pjoin(collection.name + '_scan.bin')
-        print('Saving scanner results in "{}"'.format(scan_FN.getPath()))
-        f = open(scan_FN.getPath(), 'wb')
-        pickle.dump(collection, f)
-        f.close()
+        stats = stats_dic[collection_name]
+        table_str.append([
+            str(stats['name']), str(stats['total_DAT']), str(stats['total']), str(stats['have']),
+            str(stats['badname']), str(stats['missing']), str(stats['unknown']), str(stats['error']),
+        ])
+    table_text = common.text_render_table(table_str)
+    print('\n=== Scanner summary for all collections ===')
+    for line in table_text: print(line)
+    report_metrics(options, 'scanall')
 
 def command_status(options, collection_name):
     log_info('View collection scan results')
-    # Load collection scanner data.
-    scan_FN = options.data_dir_FN.pjoin(collection_name + '_scan.bin')
-    if not scan_FN.exists():
-        print('Not found {}'.format(scan_FN.getPath()))
-        print('Exiting')
-        sys.exit(1)
-    print('Loading scanner results in "{}"'.format(scan_FN.getPath()))
-    f = open(scan_FN.getPath(), 'rb')
-    collection = pickle.load(f)
-    f.close()
+    # Read the collection summary in the scanner database.
+    scan_db = open_scan_database_collection(options, collection_name)
+    stats = scan_db.get_collection_statistics(collection_name)
+    scan_db.close()
 
     # Print scanner summary.
-    stats = common.get_collection_statistics(collection)
     print('\n=== Scanner summary for collection "{}" ==='.format(collection_name))
+    print('Scanned on {}'.format(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(stats['scan_time']))))
+    print('DAT file "{}"'.format(stats['DAT_name']))
     print('Total SETs in DAT {:5,}'.format(stats['total_DAT']))
     print('Total SETs        {:5,}'.format(stats['total']))
     print('Have SETs         {:5,}'.format(stats['have']))
@@ -155,20 +333,18 @@ def command_statusall(options):
     log_info('View all collections scan results')
     configuration = common.parse_File_Config(options)
 
+    # Read the collection summaries in the scanner database.
     stats_list = []
+    scan_db = open_scan_database(options)
+    print('Loading scanner results in "{}"'.format(scan_db.db_FN.getPath()))
     for collection_name in configuration.collections:
-        # Load collection scanner data.
-        scan_FN = options.data_dir_FN.pjoin(collection_name + '_scan.bin')
-        if not scan_FN.exists():
-            print('Not found {}'.format(scan_FN.getPath()))
+        stats = scan_db.get_collection_statistics(collection_name)
+        if stats is None:
+            print('Collection "{}" not found in {}'.format(collection_name, scan_db.db_FN.getPath()))
             print('Exiting')
             sys.exit(1)
-        print('Loading scanner results in "{}"'.format(scan_FN.getPath()))
-        f = open(scan_FN.getPath(), 'rb')
-        collection = pickle.load(f)
-        f.close()
-        stats = common.get_collection_statistics(collection)
         stats_list.append(stats)
+    scan_db.close()
 
     # Print results.
     table_str = [
@@ -188,19 +364,13 @@ def command_statusall(options):
 def command_listROMs(options, collection_name):
     log_info('List collection scanned ROMs')
     # Load collection scanner data.
-    scan_FN = options.data_dir_FN.pjoin(collection_name + '_scan.bin')
-    if not scan_FN.exists():
-        print('Not found {}'.format(scan_FN.getPath()))
-        print('Exiting')
-        sys.exit(1)
-    print('Loading scanner results in "{}"'.format(scan_FN.getPath()))
-    f = open(scan_FN.getPath(), 'rb')
-    collection = pickle.load(f)
-    f.close()
+    scan_db = open_scan_database_collection(options, collection_name)
+    set_list = scan_db.get_sets(collection_name)
+    scan_db.close()
 
     # Print scanner results (long list)
     print('\n=== Scanner long list ===')
-    for set in collection.sets:
+    for set in set_list:
         log_info('\033[91mSET\033[0m {} "{}"'.format(set.status, set.basename))
         for rom in set.rom_list:
             if rom['status'] == common.ROMset.ROM_STATUS_BADNAME:
@@ -211,21 +381,17 @@ def command_listROMs(options, collection_name):
 
 def command_listIssues(options, collection_name):
     log_info('List collection scanned ROMs with issues')
-    # Load collection scanner data.
-    scan_FN = options.data_dir_FN.pjoin(collection_name + '_scan.bin')
-    if not scan_FN.exists():
-        print('Not found {}'.format(scan_FN.getPath()))
-        print('Exiting')
-        sys.exit(1)
-    print('Loading scanner results in "{}"'.format(scan_FN.getPath()))
-    f = open(scan_FN.getPath(), 'rb')
-    collection = pickle.load(f)
-    f.close()
+    # Load collection sets with issues from scanner data.
+    scan_db = open_scan_database_collection(options, collection_name)
+    set_list = scan_db.get_sets(collection_name, [
+        common.ROMset.SET_STATUS_BADNAME, common.ROMset.SET_STATUS_MISSING,
+        common.ROMset.SET_STATUS_UNKNOWN, common.ROMset.SET_STATUS_ERROR,
+    ])
+    scan_db.close()
 
     # Print scanner results (long list)
     print('\n=== Scanner long list ===')
-    for set in collection.sets:
-        if set.status == common.ROMset.SET_STATUS_GOOD: continue
+    for set in set_list:
         log_info('\033[91mSET\033[0m {} "{}"'.format(set.status, set.basename))
         for rom in set.rom_list:
             if rom['status'] == common.ROMset.ROM_STATUS_BADNAME:
@@ -240,33 +406,21 @@ LIST_UNKNOWN = 300
 LIST_ERROR   = 400
 def command_listStuff(options, collection_name, list_type):
     log_info('List collection scanned ROMs with issues')
-    # Load collection scanner data.
-    scan_FN = options.data_dir_FN.pjoin(collection_name + '_scan.bin')
-    if not scan_FN.exists():
-        print('Not found {}'.format(scan_FN.getPath()))
-        print('Exiting')
-        sys.exit(1)
-    print('Loading scanner results in "{}"'.format(scan_FN.getPath()))
-    f = open(scan_FN.getPath(), 'rb')
-    collection = pickle.load(f)
-    f.close()
+    # Load collection sets from scanner data. The database filters the sets by status.
+    if list_type == LIST_BADNAME:   set_status = common.ROMset.SET_STATUS_BADNAME
+    elif list_type == LIST_MISSING: set_status = common.ROMset.SET_STATUS_MISSING
+    elif list_type == LIST_UNKNOWN: set_status = common.ROMset.SET_STATUS_UNKNOWN
+    elif list_type == LIST_ERROR:   set_status = common.ROMset.SET_STATUS_ERROR
+    else:
+        raise TypeError('Wrong type. Logical error.')
+    scan_db = open_scan_database_collection(options, collection_name)
+    set_list = scan_db.get_sets(collection_name, [set_status])
+    scan_db.close()
 
     # Print scanner results (long list)
     print('\n=== Scanner long list ===')
     num_items = 0
-    for set in collection.sets:
-        # Filter SET
-        if list_type == LIST_BADNAME:
-            if set.status != common.ROMset.SET_STATUS_BADNAME: continue
-        elif list_type == LIST_MISSING:
-            if set.status != common.ROMset.SET_STATUS_MISSING: continue
-        elif list_type == LIST_UNKNOWN:
-            if set.status != common.ROMset.SET_STATUS_UNKNOWN: continue
-        elif list_type == LIST_ERROR:
-            if set.status != common.ROMset.SET_STATUS_ERROR: continue
-        else:
-            raise TypeError('Wrong type. Logical error.')
-
+    for set in set_list:
         log_info('\033[91mSET\033[0m {} "{}"'.format(set.status, set.basename))
         num_items += 1
         for rom in set.rom_list:
@@ -277,26 +431,535 @@ def command_listStuff(options, collection_name, list_type):
                 log_info('ROM {} "{}"'.format(rom['status'], rom['name']))
     print('\nListed {} items.'.format(num_items))
 
+# The fix commands do not scan the collection. The actions are planned from the results of
+# the last scan and only the sets modified are updated in the scanner database.
+# Returns True if the set file is the same as in the last scan. The size and modification
+# time stored in the scanner results are checked, so this also works with --noCache.
+def check_set_unchanged(set, cache):
+    if not os.path.isfile(set.filename):
+        log_warn('File not found "{}". Skipping it.'.format(set.filename))
+        return False
+    st = os.stat(set.filename)
+    if set.is_file_modified(st) or (cache is not None and cache.is_modified(set.filename, st)):
+        log_warn('File "{}" modified after the last scan. Skipping it.'.format(set.filename))
+        return False
+
+    return True
+
+# Updates the scanner results and the checksum cache after the actions have been done.
+def update_scan_results(scan_db, collection, DAT, cache, removed, new_sets):
+    if removed or new_sets:
+        log_info('Updating scanner results of {} sets'.format(len(removed) + len(new_sets)))
+        scan_db.update_sets(collection.name, collection.dirname, DAT, removed, new_sets)
+    if cache is not None: cache.save()
+    scan_db.close()
+
 def command_fix(options, collection_name):
     log_info('Fixing collection {}'.format(collection_name))
     configuration = common.parse_File_Config(options)
-    collection = perform_scanner(configuration, collection_name)
-    for set in collection.sets:
-        if set.status == common.ROMset.SET_STATUS_BADNAME:
-            common.fix_ROM_set(set)
-    # Rescan collection and store results in chache.
-    command_scan(options, collection_name)
+    collection = ROMcollection(get_collection_conf(configuration, collection_name))
+    scan_db = open_scan_database_collection(options, collection_name)
+    cache = open_checksum_cache(options, collection)
+
+    # Plan the actions. Do not overwrite existing files.
+    plan = []
+    target_set = set()
+    for rom_set in scan_db.get_sets(collection_name, [common.ROMset.SET_STATUS_BADNAME]):
+        if not check_set_unchanged(rom_set, cache): continue
+        target = rom_set.correct_filename
+        if target != rom_set.filename and (target in target_set or os.path.exists(target)):
+            log_warn('File "{}" already exists. Skipping "{}".'.format(target, rom_set.filename))
+            continue
+        target_set.add(target)
+        plan.append(rom_set)
+    log_info('{} sets to fix'.format(len(plan)))
+    if options.dry_run:
+        for rom_set in plan:
+            if rom_set.filename != rom_set.correct_filename:
+                print('MV "{}"\n-> "{}"'.format(rom_set.filename, rom_set.correct_filename))
+            rom = rom_set.rom_list[0]
+            if rom['name'] != rom['correct_name']:
+                print('ROM "{}" -> "{}"'.format(rom['name'], rom['correct_name']))
+        print('Dry run. No files modified.')
+        return
+
+    # Fix the sets. The checksums of a ROM do not change when it is renamed.
+    DAT = load_collection_DAT(options, configuration, configuration.collections[collection_name])
+    removed = []
+    new_sets = []
+    for rom_set in plan:
+        if not common.fix_ROM_set(rom_set, DAT.get_ROM_extensions()): continue
+        rom = rom_set.rom_list[0]
+        file_info = {
+            'zfilename' : rom['correct_name'],
+            'checksums' : {'crc' : rom['crc'], 'md5' : rom['md5'], 'sha1' : rom['sha1'], 'size' : rom['size']},
+            'header_checksums' : None,
+            'hashes' : rom['hashes'],
+            'quick' : False,
+        }
+        removed.append(rom_set.filename)
+        st = os.stat(rom_set.correct_filename)
+        new_set = common.build_ROM_set(rom_set.correct_filename, file_info, DAT)
+        new_set.set_file_stat(st)
+        new_sets.append(new_set)
+        if cache is not None:
+            cache.rename(rom_set.filename, rom_set.correct_filename, st, rom['correct_name'])
+    update_scan_results(scan_db, collection, DAT, cache, removed, new_sets)
+    print('\nFixed {} sets.'.format(len(new_sets)))
 
 def command_deleteUnknown(options, collection_name):
     log_info('Deleting Unknown SETs in collection {}'.format(collection_name))
     configuration = common.parse_File_Config(options)
-    collection = perform_scanner(configuration, collection_name)
-    for set in collection.sets:
-        if set.status == common.ROMset.SET_STATUS_UNKNOWN:
-            print('Deleting {}'.format(set.basename))
-            os.remove(set.filename)
-    # Rescan collection and store results in chache.
-    command_scan(options, collection_name)
+    collection = ROMcollection(get_collection_conf(configuration, collection_name))
+    scan_db = open_scan_database_collection(options, collection_name)
+    cache = open_checksum_cache(options, collection)
+
+    # Only ZIP files and loose ROMs are deleted, never other files in ROM_dir, even if a
+    # scan with an older PRM reported them as Unknown.
+    DAT = load_collection_DAT(options, configuration, configuration.collections[collection_name])
+    plan = [rom_set for rom_set in scan_db.get_sets(collection_name, [common.ROMset.SET_STATUS_UNKNOWN])
+        if check_set_unchanged(rom_set, cache) and (rom_set.filename.lower().endswith('.zip') or
+            common.is_loose_ROM_file(rom_set.filename, DAT.get_ROM_extensions()))]
+    log_info('{} sets to delete'.format(len(plan)))
+    if options.dry_run:
+        for rom_set in plan:
+            print('RM "{}"'.format(rom_set.filename))
+        print('Dry run. No files modified.')
+        return
+
+    removed = []
+    for rom_set in plan:
+        print('Deleting {}'.format(rom_set.basename))
+        os.remove(rom_set.filename)
+        removed.append(rom_set.filename)
+        if cache is not None: cache.remove(rom_set.filename)
+    update_scan_results(scan_db, collection, DAT, cache, removed, [])
+    print('\nDeleted {} sets.'.format(len(removed)))
+
+# Finds the DAT of a collection. A random sample of the ROMs in ROM_dir is searched in the
+# index of all the DATs in NoIntro_DAT_dir and the DATs are ranked by the number of matches.
+# If there is a newer DAT of the same system than the configured one that has more matches
+# it is reported.
+def command_selectDAT(options, collection_name):
+    log_info('Selecting DAT for collection {}'.format(collection_name))
+    configuration = common.parse_File_Config(options)
+    collection_conf = get_collection_conf(configuration, collection_name)
+    DAT_index = common.DATIndex(FileName(configuration.common_opts['NoIntro_DAT_dir']),
+        options.data_dir_FN.pjoin('DAT_index.bin'))
+    DAT_index.build()
+
+    # Sample the ROMs and count the matches of every DAT.
+    collection = ROMcollection(collection_conf)
+    collection.scan_files_in_dir()
+    key_list = common.sample_collection_keys(collection, options.sample_size,
+        DAT_index.get_ROM_extensions())
+    num_keys = len(key_list)
+    print('Sampled {:,} ROMs of {:,} files'.format(num_keys, len(collection.get_file_list())))
+    if num_keys == 0:
+        print('No ROMs found in ROM_dir')
+        return
+    counters = DAT_index.count_matches(key_list)
+
+    # Newer DATs go first if the number of matches is the same.
+    DAT_list = DAT_index.DAT_list
+    DAT_dates = [common.get_DAT_system_and_date(DAT_entry['name']) for DAT_entry in DAT_list]
+    ranking = [i for i in range(len(DAT_list)) if counters[i] > 0]
+    ranking.sort(key = lambda i: (counters[i], DAT_dates[i][1]), reverse = True)
+    if not ranking:
+        print('No DAT matches the ROMs in ROM_dir')
+        return
+    table_str = [
+        ['left', 'right', 'right', 'right', 'left'],
+        ['DAT file', 'Matches', 'Match rate', 'DAT ROMs', 'Configured'],
+    ]
+    for i in ranking[:10]:
+        # 95% confidence interval of the match rate.
+        rate = counters[i] / num_keys
+        margin = 1.96 * math.sqrt(rate * (1 - rate) / num_keys)
+        table_str.append([DAT_list[i]['name'], '{:,}'.format(counters[i]),
+            '{:.1f}% +-{:.1f}'.format(100 * rate, 100 * margin), '{:,}'.format(DAT_list[i]['num_ROMs']),
+            'Yes' if DAT_list[i]['name'] == collection_conf['DAT'] else ''])
+    print('')
+    for line in common.text_render_table(table_str): print(line)
+    print('\nBest DAT "{}"'.format(DAT_list[ranking[0]]['name']))
+
+    # Check if there is a newer DAT for the system of the configured DAT.
+    conf_idx_list = [i for i in range(len(DAT_list)) if DAT_list[i]['name'] == collection_conf['DAT']]
+    if not conf_idx_list:
+        print('Configured DAT "{}" not found in NoIntro_DAT_dir'.format(collection_conf['DAT']))
+        return
+    conf_idx = conf_idx_list[0]
+    print('Configured DAT "{}" matches {:,} of {:,} ROMs'.format(
+        collection_conf['DAT'], counters[conf_idx], num_keys))
+    system, date = DAT_dates[conf_idx]
+    newer_list = [i for i in ranking if DAT_dates[i][0] == system and DAT_dates[i][1] > date]
+    if newer_list and counters[newer_list[0]] > counters[conf_idx]:
+        print('Newer DAT "{}" matches {:,} of {:,} ROMs. Consider updating <DAT> of the collection.'.format(
+            DAT_list[newer_list[0]]['name'], counters[newer_list[0]], num_keys))
+
+# Copies the known ROMs in the Incoming_dir to the collections. The files in the Incoming_dir
+# are read once. The CRC of every ROM is checked with the Bloom filter of the import index
+# and only the ROMs that pass are searched in the DATs of all the collections. ROMs are copied to ROM_dir with the DAT set and ROM names. Files in the
+# Incoming_dir are not modified.
+def command_import(options):
+    log_info('Importing ROMs in the Incoming_dir')
+    configuration = common.parse_File_Config(options)
+    incoming_FN = FileName(configuration.common_opts['Incoming_dir'])
+    if not configuration.common_opts['Incoming_dir'] or not incoming_FN.isdir():
+        log_error('Incoming_dir "{}" not found.'.format(incoming_FN.getPath()))
+        sys.exit(1)
+
+    # Build the index of all the collections.
+    index = common.ImportIndex()
+    for collection_conf in configuration.collections.values():
+        index.add_collection(collection_conf, load_collection_DAT(options, configuration, collection_conf))
+    index.build_filter()
+
+    # Identify the ROMs and plan the copies. Do not overwrite existing files.
+    log_info('Scanning files in "{}"...'.format(incoming_FN.getPath()))
+    file_list = sorted(incoming_FN.recursiveScanFilesInPath('*'))
+    status_counters = {
+        common.IMPORT_ROM_FILTERED : 0,
+        common.IMPORT_ROM_UNKNOWN : 0,
+        common.IMPORT_ROM_FOUND : 0,
+        common.IMPORT_ROM_ERROR : 0,
+    }
+    num_have = 0
+    plan = []
+    target_set = set()
+    progress = common.ProgressReporter('Processed file', len(file_list))
+    for filename in file_list:
+        progress.update()
+        for rom in common.import_identify_file(filename, index, options.hashes):
+            status_counters[rom['status']] += 1
+            for collection_conf, DAT, checksums, DAT_matches in rom['matches']:
+                rom_set = common.ROMset(filename)
+                datrom = common.resolve_DAT_ROM(rom_set, {'name' : rom['name']}, DAT_matches)
+                datset = [datset for datset, r in DAT_matches if r is datrom][0]
+                if len(datset.ROMs) != 1:
+                    log_verb('Set "{}" has {} ROMs. Skipping it.'.format(datset.name, len(datset.ROMs)))
+                    continue
+                target = FileName(collection_conf['ROM_dir']).pjoin(datset.name + '.zip').getPath()
+                if target in target_set or os.path.exists(target):
+                    num_have += 1
+                    continue
+                target_set.add(target)
+                plan.append({
+                    'rom' : rom,
+                    'collection_conf' : collection_conf,
+                    'DAT' : DAT,
+                    'checksums' : checksums,
+                    'datrom' : datrom,
+                    'target' : target,
+                })
+    progress.finish()
+
+    if options.dry_run:
+        for action in plan:
+            rom = action['rom']
+            source = rom['filename'] if rom['zinfo'] is None else '{}:{}'.format(rom['filename'], rom['name'])
+            print('CP "{}"\n-> "{}" ({})'.format(source, action['target'], action['collection_conf']['name']))
+        print('Dry run. No files modified.')
+    else:
+        # Copy the ROMs and add the new sets to the scanner results of each collection.
+        collection_actions = {}
+        for action in plan:
+            collection_actions.setdefault(action['collection_conf']['name'], []).append(action)
+        for collection_name, action_list in collection_actions.items():
+            collection = ROMcollection(configuration.collections[collection_name])
+            cache = open_checksum_cache(options, collection)
+            FileName(collection.dirname).makedirs()
+            new_sets = []
+            for action in action_list:
+                log_info('CP "{}"\n-> "{}"'.format(action['rom']['filename'], action['target']))
+                common.import_copy_ROM(action['rom'], action['target'], action['datrom'].name)
+                file_info = {
+                    'zfilename' : action['datrom'].name,
+                    'checksums' : action['checksums'],
+                    'header_checksums' : None,
+                    'hashes' : tuple(options.hashes),
+                    'quick' : False,
+                }
+                st = os.stat(action['target'])
+                new_set = common.build_ROM_set(action['target'], file_info, action['DAT'])
+                new_set.set_file_stat(st)
+                new_sets.append(new_set)
+                if cache is not None: cache.put(action['target'], st, file_info)
+            scan_db = open_scan_database(options)
+            if scan_db.collection_exists(collection_name):
+                scan_db.update_sets(collection_name, collection.dirname, action_list[0]['DAT'], [], new_sets)
+            scan_db.close()
+            if cache is not None: cache.save()
+
+    # Print import summary.
+    print('\n=== Import summary ===')
+    print('Files in Incoming_dir  {:7,}'.format(len(file_list)))
+    print('Rejected by filter     {:7,}'.format(status_counters[common.IMPORT_ROM_FILTERED]))
+    print('Unknown ROMs           {:7,}'.format(status_counters[common.IMPORT_ROM_UNKNOWN]))
+    print('Error ROMs             {:7,}'.format(status_counters[common.IMPORT_ROM_ERROR]))
+    print('Known ROMs             {:7,}'.format(status_counters[common.IMPORT_ROM_FOUND]))
+    print('Already in collection  {:7,}'.format(num_have))
+    print('{} {:7,}'.format('ROMs to import        ' if options.dry_run else 'Imported ROMs         ', len(plan)))
+
+# Seconds without file events before the changed files are scanned. Copying a set usually
+# produces several events.
+WATCH_QUIET_TIME = 1.0
+
+# Returns the list of watched collections whose ROM_dir has filename. Several collections
+# may share a ROM_dir or have nested ROM_dirs.
+def watch_find_collections(watched_list, filename):
+    return [watched for watched in watched_list if filename.startswith(watched['prefix'])]
+
+def watch_log_statistics(stats):
+    log_info('Collection {} Have {:,} BadName {:,} Miss {:,} Unknown {:,} Error {:,}'.format(
+        stats['name'], stats['have'], stats['badname'], stats['missing'], stats['unknown'],
+        stats['error']))
+
+# Scans again a collection and replaces its scanner results. Used at startup and when
+# directories are created, moved or deleted.
+def watch_scan_collection(options, configuration, scan_db, watched):
+    collection = perform_scanner(options, configuration, watched['collection'].name,
+        show_progress = False)
+    scan_db.save_collection(collection)
+    watch_log_statistics(common.get_collection_statistics(collection))
+    # perform_scanner() saved the checksums of all the files, reload the cache.
+    watched['cache'] = open_checksum_cache(options, watched['collection'])
+
+# Scans the files in filename_set, which were created, modified, renamed or deleted, and
+# updates the scanner results of the collection.
+def watch_update_collection(options, scan_db, watched, filename_set):
+    collection = watched['collection']
+    DAT = watched['DAT']
+    cache = watched['cache']
+    removed = []
+    new_sets = []
+    for filename in sorted(filename_set):
+        if not common.SCANNER_FILE_FILTER.match(os.path.basename(filename)): continue
+        removed.append(filename)
+        try:
+            st = os.stat(filename)
+        except OSError:
+            st = None
+        if st is None or not os.path.isfile(filename):
+            log_info('Removed "{}"'.format(filename))
+            if cache is not None: cache.remove(filename)
+            continue
+        file_info = cache.get(filename, st) if cache is not None else None
+        if file_info is None:
+            file_info = common.get_ROM_file_info(filename, collection.header_detector,
+                options.quick, options.hashes, loose_extensions = DAT.get_ROM_extensions())
+            if cache is not None: cache.put(filename, st, file_info)
+        rom_set = common.build_ROM_set(filename, file_info, DAT)
+        rom_set.set_file_stat(st)
+        log_info('{} "{}"'.format(rom_set.status, filename))
+        new_sets.append(rom_set)
+    scan_db.update_sets(collection.name, collection.dirname, DAT, removed, new_sets, time.time())
+    if cache is not None: cache.save()
+    stats = scan_db.get_collection_statistics(collection.name)
+    watch_log_statistics(stats)
+
+# Keeps the scanner results of all the collections up to date. The collections are scanned
+# once and then the ROM_dirs are watched. Only the files created, modified, renamed or
+# deleted are scanned again and their sets updated in the scanner database.
+def command_watch(options):
+    log_info('Watching all collections')
+    configuration = common.parse_File_Config(options)
+    scan_db = open_scan_database(options)
+    watched_list = []
+    for collection_conf in configuration.collections.values():
+        if not os.path.isdir(collection_conf['ROM_dir']):
+            log_warn('Directory does not exist "{}". Skipping collection {}.'.format(
+                collection_conf['ROM_dir'], collection_conf['name']))
+            continue
+        collection = ROMcollection(collection_conf)
+        watched = {
+            'collection' : collection,
+            'prefix' : os.path.join(collection.dirname, ''),
+            'DAT' : load_collection_DAT(options, configuration, collection_conf),
+            'cache' : None,
+        }
+        watched_list.append(watched)
+    if not watched_list:
+        log_error('No collections to watch.')
+        sys.exit(1)
+
+    # Start watching before the initial scan so no changes are lost.
+    watcher = common.new_directory_watcher([w['collection'].dirname for w in watched_list],
+        options.poll_interval)
+    for watched in watched_list:
+        watch_scan_collection(options, configuration, scan_db, watched)
+    print('Watching {} collections. Press Ctrl-C to stop.'.format(len(watched_list)))
+
+    pending = {} # Key is the collection name, value the set of changed files.
+    rescan = set() # Names of collections to scan again.
+    last_event_time = 0.0
+    try:
+        while True:
+            changed, rescan_dirs = watcher.read_events(WATCH_QUIET_TIME)
+            for filename in changed:
+                for watched in watch_find_collections(watched_list, filename):
+                    pending.setdefault(watched['collection'].name, set()).add(filename)
+                    last_event_time = time.time()
+            for dirname in rescan_dirs:
+                for watched in watched_list:
+                    if watched['prefix'].startswith(os.path.join(dirname, '')) or \
+                        dirname.startswith(watched['prefix']):
+                        rescan.add(watched['collection'].name)
+                        last_event_time = time.time()
+            if not pending and not rescan: continue
+            if time.time() - last_event_time < WATCH_QUIET_TIME: continue
+
+            for watched in watched_list:
+                name = watched['collection'].name
+                if name in rescan:
+                    watch_scan_collection(options, configuration, scan_db, watched)
+                elif name in pending:
+                    watch_update_collection(options, scan_db, watched, pending[name])
+            pending = {}
+            rescan = set()
+    except KeyboardInterrupt:
+        print('\nStopped watching.')
+    finally:
+        watcher.close()
+        scan_db.close()
+
+# Hash name from the length of the hashes in hexadecimal.
+WHEREIS_HASH_LENGTHS = {8 : 'crc', 32 : 'md5', 40 : 'sha1'}
+
+# Returns the content keys of a file that is not a set of any collection. The file is hashed
+# with no header detector and with the detector of every collection, and the checksums with
+# and without header are used, so headered and headerless copies are found. SHA1 and MD5 are
+# also looked up in the roms table to find ROMs without a CRC, see get_ROM_content_key().
+# Returns a set of tuples (content_key, sha1).
+def whereis_hash_file(scan_db, configuration, filename):
+    detector_dic = {None : None}
+    for collection_conf in configuration.collections.values():
+        detector = common.get_collection_detector(collection_conf)
+        if detector is not None: detector_dic.setdefault(detector.key, detector)
+    loose_extensions = common.get_ROM_name_extensions([filename])
+    key_set = set()
+    for detector in detector_dic.values():
+        file_info = common.get_ROM_file_info(filename, detector, loose_extensions = loose_extensions)
+        if file_info['checksums'] is None:
+            print('File "{}" is not a valid set. ZIP files must have one ROM.'.format(filename))
+            print('Exiting')
+            sys.exit(1)
+        for checksums in (file_info['checksums'], file_info['header_checksums']):
+            if checksums is None: continue
+            rom = dict(checksums, status = common.ROMset.ROM_STATUS_UNKNOWN)
+            key_set.add((common.get_ROM_content_key(rom), rom['sha1']))
+            for hash_name in ('sha1', 'md5'):
+                if not rom[hash_name]: continue
+                key_set.update((location['content_key'], rom['sha1'])
+                    for location in scan_db.find_hash(hash_name, rom[hash_name]))
+
+    return key_set
+
+# Returns the content keys of a hash or a file for command whereis. A list of tuples
+# (content_key, sha1), empty if not found, see ScanDatabase.find_content(). If the file is a
+# set of a collection the content keys of the set ROMs are used, otherwise the file is
+# hashed. Hashes are looked up in the roms table. A SHA1 or MD5 alone is not found if all the
+# copies were scanned with --quick.
+def whereis_get_content_keys(scan_db, configuration, argument):
+    if os.path.isfile(argument):
+        filename = os.path.abspath(argument)
+        key_list = scan_db.get_set_content_keys(filename)
+        if key_list: return key_list
+        log_info('File "{}" is not in any collection. Hashing it.'.format(filename))
+        return sorted(whereis_hash_file(scan_db, configuration, filename))
+
+    hash_value = argument.upper()
+    hash_name = WHEREIS_HASH_LENGTHS.get(len(hash_value))
+    if hash_name is None or not all(c in '0123456789ABCDEF' for c in hash_value):
+        print('"{}" is not a file or a SHA1, MD5 or CRC hash'.format(argument))
+        print('Exiting')
+        sys.exit(1)
+    location_list = scan_db.find_hash(hash_name, hash_value)
+    if hash_name == 'crc':
+        return sorted({(location['content_key'], '') for location in location_list})
+
+    return sorted({(location['content_key'], location['sha1']) for location in location_list})
+
+def command_whereis(options, argument):
+    log_info('Find the copies of a ROM in all collections')
+    if argument is None:
+        print('whereis requires a SHA1, MD5 or CRC hash or a file name')
+        print('Exiting')
+        sys.exit(1)
+    configuration = common.parse_File_Config(options)
+    scan_db = open_scan_database(options)
+    print('Loading scanner results in "{}"'.format(scan_db.db_FN.getPath()))
+    # Copies without a SHA1 are found with every SHA1 of the same content key.
+    location_list = []
+    location_set = set()
+    for content_key, sha1 in whereis_get_content_keys(scan_db, configuration, argument):
+        for location in scan_db.find_content(content_key, sha1):
+            location_id = (location['collection'], location['filename'], location['rom_name'])
+            if location_id in location_set: continue
+            location_set.add(location_id)
+            location_list.append(location)
+    scan_db.close()
+    if not location_list:
+        print('\nROM not found in any collection.')
+        return
+
+    table_str = [
+        ['left', 'left', 'left', 'left', 'right', 'left'],
+        ['Collection', 'Set', 'Set status', 'ROM', 'Size', 'ROM status'],
+    ]
+    for location in location_list:
+        table_str.append([
+            location['collection'], location['filename'], location['set_status'],
+            location['rom_name'], '{:,}'.format(location['size']), location['rom_status'],
+        ])
+    table_text = common.text_render_table(table_str)
+    print('')
+    for line in table_text: print(line)
+
+# Prints the duplicate ROMs of all collections or, if collection_name is set, the duplicate
+# ROMs of that collection and where their other copies are.
+def command_duplicates(options, collection_name):
+    log_info('Find duplicate ROMs in all collections')
+    scan_db = open_scan_database(options)
+    print('Loading scanner results in "{}"'.format(scan_db.db_FN.getPath()))
+    groups = scan_db.get_duplicate_groups()
+    totals = scan_db.get_content_totals()
+    scan_db.close()
+    stats_dic = common.get_duplicate_statistics(groups, totals)
+    if collection_name is not None and collection_name not in stats_dic:
+        print('Collection "{}" not found in {}'.format(collection_name, scan_db.db_FN.getPath()))
+        print('Exiting')
+        sys.exit(1)
+
+    # Summary of all collections.
+    table_str = [
+        ['left', 'right', 'right', 'right', 'right', 'right', 'right'],
+        ['Collection', 'ROMs', 'Bytes', 'Dup ROMs', 'Dup bytes', 'Reclaim ROMs', 'Reclaim bytes'],
+    ]
+    total_stats = {key : 0 for key in ('ROMs', 'bytes', 'duplicate_ROMs', 'duplicate_bytes',
+        'reclaimable_ROMs', 'reclaimable_bytes')}
+    for stats in stats_dic.values():
+        table_str.append([stats['name'], '{:,}'.format(stats['ROMs']), '{:,}'.format(stats['bytes']),
+            '{:,}'.format(stats['duplicate_ROMs']), '{:,}'.format(stats['duplicate_bytes']),
+            '{:,}'.format(stats['reclaimable_ROMs']), '{:,}'.format(stats['reclaimable_bytes'])])
+        for key in total_stats: total_stats[key] += stats[key]
+    table_str.append(['Total', '{:,}'.format(total_stats['ROMs']), '{:,}'.format(total_stats['bytes']),
+        '{:,}'.format(total_stats['duplicate_ROMs']), '{:,}'.format(total_stats['duplicate_bytes']),
+        '{:,}'.format(total_stats['reclaimable_ROMs']), '{:,}'.format(total_stats['reclaimable_bytes'])])
+    table_text = common.text_render_table(table_str)
+    print('')
+    for line in table_text: print(line)
+    if collection_name is None: return
+
+    # Duplicate ROMs of the collection. Copies not kept can be deleted.
+    print('\n=== Duplicate ROMs of collection "{}" ==='.format(collection_name))
+    for location_list in groups:
+        if not any(collection_name in location['collections'] for location in location_list): continue
+        print('')
+        for location in location_list:
+            print('{} {} "{}" ROM "{}" {:,} bytes'.format(
+                'Keep   ' if location['keep'] else 'Reclaim', ','.join(location['collections']),
+                location['filename'], location['rom_name'], location['size']))
 
 def command_usage():
   print("""Usage: prm.py [options] COMMAND [COLLECTION]
@@ -320,60 +983,96 @@ fix COLLECTION            Fixes sets in ROM_dir in a collection.
 
 deleteUnknown COLLECTION  Delete Unknown ROMs.
 
+import                    Copy the known ROMs in Incoming_dir to the collections.
+
+selectDAT COLLECTION      Find the DAT of a collection sampling the ROMs in ROM_dir.
+
+watch                     Keep the scanner results up to date watching the ROM_dirs.
+
+whereis HASH|FILE         List the copies of a ROM in all collections. HASH is a SHA1, MD5 or CRC.
+duplicates [COLLECTION]   Print duplicate and reclaimable ROMs of all collections.
+
 Options:
 -h, --help                Print short command reference.
 -v, --verbose             Print more information about what's going on.
+--jobs N                  Use N processes to decompress and hash ROMs when scanning.
+--threads N               Use N threads to decompress and hash ROMs when scanning without --jobs.
+--queueDepth N            Number of files read ahead of the hashing threads.
+--quick                   Use the CRC stored in the ZIP files. Do not compute MD5 and SHA1.
+--hashes LIST             Comma separated hashes to compute when scanning (crc,md5,sha1).
+                          Cannot be used with --quick.
+--sample N                Number of ROMs sampled by selectDAT.
+--poll SECONDS            Make watch check the ROM_dirs every SECONDS instead of using inotify.
+--profile                 Print the time, throughput and memory of each phase of scan and scanall.
+--metricsJSON FILE        Append the metrics of scan and scanall to FILE as a line of JSON.
+--noCache                 Decompress and hash all files, even if they did not change since last scan.
 --dryRun                  Don't modify any files, just print the operations to be done.""")
 
 # -----------------------------------------------------------------------------
 # main function
 # -----------------------------------------------------------------------------
-print('\033[36mPython ROM Manager for No-Intro ROM sets\033[0m version ' + common.PRM_VERSION)
-
-# --- Initialise data and temp directories
-# This is used to store the results of scans for later display. Use JSON to store data.
-this_FN = FileName(__file__)
-data_dir_FN = FileName(this_FN.getDir()).pjoin('data')
-temp_dir_FN = FileName(this_FN.getDir()).pjoin('tmp')
-log_info('Data dir "{}"'.format(data_dir_FN.getPath()))
-log_info('Temp dir "{}"'.format(temp_dir_FN.getPath()))
-
-# --- Command line parser
-parser = argparse.ArgumentParser()
-parser.add_argument('-v', '--verbose', help = 'Bbe verbose', action = 'count')
-parser.add_argument('--dryRun', help = 'Do not modify any files', action = 'store_true')
-parser.add_argument('command', help = 'Main action to do', nargs = 1)
-parser.add_argument('collection', help = 'ROM collection name', nargs = '?')
-args = parser.parse_args()
-options = process_arguments(args)
-options.data_dir_FN = data_dir_FN
-options.temp_dir_FN = temp_dir_FN
-# pprint.pprint(args)
-
-# --- Positional arguments that don't require a filterName
-command = args.command[0]
-if command == 'usage': command_usage()
-elif command == 'list': command_listcollections(options)
-
-elif command == 'scan': command_scan(options, args.collection)
-elif command == 'scanall': command_scanall(options)
-
-elif command == 'status': command_status(options, args.collection)
-elif command == 'statusall': command_statusall(options)
-
-elif command == 'listROMs': command_listROMs(options, args.collection)
-elif command == 'listIssues': command_listIssues(options, args.collection)
-elif command == 'listBadName': command_listStuff(options, args.collection, LIST_BADNAME)
-elif command == 'listMissing': command_listStuff(options, args.collection, LIST_MISSING)
-elif command == 'listUnknown': command_listStuff(options, args.collection, LIST_UNKNOWN)
-elif command == 'listError': command_listStuff(options, args.collection, LIST_ERROR)
-
-elif command == 'fix': command_fix(options, args.collection)
-elif command == 'deleteUnknown': command_deleteUnknown(options, args.collection)
-
-else:
-    print('\033[31m[ERROR]\033[0m Unrecognised command "{}"'.format(command))
-    sys.exit(1)
-
-# Sayonara
-sys.exit(0)
+if __name__ == '__main__':
+    print('\033[36mPython ROM Manager for No-Intro ROM sets\033[0m version ' + common.PRM_VERSION)
+
+    # --- Initialise data and temp directories
+    # This is used to store the results of scans for later display. Use JSON to store data.
+    this_FN = FileName(__file__)
+    data_dir_FN = FileName(this_FN.getDir()).pjoin('data')
+    temp_dir_FN = FileName(this_FN.getDir()).pjoin('tmp')
+    log_info('Data dir "{}"'.format(data_dir_FN.getPath()))
+    log_info('Temp dir "{}"'.format(temp_dir_FN.getPath()))
+
+    # --- Command line parser
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-v', '--verbose', help = 'Bbe verbose', action = 'count')
+    parser.add_argument('--dryRun', help = 'Do not modify any files', action = 'store_true')
+    parser.add_argument('--jobs', help = 'Number of scanner processes', type = int)
+    parser.add_argument('--threads', help = 'Number of scanner hashing threads', type = int)
+    parser.add_argument('--queueDepth', help = 'Number of files read ahead by the scanner', type = int)
+    parser.add_argument('--noCache', help = 'Do not use the checksum cache', action = 'store_true')
+    parser.add_argument('--quick', help = 'Use the CRC stored in the ZIP files', action = 'store_true')
+    parser.add_argument('--hashes', help = 'Comma separated list of hashes to compute')
+    parser.add_argument('--sample', help = 'Number of ROMs sampled by selectDAT', type = int)
+    parser.add_argument('--profile', help = 'Print the metrics of each phase of the scanner', action = 'store_true')
+    parser.add_argument('--metricsJSON', help = 'Append the scanner metrics to this JSON file')
+    parser.add_argument('--poll', help = 'Seconds between checks of watch', type = int)
+    parser.add_argument('command', help = 'Main action to do', nargs = 1)
+    parser.add_argument('collection', help = 'ROM collection name', nargs = '?')
+    args = parser.parse_args()
+    options = process_arguments(args)
+    options.data_dir_FN = data_dir_FN
+    options.temp_dir_FN = temp_dir_FN
+    # pprint.pprint(args)
+
+    # --- Positional arguments that don't require a filterName
+    command = args.command[0]
+    if command == 'usage': command_usage()
+    elif command == 'list': command_listcollections(options)
+
+    elif command == 'scan': command_scan(options, args.collection)
+    elif command == 'scanall': command_scanall(options)
+
+    elif command == 'status': command_status(options, args.collection)
+    elif command == 'statusall': command_statusall(options)
+
+    elif command == 'listROMs': command_listROMs(options, args.collection)
+    elif command == 'listIssues': command_listIssues(options, args.collection)
+    elif command == 'listBadName': command_listStuff(options, args.collection, LIST_BADNAME)
+    elif command == 'listMissing': command_listStuff(options, args.collection, LIST_MISSING)
+    elif command == 'listUnknown': command_listStuff(options, args.collection, LIST_UNKNOWN)
+    elif command == 'listError': command_listStuff(options, args.collection, LIST_ERROR)
+
+    elif command == 'fix': command_fix(options, args.collection)
+    elif command == 'deleteUnknown': command_deleteUnknown(options, args.collection)
+    elif command == 'import': command_import(options)
+    elif command == 'selectDAT': command_selectDAT(options, args.collection)
+    elif command == 'watch': command_watch(options)
+    elif command == 'whereis': command_whereis(options, args.collection)
+    elif command == 'duplicates': command_duplicates(options, args.collection)
+
+    else:
+        print('\033[31m[ERROR]\033[0m Unrecognised command "{}"'.format(command))
+        sys.exit(1)
+
+    # Sayonara
+    sys.exit(0)